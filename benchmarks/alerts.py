@@ -0,0 +1,85 @@
+'''Load test of the alert engine: one ingest cycle against many subscriptions.
+
+    python benchmarks/alerts.py --subscriptions 100000 --vehicles 5000 --moved 0.6
+
+Subscriptions are synthetic, a mix of journey and line subscriptions on stops around the
+fleet of benchmarks/live_storage.py. Every cycle moves a share of the vehicles (the feed repeats
+the fix of the rest), the engine then only evaluates the subscriptions of the moved vehicles.
+Nothing is written to redis or the database.
+'''
+import argparse
+import random
+import statistics
+import time
+from datetime import timedelta
+from live_storage import synthetic_fleet, AREA
+from bustrackr_server import motion
+from bustrackr_server.alerts import AlertEngine, Subscription
+
+def synthetic_subscriptions(count: int, fleet: list, journey_share: float, seed: int = 3) -> list:
+    rng = random.Random(seed)
+    line_ids = sorted({vehicle.line_id for vehicle in fleet})
+    subscriptions = []
+    for i in range(count):
+        journey = rng.random() < journey_share
+        meters = rng.choice((None, 300, 500, 1000))
+        subscriptions.append(Subscription(
+            id=i,
+            user_id=i // 5,
+            journey_id=rng.choice(fleet).service_journey_id if journey else None,
+            line_id=None if journey else rng.choice(line_ids),
+            stop_id=8000000 + rng.randrange(50000),
+            latitude=rng.uniform(AREA[2], AREA[0]),
+            longitude=rng.uniform(AREA[1], AREA[3]),
+            meters=meters,
+            minutes=rng.choice((2, 5, 10)) if meters is None else rng.choice((None, 2, 5, 10)),
+        ))
+    return subscriptions
+
+def move(fleet: list, share: float, rng: random.Random) -> list:
+    moved = []
+    for vehicle in fleet:
+        if rng.random() < share:
+            vehicle = vehicle.copy(update={
+                'latitude': vehicle.latitude + rng.gauss(0, 0.0003),
+                'longitude': vehicle.longitude + rng.gauss(0, 0.0006),
+                'timestamp': vehicle.timestamp + timedelta(seconds=5),
+            })
+        moved.append(vehicle)
+    return moved
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscriptions', type=int, default=100000)
+    parser.add_argument('--vehicles', type=int, default=5000)
+    parser.add_argument('--moved', type=float, default=0.6, help='Share of the vehicles with a new fix every cycle')
+    parser.add_argument('--journeys', type=float, default=0.5, help='Share of journey (not line) subscriptions')
+    parser.add_argument('--cycles', type=int, default=10)
+    args = parser.parse_args()
+
+    fleet = synthetic_fleet(args.vehicles)
+    subscriptions = synthetic_subscriptions(args.subscriptions, fleet, args.journeys)
+    engine = AlertEngine()
+    start = time.perf_counter()
+    engine.load(subscriptions)
+    print(f'{args.subscriptions} subscriptions indexed in {(time.perf_counter() - start) * 1000:.0f} ms, '
+          f'{len(engine.by_journey)} journeys and {len(engine.by_line)} lines')
+
+    rng = random.Random(4)
+    now = time.time()
+    engine.evaluate(motion.update(fleet), now) # Every vehicle is new in the first cycle
+    times, pairs, alerts = [], [], []
+    for cycle in range(args.cycles):
+        fleet = move(fleet, args.moved, rng)
+        vehicles = motion.update(fleet)
+        start = time.perf_counter()
+        cycle_alerts, cycle_pairs = engine.evaluate(vehicles, now + 5 * (cycle + 1))
+        times.append((time.perf_counter() - start) * 1000)
+        pairs.append(cycle_pairs)
+        alerts.append(len(cycle_alerts))
+    print(f'{args.moved:.0%} of {args.vehicles} vehicles moving: {statistics.median(times):.1f} ms per cycle (median), '
+          f'{statistics.median(pairs):.0f} pairs evaluated of {args.subscriptions} subscriptions, '
+          f'{sum(alerts) / len(alerts):.0f} alerts per cycle')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+'''Per-request cost of authentication, before and after the verified token cache.
+
+    python benchmarks/auth_overhead.py --requests 20000
+
+"before" is what every authenticated request used to do: jwt.decode, then re-encode and set
+a new cookie. "after" is token_required + renew_jwt_token as they are now: a cache lookup,
+the revocation SISMEMBER and a renewal only late in the token's life. The SISMEMBER round
+trip is included only if redis is reachable (--no-redis to leave it out).
+'''
+import argparse
+import statistics
+import time
+from types import SimpleNamespace
+import jwt
+from werkzeug.wrappers import Response
+from bustrackr_server import Config, redis_client
+from bustrackr_server.services.authentication_service import add_jwt_token, renew_jwt_token, validate_jwt_token
+
+def issue_token(user_id: int) -> str:
+    response = Response()
+    add_jwt_token(response, user_id, False)
+    return response.headers['Set-Cookie'].split(';')[0].split('=', 1)[1]
+
+def before(token: str) -> None:
+    decoded = jwt.decode(token, Config.JWT_SECRET, algorithms=['HS256'])
+    payload = {'user_id': decoded['user_id'], 'long_expire': decoded['long_expire'], 'exp': decoded['exp'] + 1}
+    Response().set_cookie('authToken', jwt.encode(payload, Config.JWT_SECRET, algorithm='HS256'), httponly=True)
+
+def after(token: str) -> None:
+    request = SimpleNamespace()
+    validate_jwt_token(request, token)
+    renew_jwt_token(Response(), request)
+
+def measure(name: str, func, tokens: list, requests: int) -> None:
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        func(tokens[i % len(tokens)])
+        latencies.append((time.perf_counter() - start) * 1_000_000)
+    latencies.sort()
+    print(f'{name:>7}: mean {statistics.mean(latencies):7.1f} us, p50 {latencies[len(latencies) // 2]:7.1f} us, '
+          f'p99 {latencies[int(len(latencies) * 0.99)]:7.1f} us')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20_000)
+    parser.add_argument('--users', type=int, default=1000, help='Distinct tokens in use')
+    parser.add_argument('--no-redis', action='store_true', help='Skip the revocation check')
+    args = parser.parse_args()
+
+    if not args.no_redis:
+        try:
+            redis_client.ping()
+        except Exception:
+            print('redis is not reachable, measuring without the revocation check')
+            args.no_redis = True
+    Config.TOKEN_REVOCATION_CHECK = not args.no_redis
+
+    tokens = [issue_token(user_id) for user_id in range(args.users)]
+    measure('before', before, tokens, args.requests)
+    measure('after', after, tokens, args.requests)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''Redis memory and latency of live snapshots against per vehicle hashes on a synthetic fleet.
+
+    python benchmarks/live_storage.py --vehicles 5000 --cycles 20
+
+"hash" is how the live data used to be stored: a redis-om hash per vehicle with its RediSearch
+index, written in one pipeline and read with a bounding box FT.SEARCH. "packed" is a snapshot per
+cycle (live_store), read with GET and decoded, and "packed (cached)" is the common case of a
+worker which already decoded the current cycle. Memory is the growth of used_memory while a cycle
+is stored, so it includes the index. Use an otherwise idle redis (with RediSearch), everything
+the benchmark writes is deleted afterwards.
+'''
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timezone, timedelta
+from redis_om import HashModel, Field, Migrator
+from bustrackr_server import redis_client
+from bustrackr_server import live_store, motion
+
+# Ids as in the NeTEx data, 16 digits, far beyond 32 bits
+LINES = [(9011001000100000 + n * 100000, str(n), f'Destination {n}', f'Operator {n % 7}') for n in range(1, 400)]
+# Stockholm, the box is about the size of a zoomed in map
+AREA = (59.45, 17.80, 59.20, 18.25)
+BOX = (59.34, 18.02, 59.31, 18.09)
+
+class VehicleLive(HashModel):
+    '''The hash and index the live data used to be stored as'''
+    service_journey_id: int = Field(index=True)
+    vehicle_id: int = Field(index=True)
+    bearing: float
+    velocity: int
+    longitude: float = Field(index=True)
+    latitude: float = Field(index=True)
+    timestamp: datetime
+    line_id: int = 0
+    line: str = ''
+    destination: str = ''
+    operator: str = ''
+
+    class Meta:
+        primary_key = ('service_journey_id', 'vehicle_id')
+        database = redis_client
+
+def synthetic_fleet(vehicles: int, seed: int = 1) -> list:
+    rng = random.Random(seed)
+    now = datetime.now(timezone(timedelta(hours=2)))
+    fleet = []
+    for i in range(vehicles):
+        line_id, line, destination, operator = rng.choice(LINES)
+        fleet.append(live_store.LiveVehicle(
+            service_journey_id=9015001000000000 + i,
+            vehicle_id=9031001000000000 + i,
+            bearing=rng.uniform(0, 360),
+            velocity=rng.randint(0, 25),
+            latitude=rng.uniform(AREA[2], AREA[0]),
+            longitude=rng.uniform(AREA[1], AREA[3]),
+            timestamp=now - timedelta(seconds=rng.randint(0, 30)),
+            line_id=line_id,
+            line=line,
+            destination=destination,
+            operator=operator,
+            route_id=line_id + 1, # One route per line, its id as long as the real ones
+        ))
+    return fleet
+
+def used_memory() -> int:
+    return int(redis_client.info('memory')['used_memory'])
+
+def as_hashes(fleet: list) -> list:
+    return [VehicleLive(**vehicle._asdict()) for vehicle in fleet]
+
+def write_hashes(fleet: list) -> None:
+    with redis_client.pipeline() as pipe:
+        for vehicle in fleet:
+            vehicle.save(pipeline=pipe)
+            vehicle.expire(15, pipeline=pipe)
+        pipe.execute()
+
+def delete_hashes(fleet: list) -> None:
+    with redis_client.pipeline(transaction=False) as pipe:
+        for vehicle in fleet:
+            pipe.delete(vehicle.key())
+        pipe.execute()
+
+def read_hashes() -> list:
+    lat_0, lon_0, lat_1, lon_1 = BOX
+    return VehicleLive.find(
+        (VehicleLive.latitude > lat_1) & (VehicleLive.latitude < lat_0) &
+        (VehicleLive.longitude > lon_0) & (VehicleLive.longitude < lon_1)
+    ).all()
+
+def read_packed() -> list:
+    return live_store.in_box(live_store.read_current_cycle().vehicles, *BOX)
+
+def read_packed_cold() -> list:
+    live_store.remember_cycle(live_store.EMPTY_CYCLE) # Forget the decoded cycle, as a worker seeing a new one would
+    return read_packed()
+
+def timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1000
+
+def report(name: str, memory: int, vehicles: int, writes: list, reads: list) -> None:
+    print(f'{name:16} {memory / vehicles:8.0f} B/vehicle   write {statistics.median(writes):7.2f} ms   '
+          f'read {statistics.median(reads):7.3f} ms (median)')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vehicles', type=int, default=5000)
+    parser.add_argument('--cycles', type=int, default=20, help='Writes and reads measured per mode')
+    args = parser.parse_args()
+
+    fleet = synthetic_fleet(args.vehicles)
+    live = motion.update(fleet) # What the ingester publishes
+    blob = live_store.pack_cycle(live)
+    print(f'{args.vehicles} vehicles, packed cycle is {len(blob)} bytes ({len(blob) / args.vehicles:.1f} B/vehicle before redis overhead)')
+    start = time.perf_counter()
+    live_store.unpack_cycle(blob)
+    print(f'Decoding a cycle takes {(time.perf_counter() - start) * 1000:.2f} ms')
+
+    try:
+        redis_client.ping()
+    except Exception:
+        print('redis is not reachable, only the encoding was measured')
+        return
+
+    Migrator().run()
+    before = used_memory()
+    hashes = as_hashes(fleet)
+    writes = [timed(write_hashes, hashes) for _ in range(args.cycles)]
+    time.sleep(1) # Let the index catch up
+    memory = used_memory() - before
+    reads = [timed(read_hashes) for _ in range(args.cycles)]
+    delete_hashes(hashes)
+    redis_client.ft(VehicleLive.Meta.index_name).dropindex()
+    report('hash', memory, args.vehicles, writes, reads)
+
+    cycle_ids = []
+    before = used_memory()
+    cycle_ids.append(live_store.write_cycle(live))
+    memory = used_memory() - before # One snapshot, the replaced ones expire after a grace period
+    writes = [timed(lambda: cycle_ids.append(live_store.write_cycle(live))) for _ in range(args.cycles)]
+    cold = [timed(read_packed_cold) for _ in range(args.cycles)]
+    warm = [timed(read_packed) for _ in range(args.cycles)]
+    report('packed', memory, args.vehicles, writes, cold)
+    report('packed (cached)', memory, args.vehicles, writes, warm)
+    redis_client.delete(live_store.CURRENT_KEY, *(f'{live_store.CYCLE_KEY_PREFIX}{cycle_id}' for cycle_id in cycle_ids))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''Closed loop load test, compares the waitress app with the async (ASGI) app.
+
+Start both against the same database and redis, e.g.
+    waitress-serve --port=8080 --threads=8 --call bustrackr_server:create_app
+    uvicorn bustrackr_server.asgi:app --port 8081
+then
+    python benchmarks/load_test.py --target waitress=http://localhost:8080 --target asgi=http://localhost:8081 \
+        --concurrency 1000 --duration 30 --client-delay 200
+
+Every simulated client sends a request, waits for the answer, sleeps --client-delay ms (a slow
+mobile client reading the response) and repeats. Viewports are random around Stockholm.
+'''
+import argparse
+import asyncio
+import random
+import time
+import httpx
+
+ENDPOINTS = {
+    'stops': ('/api/stops', 0.08),
+    'quays': ('/api/quays', 0.04),
+    'live': ('/api/live', 0.08),
+}
+
+def random_body(rng: random.Random, size: float) -> dict:
+    lat, lon = rng.gauss(59.33, 0.05), rng.gauss(18.06, 0.1)
+    return {'lat_0': lat + size / 2, 'lon_0': lon - size, 'lat_1': lat - size / 2, 'lon_1': lon + size}
+
+async def client(http: httpx.AsyncClient, path: str, size: float, deadline: float, delay: float, latencies: list, errors: list, seed: int):
+    rng = random.Random(seed)
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await http.post(path, json=random_body(rng, size))
+            if response.status_code >= 500:
+                errors.append(response.status_code)
+            else:
+                latencies.append((time.perf_counter() - start) * 1000)
+        except httpx.HTTPError as e:
+            errors.append(type(e).__name__)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+
+async def run_target(name: str, url: str, args) -> None:
+    path, size = ENDPOINTS[args.endpoint]
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=args.timeout, headers={'Accept-Encoding': 'gzip'}) as http:
+        latencies, errors = [], []
+        deadline = time.monotonic() + args.duration
+        started = time.perf_counter()
+        await asyncio.gather(*(client(http, path, size, deadline, args.client_delay, latencies, errors, seed) for seed in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] if latencies else float('nan')
+    print(f'{name:>10}: {len(latencies) / elapsed:8.1f} req/s, p50 {percentile(0.5):7.1f} ms, '
+          f'p99 {percentile(0.99):7.1f} ms, {len(errors)} errors')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', action='append', required=True, help='name=base_url, may be repeated')
+    parser.add_argument('--endpoint', choices=ENDPOINTS.keys(), default='stops')
+    parser.add_argument('--concurrency', type=int, default=200, help='Simulated clients')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds per target')
+    parser.add_argument('--client-delay', type=float, default=0, help='Milliseconds a client waits between requests')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    for target in args.target:
+        name, _, url = target.partition('=')
+        asyncio.run(run_target(name, url, args))
+
+if __name__ == '__main__':
+    main()
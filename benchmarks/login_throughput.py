@@ -0,0 +1,93 @@
+'''Login throughput under mixed load, and what a login burst does to /api/live.
+
+Start the server, e.g.
+    waitress-serve --port=8080 --threads=8 --call bustrackr_server:create_app
+then
+    python benchmarks/login_throughput.py --url http://localhost:8080 --register \
+        --logins 50 --live 100 --duration 30
+
+--logins clients log in back to back (a token expiry wave), --live clients poll /api/live
+like the map does. Run it with HASH_WORKERS=0 on the server to compare with hashing on the
+request threads. 503s are logins turned away by the hasher admission control.
+'''
+import argparse
+import asyncio
+import random
+import time
+import httpx
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+async def login_client(http: httpx.AsyncClient, body: dict, deadline: float, results: dict) -> None:
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            response = await http.post('/api/login', json=body)
+        except httpx.HTTPError:
+            results['errors'] += 1
+            continue
+        if response.status_code == 200:
+            results['ok'] += 1
+            results['latencies'].append((time.perf_counter() - start) * 1000)
+        elif response.status_code == 503:
+            results['busy'] += 1
+            await asyncio.sleep(float(response.headers.get('Retry-After', '1')))
+        else:
+            results['errors'] += 1
+
+async def live_client(http: httpx.AsyncClient, deadline: float, results: dict, seed: int) -> None:
+    rng = random.Random(seed)
+    while time.monotonic() < deadline:
+        lat, lon = rng.gauss(59.33, 0.05), rng.gauss(18.06, 0.1)
+        start = time.perf_counter()
+        try:
+            response = await http.post('/api/live', json={'lat_0': lat + 0.02, 'lon_0': lon - 0.04, 'lat_1': lat - 0.02, 'lon_1': lon + 0.04})
+            if response.status_code < 500:
+                results['latencies'].append((time.perf_counter() - start) * 1000)
+            else:
+                results['errors'] += 1
+        except httpx.HTTPError:
+            results['errors'] += 1
+        await asyncio.sleep(0.2) # The map polls, it does not hammer
+
+async def run(args) -> None:
+    body = {'email': args.email, 'password': args.password, 'long_expire': False}
+    limits = httpx.Limits(max_connections=args.logins + args.live)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as http:
+        if args.register:
+            await http.post('/api/register', json={
+                'username': args.email.split('@')[0][:20], 'email': args.email, 'password': args.password,
+                'date_of_birth': '1990-01-01', 'terms_of_service': True, 'data_policy': True, 'long_expire': 0
+            })
+
+        logins = {'ok': 0, 'busy': 0, 'errors': 0, 'latencies': []}
+        live = {'errors': 0, 'latencies': []}
+        deadline = time.monotonic() + args.duration
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(login_client(http, body, deadline, logins) for _ in range(args.logins)),
+            *(live_client(http, deadline, live, seed) for seed in range(args.live)),
+        )
+        elapsed = time.perf_counter() - started
+
+    print(f'logins: {logins["ok"] / elapsed:.1f}/s, p50 {percentile(logins["latencies"], 0.5):.0f} ms, '
+          f'p99 {percentile(logins["latencies"], 0.99):.0f} ms, {logins["busy"]} turned away (503), {logins["errors"]} errors')
+    print(f'  live: {len(live["latencies"]) / elapsed:.1f} req/s, p50 {percentile(live["latencies"], 0.5):.0f} ms, '
+          f'p99 {percentile(live["latencies"], 0.99):.0f} ms, {live["errors"]} errors')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--email', default='loadtest@example.com')
+    parser.add_argument('--password', default='loadtest') # Lowercase, /login lowercases it
+    parser.add_argument('--register', action='store_true', help='Create the account first')
+    parser.add_argument('--logins', type=int, default=50, help='Clients logging in back to back')
+    parser.add_argument('--live', type=int, default=100, help='Clients polling /api/live')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds')
+    parser.add_argument('--timeout', type=float, default=30)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''Per-request cost of the request metrics (metrics.py) and tracing (tracing.py).
+
+    python benchmarks/metrics_overhead.py --requests 50000
+
+"hooks" runs only what the before_request/after_request pair adds to a request: starting the
+timing and recording the finished request. "tracing" is the same pair with TRACE_ENABLED on, with
+three spans (a query, a redis command and a formatting step) in a request which is not kept. "app"
+serves a trivial route through the Flask test client with and without the hooks, the difference
+is the overhead as a client sees it, Flask calling the hooks included (noisier, the test client
+itself costs far more).
+Nothing talks to redis or the database.
+'''
+import argparse
+import statistics
+import time
+from flask import Blueprint, Flask, Response
+from bustrackr_server import metrics, tracing
+from bustrackr_server.config import Config
+
+def start_request() -> None:
+    """The before_request hook of api_bp, without the session timer."""
+    timing = metrics.request_started()
+    timing.handler_started = time.perf_counter()
+
+def create_app(hooks: bool) -> Flask:
+    app = Flask(__name__)
+    bp = Blueprint('api', __name__)
+    if hooks:
+        bp.before_request(start_request)
+    bp.add_url_rule('/ping', 'ping', lambda: Response(b'{"status":"ok"}', mimetype='application/json'))
+    app.register_blueprint(bp, url_prefix='/api')
+    if hooks:
+        app.after_request(metrics.request_finished)
+    return app
+
+def measure_hooks(requests: int) -> list:
+    app = create_app(False)
+    response = Response(b'{}')
+    latencies = []
+    with app.test_request_context('/api/ping'):
+        for _ in range(requests):
+            start = time.perf_counter()
+            start_request()
+            metrics.request_finished(response)
+            latencies.append((time.perf_counter() - start) * 1_000_000)
+    return latencies
+
+def measure_tracing(requests: int) -> list:
+    app = create_app(False)
+    response = Response(b'{}')
+    latencies = []
+    settings = Config.TRACE_ENABLED, Config.TRACE_SLOW_MS
+    Config.TRACE_ENABLED, Config.TRACE_SLOW_MS = True, float('inf') # No trace is kept
+    try:
+        with app.test_request_context('/api/ping'):
+            for _ in range(requests):
+                start = time.perf_counter()
+                start_request()
+                tracing.db_span('stops', 'SELECT 1', 0.001)
+                tracing.redis_span('GET', 0.0002)
+                with tracing.span('format_stops'):
+                    pass
+                metrics.request_finished(response)
+                latencies.append((time.perf_counter() - start) * 1_000_000)
+    finally:
+        Config.TRACE_ENABLED, Config.TRACE_SLOW_MS = settings
+    return latencies
+
+def measure_app(requests: int, batch: int = 1000) -> tuple:
+    """Latencies without and with the hooks, in alternating batches so both see the same machine."""
+    clients = (create_app(False).test_client(), create_app(True).test_client())
+    latencies = ([], [])
+    for _ in range(0, requests, batch):
+        for client, measured in zip(clients, latencies):
+            for _ in range(batch):
+                start = time.perf_counter()
+                client.get('/api/ping')
+                measured.append((time.perf_counter() - start) * 1_000_000)
+    return latencies
+
+def report(name: str, latencies: list) -> None:
+    latencies.sort()
+    print(f'{name:>14}: mean {statistics.mean(latencies):7.2f} us, p50 {latencies[len(latencies) // 2]:7.2f} us, '
+          f'p99 {latencies[int(len(latencies) * 0.99)]:7.2f} us')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50_000)
+    args = parser.parse_args()
+
+    report('hooks', measure_hooks(args.requests))
+    report('tracing', measure_tracing(args.requests))
+    without, with_hooks = measure_app(args.requests)
+    report('app, no hooks', without)
+    report('app, hooks', with_hooks)
+    print(f'overhead: {statistics.median(with_hooks) - statistics.median(without):.2f} us per request (difference of the medians)')
+    start = time.perf_counter()
+    metrics.render()
+    print(f'rendering /metrics: {(time.perf_counter() - start) * 1000:.2f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''k nearest stops over a national stop set, k-d tree against comparing every stop.
+
+    python benchmarks/nearby.py --stops 50000 --queries 2000 --k 10
+
+The stops are synthetic: clustered around towns spread over Sweden, about as many as the
+national bus stop set. With --database the real bus stops are loaded instead (needs the
+database from .env). Queries are random points near the stops, as a user would be.
+'''
+import argparse
+import random
+import statistics
+import time
+from bustrackr_server.nearby_index import NearbyIndex, has_tree
+
+SWEDEN = (55.3, 11.1, 69.0, 24.1) # lat_min, lon_min, lat_max, lon_max
+
+def synthetic_stops(count: int, seed: int = 1) -> tuple:
+    rng = random.Random(seed)
+    towns = [(rng.uniform(SWEDEN[0], SWEDEN[2] - 4), rng.uniform(SWEDEN[1] + 1, SWEDEN[3] - 4)) for _ in range(300)]
+    weights = [rng.paretovariate(1.2) for _ in towns] # A few large cities, many small towns
+    latitudes, longitudes = [], []
+    for lat, lon in rng.choices(towns, weights, k=count):
+        latitudes.append(lat + rng.gauss(0, 0.05))
+        longitudes.append(lon + rng.gauss(0, 0.1))
+    return latitudes, longitudes
+
+def database_stops() -> tuple:
+    from bustrackr_server import create_app
+    from bustrackr_server.services.nearby_service import load_static_rows
+    with create_app(ingest=False).app_context():
+        rows = load_static_rows('stops')
+    return [float(row.lat) for row in rows], [float(row.lon) for row in rows]
+
+def measure(name: str, index: NearbyIndex, build_ms: float, queries: list, k: int, radius: float) -> list:
+    times = []
+    results = []
+    for lat, lon in queries:
+        start = time.perf_counter()
+        results.append(index.query(lat, lon, k, radius))
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    print(f'{name:12} build {build_ms:8.1f} ms   query median {statistics.median(times):.3f} ms   '
+          f'p99 {times[int(len(times) * 0.99)]:.3f} ms')
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stops', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--radius', type=float, default=5000, help='Meters')
+    parser.add_argument('--database', action='store_true', help='Use the bus stops in the database')
+    args = parser.parse_args()
+
+    latitudes, longitudes = database_stops() if args.database else synthetic_stops(args.stops)
+    rng = random.Random(2)
+    picks = rng.sample(range(len(latitudes)), min(args.queries, len(latitudes)))
+    queries = [(latitudes[i] + rng.gauss(0, 0.01), longitudes[i] + rng.gauss(0, 0.02)) for i in picks]
+    items = list(range(len(latitudes)))
+    print(f'{len(items)} stops, {len(queries)} queries, k={args.k}, radius {args.radius:g} m')
+
+    indexes = [('brute force', False)] + ([('k-d tree', True)] if has_tree() else [])
+    found = []
+    for name, use_tree in indexes:
+        start = time.perf_counter()
+        index = NearbyIndex(items, latitudes, longitudes, use_tree=use_tree)
+        build_ms = (time.perf_counter() - start) * 1000
+        found.append(measure(name, index, build_ms, queries, args.k, args.radius))
+    if not has_tree():
+        print('scipy is not installed, only the brute force fallback was measured')
+    elif [[item for item, _ in result] for result in found[0]] != [[item for item, _ in result] for result in found[1]]:
+        print('The two disagree (ties at equal distance can do this)')
+
+if __name__ == '__main__':
+    main()
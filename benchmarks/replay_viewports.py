@@ -0,0 +1,104 @@
+'''Replay recorded viewports against the tile cache and compare with querying every viewport directly.
+
+Record a trace by setting VIEWPORT_TRACE_FILE on a running server, then:
+    python benchmarks/replay_viewports.py trace.jsonl --type stops
+Without a trace a synthetic one is generated (users panning around a few city centres):
+    python benchmarks/replay_viewports.py --synthetic 20000
+
+The loader is synthetic (uniform points, LOAD_MS per query) so the numbers show the cache
+behaviour, not database performance.
+'''
+import argparse
+import bisect
+import random
+import statistics
+import time
+import orjson
+from bustrackr_server.services.stops_service import process_coordinates
+from bustrackr_server.tile_cache import TileCache, snap_to_tiles
+
+LOAD_MS = 2.0 # Simulated database round trip
+POINTS = 200_000 # Roughly the number of stops in Sweden
+BOUNDS = (55.3, 11.0, 69.1, 24.2) # lat_min, lon_min, lat_max, lon_max
+CENTRES = [(59.33, 18.06), (57.71, 11.97), (55.60, 13.00), (59.86, 17.64), (58.41, 15.62)]
+
+def make_points(count: int) -> list:
+    rng = random.Random(1)
+    points = []
+    for i in range(count):
+        # Half the points are clustered in cities, like the real stops
+        if i % 2:
+            lat, lon = rng.choice(CENTRES)
+            lat, lon = rng.gauss(lat, 0.15), rng.gauss(lon, 0.25)
+        else:
+            lat, lon = rng.uniform(BOUNDS[0], BOUNDS[2]), rng.uniform(BOUNDS[1], BOUNDS[3])
+        points.append({'id': str(i), 'location': {'lat': lat, 'lon': lon}})
+    points.sort(key=lambda point: point['location']['lat'])
+    return points
+
+def make_loader(points: list):
+    lats = [point['location']['lat'] for point in points]
+
+    def loader(lat_0, lon_0, lat_1, lon_1):
+        time.sleep(LOAD_MS / 1000)
+        start, end = bisect.bisect_left(lats, lat_1), bisect.bisect_right(lats, lat_0)
+        return [point for point in points[start:end] if lon_0 <= point['location']['lon'] <= lon_1]
+    return loader
+
+def synthetic_trace(count: int) -> list:
+    rng = random.Random(2)
+    trace = []
+    users = [list(rng.choice(CENTRES)) for _ in range(200)]
+    for _ in range(count):
+        user = rng.choice(users)
+        user[0] += rng.gauss(0, 0.01) # Small pans
+        user[1] += rng.gauss(0, 0.02)
+        height = rng.uniform(0.03, 0.15)
+        trace.append({'lat_0': user[0] + height / 2, 'lon_0': user[1] - height, 'lat_1': user[0] - height / 2, 'lon_1': user[1] + height})
+    return trace
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def report(name: str, latencies: list) -> None:
+    print(f'{name:>8}: {len(latencies)} requests, mean {statistics.mean(latencies):.3f} ms, '
+          f'p50 {percentile(latencies, 0.5):.3f} ms, p99 {percentile(latencies, 0.99):.3f} ms')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace', nargs='?', help='JSON lines trace recorded with VIEWPORT_TRACE_FILE')
+    parser.add_argument('--type', default=None, help='Only replay viewports of this type')
+    parser.add_argument('--synthetic', type=int, default=10_000, help='Synthetic trace length if no trace is given')
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace, 'rb') as trace_file:
+            trace = [orjson.loads(line) for line in trace_file if line.strip()]
+        trace = [entry for entry in trace if args.type is None or entry.get('type') == args.type]
+    else:
+        trace = synthetic_trace(args.synthetic)
+
+    loader = make_loader(make_points(POINTS))
+    cache = TileCache('replay', loader, ttl=3600, use_redis=False)
+
+    direct, tiled = [], []
+    for entry in trace:
+        # Recorded viewports are already padded, synthetic ones are raw client values
+        bbox = (entry['lat_0'], entry['lon_0'], entry['lat_1'], entry['lon_1']) if args.trace else process_coordinates(entry)
+
+        start = time.perf_counter()
+        loader(*bbox)
+        direct.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        cache.get(snap_to_tiles(*bbox))
+        tiled.append((time.perf_counter() - start) * 1000)
+
+    report('direct', direct)
+    report('tiled', tiled)
+    stats = cache.get_stats()
+    print(f'tile hit ratio {stats["hit_ratio"]:.3f}, {stats["loads"]} loads for {len(trace)} viewports, {stats["cached_tiles"]} tiles cached')
+
+if __name__ == '__main__':
+    main()
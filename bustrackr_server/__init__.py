@@ -1,50 +1,103 @@
+import time
+started_at = time.perf_counter() # Cold start is measured from the first import
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from bustrackr_server.config import Config
-from redis_om import redis, Migrator
-
-app = Flask(__name__)
-app.config.from_object(Config)
-db = SQLAlchemy(app)
-
-if (Config.ENV == "development"):
-    from flask_cors import CORS
-    CORS(app)
-    CORS(app, resources={r"/*": {"origins": "http://localhost:8080"}})
+from bustrackr_server.db_metrics import TimedQueuePool
+from threading import RLock
+import cProfile
+import pstats
 
-redis_client = redis.Redis(
-    host=Config.REDIS_HOST,
-    port=Config.REDIS_PORT,
-    password=Config.REDIS_PASS,
-    db=Config.REDIS_DB,
-    decode_responses=True,
-    retry_on_error=[redis.exceptions.ConnectionError],
-    retry_on_timeout=True
-)
+# Nothing in this module talks to the database or redis at import time,
+# all of that happens in the startup phases run by create_app()
 
-redis_client.flushall()
-redis_client.flushdb()
+from bustrackr_server.redis_resilience import create_redis_client
+redis_client = create_redis_client() # Pooled, retried and behind a circuit breaker
 
-from bustrackr_server.models_redis import VehicleLive
-
-Migrator().run()
+from bustrackr_server.db_routing import RoutingSession # Needs redis_client
+db = SQLAlchemy(engine_options={'poolclass': TimedQueuePool}, session_options={'class_': RoutingSession})
 
 from bustrackr_server import models # Need to import
 # from bustrackr_server.data_parser import process_static_data # This file is not included in the repo yet
 
-def fix_redis():
-    redis_client.flushall()
-    redis_client.flushdb()
-    Migrator().run()
+phase_lock = RLock() # Phases may run other phases
+completed_phases = set()
+startup_timings = {} # Phase name -> milliseconds
+
+def run_phase(name: str, phase, *args, once: bool = False) -> None:
+    """Run a startup phase and record how long it took, once=True phases only ever run once per process."""
+    with phase_lock:
+        if once and name in completed_phases:
+            return
+        start = time.perf_counter()
+        phase(*args)
+        startup_timings[name] = (time.perf_counter() - start) * 1000
+        completed_phases.add(name)
 
 def fix_database():
-    with app.app_context():
-        db.create_all() # Create all the tables
-        db.session.commit()
-        # process_static_data()
+    '''Create the tables, must be called inside an app context'''
+    db.create_all() # Create all the tables
+    db.session.commit()
+    # process_static_data()
+    response_cache.clear() # Cached responses are only valid for the old static data
+    clear_tile_caches()
+    bump_static_version()
 
-from bustrackr_server.routes import register_routes
-register_routes(app)
+def init_extensions(app: Flask) -> None:
+    app.config.from_object(Config)
+    db.init_app(app) # Engines connect lazily on the first query
+
+    if (Config.ENV == "development"):
+        from flask_cors import CORS
+        CORS(app)
+        CORS(app, resources={r"/*": {"origins": "http://localhost:8080"}})
+
+def start_ingest(app: Flask) -> None:
+    from bustrackr_server.data_fetcher import do_fetch
+    do_fetch(app)
+
+def create_app(ingest: bool | None = None) -> Flask:
+    """Create the application.
+    ingest decides if this process fetches the live data, defaults to INGEST_ROLE == 'embedded'
+    (off unless the deployment opts one process in). Only one process should ever do that."""
+    if ingest is None:
+        ingest = Config.INGEST_ROLE == 'embedded'
 
-from bustrackr_server.data_fetcher import do_fetch
-do_fetch()
\ No newline at end of file
+    profiler = cProfile.Profile() if Config.STARTUP_PROFILE else None
+    if profiler:
+        profiler.enable()
+
+    startup_timings.setdefault('imports', (time.perf_counter() - started_at) * 1000)
+
+    install_profiling() # Only if PROFILE_ENABLED
+
+    app = Flask(__name__)
+    run_phase('extensions', init_extensions, app)
+    run_phase('routes', register_routes, app)
+    run_phase('compression', register_compression, app)
+    if ingest:
+        run_phase('ingest', start_ingest, app, once=True)
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(Config.STARTUP_PROFILE)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+    if 'total' not in startup_timings: # Only the first app is a cold start
+        total = startup_timings['total'] = (time.perf_counter() - started_at) * 1000
+        if total > Config.STARTUP_BUDGET_MS:
+            app.logger.warning(f'Cold start took {total:.0f} ms, over the {Config.STARTUP_BUDGET_MS:.0f} ms budget: {get_startup_stats()}')
+        else:
+            app.logger.info(f'Cold start took {total:.0f} ms')
+
+    return app
+
+def get_startup_stats() -> dict:
+    return {name: round(ms, 3) for name, ms in startup_timings.items()}
+
+from bustrackr_server.routes import register_routes
+from bustrackr_server.compression import register_compression, response_cache
+from bustrackr_server.static_version import bump_static_version
+from bustrackr_server.tile_cache import clear_tile_caches
+from bustrackr_server.profiling import install as install_profiling
@@ -0,0 +1,27 @@
+from bustrackr_server import redis_client
+import time
+
+# Live data is only fetched while someone is looking at it. The ingester may run in
+# another process (or on another node), so API workers signal activity through redis.
+
+ACTIVE_KEY = 'live:active'
+ACTIVE_TTL = 15 # Seconds someone counts as watching after their last request
+MARK_INTERVAL = 1 # Seconds between writes from one worker
+
+last_marked = 0.0
+
+def mark_active() -> None:
+    """Tell the ingester someone is using the app, at most once per MARK_INTERVAL."""
+    global last_marked
+    now = time.monotonic()
+    if now - last_marked < MARK_INTERVAL:
+        return
+    last_marked = now
+    try:
+        redis_client.set(ACTIVE_KEY, 1, ex=ACTIVE_TTL)
+    except Exception:
+        pass # Live data is not served without redis anyway
+
+def is_active() -> bool:
+    """Check if any API worker has seen a user in the last ACTIVE_TTL seconds."""
+    return bool(redis_client.exists(ACTIVE_KEY))
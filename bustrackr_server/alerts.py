@@ -0,0 +1,252 @@
+from datetime import datetime, timezone
+from queue import Queue, Full
+from threading import Lock, Thread
+from typing import Dict, List, NamedTuple, Sequence
+from sqlalchemy import select
+import time
+import numpy
+import orjson
+import redis
+import requests
+from bustrackr_server import db, redis_client
+from bustrackr_server.config import Config
+from bustrackr_server.db_routing import primary
+from bustrackr_server.models import AlertSubscription, Stop
+
+# Alerts for buses approaching a stop, evaluated by the ingester once per cycle.
+# The subscriptions are held in memory, indexed by journey and by line, and reloaded when the
+# API bumps VERSION_KEY. Only vehicles with a new fix are looked up, so a cycle costs the
+# (vehicle, subscription) pairs of the buses that moved and not the number of subscriptions.
+# A pair alerts when the bus is heading towards the stop and within the subscription's meters,
+# or its minutes at the bus's smoothed speed. Distances are straight lines, which is what a
+# "the bus is near" push needs. A bus alerts a subscription once per ALERT_REPEAT_AFTER.
+# Alerts are pushed onto QUEUE_KEY for the push workers and, if ALERT_WEBHOOK_URL is set,
+# POSTed there in the background.
+
+VERSION_KEY = 'alerts:version' # Bumped on every subscription change
+QUEUE_KEY = 'alerts:queue' # Newest first, trimmed to ALERT_QUEUE_LENGTH
+STATS_KEY = 'alerts:stats' # The ingester's stats, so every API worker can report them
+EARTH_RADIUS = 6371000 # Meters
+CLOSE_ENOUGH = 50 # Meters, this close a bus is at the stop whatever its heading
+MIN_SPEED = 0.5 # Meters per second, slower and there is no sensible arrival time
+
+class Subscription(NamedTuple):
+    id: int
+    user_id: int
+    journey_id: int | None
+    line_id: int | None
+    stop_id: int
+    latitude: float # Of the stop
+    longitude: float
+    meters: int | None
+    minutes: int | None
+
+def bump_version() -> None:
+    """Tell the ingester the subscriptions changed, called by the API."""
+    try:
+        redis_client.incr(VERSION_KEY)
+    except redis.exceptions.RedisError:
+        pass # Picked up with the next change or restart
+
+class AlertEngine:
+    '''Subscriptions indexed for evaluation against a cycle of vehicles'''
+
+    def __init__(self):
+        self.load([])
+        self.last_fix: Dict[int, float] = {} # vehicle id -> time of its last evaluated fix
+        self.fired: Dict[tuple, float] = {} # (subscription id, journey id) -> when it alerted
+
+    def load(self, subscriptions: Sequence[Subscription]) -> None:
+        self.subscriptions = list(subscriptions)
+        self.latitudes = numpy.array([subscription.latitude for subscription in subscriptions], float)
+        self.longitudes = numpy.array([subscription.longitude for subscription in subscriptions], float)
+        # -1 never matches, for subscriptions with only the other threshold
+        self.meters = numpy.array([subscription.meters if subscription.meters else -1 for subscription in subscriptions], float)
+        self.seconds = numpy.array([subscription.minutes * 60 if subscription.minutes else -1 for subscription in subscriptions], float)
+        by_journey: Dict[int, List[int]] = {}
+        by_line: Dict[int, List[int]] = {}
+        for index, subscription in enumerate(subscriptions):
+            if subscription.journey_id is not None:
+                by_journey.setdefault(subscription.journey_id, []).append(index)
+            else:
+                by_line.setdefault(subscription.line_id, []).append(index)
+        self.by_journey = {key: numpy.array(value) for key, value in by_journey.items()}
+        self.by_line = {key: numpy.array(value) for key, value in by_line.items()}
+
+    def moved(self, vehicles: List) -> List:
+        """The vehicles with a fix which was not evaluated yet, forgets the vehicles which are gone."""
+        moved = []
+        seen = {}
+        for vehicle in vehicles:
+            fix_time = vehicle.timestamp.timestamp()
+            seen[vehicle.vehicle_id] = fix_time
+            if self.last_fix.get(vehicle.vehicle_id) != fix_time:
+                moved.append(vehicle)
+        self.last_fix = seen
+        return moved
+
+    def evaluate(self, vehicles: List, now: float) -> tuple:
+        """The alerts for a cycle of LiveVehicles, and the number of pairs evaluated."""
+        moved = self.moved(vehicles)
+        pair_vehicles = []
+        pair_subscriptions = []
+        for index, vehicle in enumerate(moved):
+            for subscriptions in (self.by_journey.get(vehicle.service_journey_id), self.by_line.get(vehicle.line_id)):
+                if subscriptions is not None:
+                    pair_vehicles.append(numpy.full(len(subscriptions), index))
+                    pair_subscriptions.append(subscriptions)
+        if not pair_vehicles:
+            return [], 0
+        pair_vehicles = numpy.concatenate(pair_vehicles)
+        pair_subscriptions = numpy.concatenate(pair_subscriptions)
+
+        count = len(moved)
+        latitudes = numpy.fromiter((vehicle.latitude for vehicle in moved), float, count)[pair_vehicles]
+        longitudes = numpy.fromiter((vehicle.longitude for vehicle in moved), float, count)[pair_vehicles]
+        speeds = numpy.fromiter((vehicle.speed for vehicle in moved), float, count)[pair_vehicles]
+        headings = numpy.radians(numpy.fromiter((vehicle.heading for vehicle in moved), float, count))[pair_vehicles]
+
+        stop_latitudes = self.latitudes[pair_subscriptions]
+        stop_longitudes = self.longitudes[pair_subscriptions]
+        east = numpy.radians(stop_longitudes - longitudes) * numpy.cos(numpy.radians((latitudes + stop_latitudes) / 2)) * EARTH_RADIUS
+        north = numpy.radians(stop_latitudes - latitudes) * EARTH_RADIUS
+        distances = numpy.hypot(east, north)
+        approaching = (distances <= CLOSE_ENOUGH) | (east * numpy.sin(headings) + north * numpy.cos(headings) > 0)
+        seconds = numpy.where(speeds >= MIN_SPEED, distances / numpy.maximum(speeds, MIN_SPEED), numpy.inf)
+        hits = numpy.flatnonzero(approaching & ((distances <= self.meters[pair_subscriptions]) | (seconds <= self.seconds[pair_subscriptions])))
+
+        alerts = []
+        for pair in hits.tolist():
+            vehicle = moved[pair_vehicles[pair]]
+            subscription = self.subscriptions[pair_subscriptions[pair]]
+            key = (subscription.id, vehicle.service_journey_id)
+            if now - self.fired.get(key, -Config.ALERT_REPEAT_AFTER) < Config.ALERT_REPEAT_AFTER:
+                continue
+            self.fired[key] = now
+            alerts.append({
+                'subscription_id': str(subscription.id),
+                'user_id': subscription.user_id,
+                'stop_id': str(subscription.stop_id),
+                'service_journey_id': str(vehicle.service_journey_id),
+                'vehicle_id': str(vehicle.vehicle_id),
+                'line_id': str(vehicle.line_id) if vehicle.line_id else None,
+                'line': vehicle.line or None,
+                'distance': round(float(distances[pair])),
+                'minutes': round(float(seconds[pair]) / 60, 1) if numpy.isfinite(seconds[pair]) else None,
+                'time': datetime.fromtimestamp(now, timezone.utc).isoformat(),
+            })
+        if len(self.fired) > 2 * len(self.subscriptions) + 1000: # Forget old alerts now and then
+            self.fired = {key: fired_at for key, fired_at in self.fired.items() if now - fired_at < Config.ALERT_REPEAT_AFTER}
+        return alerts, len(pair_subscriptions)
+
+SUBSCRIPTIONS_QUERY = select(
+    AlertSubscription.id,
+    AlertSubscription.userID,
+    AlertSubscription.journey_id,
+    AlertSubscription.line_id,
+    AlertSubscription.stop_id,
+    Stop.latitude,
+    Stop.longitude,
+    AlertSubscription.meters,
+    AlertSubscription.minutes
+).join_from(
+    AlertSubscription, Stop,
+    AlertSubscription.stop_id == Stop.id
+).execution_options(query_name='alert_subscriptions', yield_per=10000)
+
+engine = AlertEngine() # Only the ingest thread touches this
+loaded_version = None
+stats_lock = Lock()
+stats = {
+    'subscriptions': 0,
+    'cycles': 0,
+    'pairs': 0, # (vehicle, subscription) pairs evaluated
+    'alerts': 0,
+    'last_cycle_ms': 0.0,
+    'webhook_errors': 0,
+    'errors': 0,
+}
+
+@primary # Right after VERSION_KEY was bumped a replica may not have the change yet, and it would not be loaded until the next one
+def load_subscriptions() -> List[Subscription]:
+    return [
+        Subscription(id, user_id, journey_id, line_id, stop_id, float(latitude), float(longitude), meters, minutes)
+        for id, user_id, journey_id, line_id, stop_id, latitude, longitude, meters, minutes in db.session.execute(SUBSCRIPTIONS_QUERY)
+    ]
+
+def refresh() -> None:
+    """Reload the subscriptions if they changed since they were loaded, needs an app context."""
+    global loaded_version
+    try:
+        version = redis_client.get(VERSION_KEY) or '0'
+    except redis.exceptions.RedisError:
+        return # Keep the loaded ones
+    if version == loaded_version:
+        return
+    subscriptions = load_subscriptions()
+    engine.load(subscriptions)
+    loaded_version = version
+    with stats_lock:
+        stats['subscriptions'] = len(subscriptions)
+
+def process_cycle(vehicles: List) -> None:
+    """Evaluate the subscriptions against a cycle of LiveVehicles and publish the alerts, called by the ingester."""
+    start = time.perf_counter()
+    alerts, pairs = engine.evaluate(vehicles, time.time())
+    with stats_lock:
+        stats['cycles'] += 1
+        stats['pairs'] += pairs
+        stats['alerts'] += len(alerts)
+        stats['last_cycle_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        shared = dict(stats)
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            if alerts:
+                pipe.lpush(QUEUE_KEY, *(orjson.dumps(alert) for alert in alerts))
+                pipe.ltrim(QUEUE_KEY, 0, Config.ALERT_QUEUE_LENGTH - 1)
+            pipe.set(STATS_KEY, orjson.dumps(shared), ex=60)
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        count(errors=1) # These alerts are lost, the bus would have to come around again
+    if alerts and Config.ALERT_WEBHOOK_URL:
+        send_to_webhook(alerts)
+
+webhook_queue: Queue = Queue(maxsize=100) # Cycles of alerts waiting to be POSTed
+webhook_thread: Thread | None = None
+
+def send_to_webhook(alerts: List[dict]) -> None:
+    """POST the alerts in the background, so a slow webhook never delays the ingester."""
+    global webhook_thread
+    if webhook_thread is None:
+        webhook_thread = Thread(target=webhook_worker, daemon=True)
+        webhook_thread.start()
+    try:
+        webhook_queue.put_nowait(alerts)
+    except Full:
+        count(webhook_errors=1)
+
+def webhook_worker() -> None:
+    while True:
+        alerts = webhook_queue.get()
+        try:
+            response = requests.post(Config.ALERT_WEBHOOK_URL, data=orjson.dumps({'alerts': alerts}),
+                                     headers={'Content-Type': 'application/json'}, timeout=5)
+            response.raise_for_status()
+        except requests.RequestException:
+            count(webhook_errors=1)
+
+def count(**kwargs) -> None:
+    with stats_lock:
+        for key, value in kwargs.items():
+            stats[key] += value
+
+def get_stats() -> dict:
+    """The stats of the ingester, wherever it runs."""
+    try:
+        shared = redis_client.get(STATS_KEY)
+    except redis.exceptions.RedisError:
+        shared = None
+    if shared is not None:
+        return orjson.loads(shared)
+    with stats_lock:
+        return dict(stats)
@@ -0,0 +1,329 @@
+'''Async (ASGI) serving mode for the I/O bound read endpoints.
+
+    uvicorn bustrackr_server.asgi:app --port 8081
+
+Serves the same /api/stops, /api/quays, /api/stop_groups, /api/journey_details, /api/live and
+/api/nearby as the waitress app, reusing the query builders and formatters from the services, but with
+async psycopg and redis clients. One worker can then keep thousands of slow clients in flight
+instead of blocking a thread on every round trip. Accounts and everything else stay on waitress.
+The requests are timed and traced like on waitress, and exported by this worker's own /metrics.
+'''
+from contextlib import asynccontextmanager
+from typing import Callable
+from redis import asyncio as redis_asyncio
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+from werkzeug.http import parse_accept_header
+import orjson
+import random
+import time
+from bustrackr_server import Config, live_store, route_geometry, metrics, tracing
+from bustrackr_server.redis_resilience import UNAVAILABLE_ERRORS, redis_breaker
+from bustrackr_server.static_version import get_static_version, is_version_fresh
+from bustrackr_server.activity import ACTIVE_KEY, ACTIVE_TTL, MARK_INTERVAL
+from bustrackr_server.compression import ENCODINGS, compress
+from bustrackr_server.utils import bbox_params
+from bustrackr_server.services import stops_service, quays_service, stop_groups_service, journey_details_service, live_service, nearby_service, cluster_service
+from bustrackr_server.clustering import view_zoom
+from bustrackr_server.routes.stops import validate_request as validate_bbox_request
+from bustrackr_server.routes.stop_groups import validate_request as validate_groups_request
+from bustrackr_server.routes.journey_details import validate_request as validate_journey_details_request
+from bustrackr_server.routes.nearby import validate_request as validate_nearby_request
+from bustrackr_server.routes.stats import collect_stats
+
+engines: list[AsyncEngine] = [] # The replicas if there are any, these endpoints only read static data
+redis_client: redis_asyncio.Redis = None
+binary_client: redis_asyncio.Redis = None # For the live snapshots
+last_marked = 0.0
+
+class TimedRedis(redis_asyncio.Redis):
+    '''Records every command and sends it through the circuit breaker, like redis_resilience.ResilientRedis does'''
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await redis_breaker.call_async(super().execute_command, *args, **options)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe_redis(args[0], elapsed)
+            tracing.redis_span(args[0], elapsed)
+
+def create_redis_client(decode_responses: bool) -> redis_asyncio.Redis:
+    return TimedRedis(
+        host=Config.REDIS_HOST,
+        port=Config.REDIS_PORT,
+        password=Config.REDIS_PASS,
+        db=Config.REDIS_DB,
+        decode_responses=decode_responses,
+        max_connections=Config.REDIS_MAX_CONNECTIONS,
+        socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=Config.REDIS_SOCKET_TIMEOUT,
+        health_check_interval=Config.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    global redis_client, binary_client
+    for uri in Config.SQLALCHEMY_REPLICA_URIS or [Config.SQLALCHEMY_DATABASE_URI]:
+        engines.append(create_async_engine(uri, **Config.SQLALCHEMY_ENGINE_OPTIONS))
+    redis_client = create_redis_client(True)
+    binary_client = create_redis_client(False)
+    yield
+    for engine in engines:
+        await engine.dispose()
+    engines.clear()
+    await redis_client.aclose()
+    await binary_client.aclose()
+
+def json_response(request: Request, obj: dict, status: int = 200) -> Response:
+    body = metrics.dumps(obj)
+    headers = {'Vary': 'Accept-Encoding'}
+    if status == 200 and len(body) >= Config.COMPRESSION_MIN_SIZE:
+        encoding = parse_accept_header(request.headers.get('accept-encoding')).best_match(ENCODINGS)
+        if encoding:
+            body = compress(body, encoding)
+            headers['Content-Encoding'] = encoding
+    return Response(body, status_code=status, headers=headers, media_type='application/json')
+
+def error_response(request: Request, message: str, status: int) -> Response:
+    return json_response(request, {'status': 'error', 'message': message}, status)
+
+async def read_request(request: Request, validate: Callable[[dict], None]) -> dict:
+    """The request parameters, from the query string for GET and the JSON body for POST."""
+    if request.method == 'GET':
+        req = dict(request.query_params)
+        if 'list' in req:
+            req['list'] = [int(group_id) for group_id in req['list'].split(',') if group_id.strip()]
+    else:
+        try:
+            req = orjson.loads(await request.body())
+        except orjson.JSONDecodeError:
+            req = None
+    validate(req)
+    return req
+
+async def mark_active() -> None:
+    """Same as activity.mark_active, tells the ingester someone is watching."""
+    global last_marked
+    now = time.monotonic()
+    if now - last_marked >= MARK_INTERVAL:
+        last_marked = now
+        try:
+            await redis_client.set(ACTIVE_KEY, 1, ex=ACTIVE_TTL)
+        except UNAVAILABLE_ERRORS:
+            pass # The last snapshot is served anyway
+
+async def read_current_cycle() -> live_store.Cycle:
+    """Same as live_store.read_current_cycle, the decoded cycle is shared with it."""
+    try:
+        cycle_id = await redis_client.get(live_store.CURRENT_KEY)
+        if cycle_id is None:
+            return live_store.EMPTY_CYCLE
+        cycle = live_store.cached(cycle_id)
+        if cycle is not None:
+            return cycle
+        blob = await binary_client.get(f'{live_store.CYCLE_KEY_PREFIX}{cycle_id}')
+    except UNAVAILABLE_ERRORS:
+        return live_store.stale_cycle()
+
+    if blob is None:
+        return live_store.EMPTY_CYCLE
+    cycle = live_store.Cycle(cycle_id, await run_in_threadpool(live_store.unpack_cycle, blob))
+    live_store.remember_cycle(cycle)
+    return cycle
+
+def read_engine() -> AsyncEngine:
+    return random.choice(engines)
+
+async def fetch_all(query, params: dict) -> list:
+    async with read_engine().connect() as conn:
+        result = await conn.execute(query, params)
+        return result.fetchall()
+
+# Building an index, clusters or route shapes takes milliseconds of CPU (seconds for the national
+# stop set), and the static version may need a blocking redis GET. On the event loop either would
+# stall every connection of the worker, so they run in the thread pool.
+
+async def check_static_version() -> None:
+    """Refresh the static version in a thread if it is due, so the caches checking it do not block."""
+    if not is_version_fresh():
+        await run_in_threadpool(get_static_version)
+
+async def static_clusters(kind: str):
+    """Same as cluster_service.static_clusters_of, loading the set on the async engine."""
+    await check_static_version()
+    clusters = cluster_service.cached_static_clusters(kind)
+    if clusters is None:
+        rows = await fetch_all(nearby_service.STATIC_QUERIES[kind], {})
+        clusters = await run_in_threadpool(cluster_service.store_static_clusters, kind, rows)
+    return clusters
+
+def bbox_endpoint(kind: str, service, query, format_response: Callable) -> Callable:
+    async def endpoint(request: Request) -> Response:
+        try:
+            req = await read_request(request, validate_bbox_request)
+            lat_0, lon_0, lat_1, lon_1 = service.process_coordinates(req)
+            zoom = view_zoom(req, lon_0, lon_1)
+        except ValueError as e:
+            return error_response(request, str(e), 400)
+        except TypeError as e:
+            return error_response(request, str(e), 415)
+
+        await mark_active()
+        if cluster_service.clustered(kind, req, zoom, service.is_area_too_large(lat_0, lon_0, lat_1, lon_1)):
+            clusters = cluster_service.find_clusters(await static_clusters(kind), lat_0, lon_0, lat_1, lon_1, zoom)
+            return json_response(request, cluster_service.format_clusters_response(kind, zoom, clusters))
+        rows = await fetch_all(query, bbox_params(lat_0, lon_0, lat_1, lon_1))
+        return json_response(request, format_response(rows))
+    return endpoint
+
+async def stop_groups(request: Request) -> Response:
+    try:
+        req = await read_request(request, validate_groups_request)
+        cluster = False
+        if req['type'] == 'list':
+            query, params = stop_groups_service.FIND_GROUPS_LIST_QUERY, {'ids': req['list']}
+        else:
+            lat_0, lon_0, lat_1, lon_1 = stop_groups_service.process_coordinates(req)
+            zoom = view_zoom(req, lon_0, lon_1)
+            cluster = cluster_service.clustered('stop_groups', req, zoom, stop_groups_service.is_area_too_large(lat_0, lon_0, lat_1, lon_1))
+            query, params = stop_groups_service.FIND_GROUPS_COORDS_QUERY, bbox_params(lat_0, lon_0, lat_1, lon_1)
+    except ValueError as e:
+        return error_response(request, str(e), 400)
+    except TypeError as e:
+        return error_response(request, str(e), 415)
+
+    await mark_active()
+    if cluster:
+        clusters = cluster_service.find_clusters(await static_clusters('stop_groups'), lat_0, lon_0, lat_1, lon_1, zoom)
+        return json_response(request, cluster_service.format_clusters_response('stop_groups', zoom, clusters))
+    return json_response(request, stop_groups_service.format_groups_response(await fetch_all(query, params)))
+
+async def journey_details(request: Request) -> Response:
+    try:
+        req = await read_request(request, validate_journey_details_request)
+        params = journey_details_service.journey_params(req)
+    except ValueError as e:
+        return error_response(request, str(e), 400)
+    except TypeError as e:
+        return error_response(request, str(e), 415)
+
+    await mark_active()
+    # Same as the sync path, but on one connection
+    async with read_engine().connect() as conn:
+        journey_availible = (await conn.execute(journey_details_service.FIND_JOURNEY_QUERY, params)).one_or_none() is not None
+        vehicle_availible = (await conn.execute(journey_details_service.FIND_VEHICLE_QUERY, params)).one_or_none() is not None
+        journey_data = (await conn.execute(journey_details_service.JOURNEY_INFO_QUERY, params)).fetchall() if journey_availible else None
+        vehicle_data = (await conn.execute(journey_details_service.VEHICLE_INFO_QUERY, params)).first() if vehicle_availible else None
+
+    return json_response(request, journey_details_service.format_journey_details_response(journey_data, vehicle_data))
+
+async def live(request: Request) -> Response:
+    try:
+        req = await read_request(request, validate_bbox_request)
+        lat_0, lon_0, lat_1, lon_1 = live_service.process_coordinates(req)
+        zoom = view_zoom(req, lon_0, lon_1)
+        as_of_now = live_service.wants_as_of_now(req)
+    except ValueError as e:
+        return error_response(request, str(e), 400)
+    except TypeError as e:
+        return error_response(request, str(e), 415)
+
+    await mark_active()
+    cycle = await read_current_cycle()
+    if cluster_service.clustered('live', req, zoom, live_service.is_area_too_large(lat_0, lon_0, lat_1, lon_1)):
+        clusters = cluster_service.find_clusters(await run_in_threadpool(cluster_service.live_clusters, cycle), lat_0, lon_0, lat_1, lon_1, zoom)
+        return json_response(request, cluster_service.format_clusters_response('live', zoom, clusters, cycle))
+    token = live_service.view_token(cycle, lat_0, lon_0, lat_1, lon_1)
+    if not as_of_now and live_service.is_unchanged(req, token):
+        return json_response(request, live_service.format_unchanged_response(cycle, token))
+    buses = live_service.find_live_buses(cycle, lat_0, lon_0, lat_1, lon_1)
+    if not as_of_now:
+        return json_response(request, live_service.format_live_buses_response(cycle, buses, token))
+
+    geometries, missing = await run_in_threadpool(route_geometry.cached, {bus.route_id for bus in buses if bus.route_id})
+    if missing:
+        rows = await fetch_all(route_geometry.ROUTE_GEOMETRY_QUERY, {'route_ids': missing})
+        loaded = await run_in_threadpool(route_geometry.build_geometries, rows)
+        route_geometry.store(missing, loaded)
+        geometries.update(loaded)
+    now = time.time()
+    positions = live_service.extrapolate_buses(buses, now, geometries)
+    return json_response(request, live_service.format_live_buses_response(cycle, buses, positions=positions, as_of=now))
+
+async def nearby(request: Request) -> Response:
+    try:
+        req = await read_request(request, validate_nearby_request)
+        kind, lat, lon, k, radius = nearby_service.nearby_params(req)
+    except ValueError as e:
+        return error_response(request, str(e), 400)
+    except TypeError as e:
+        return error_response(request, str(e), 415)
+
+    await mark_active()
+    if kind == 'live':
+        cycle = await read_current_cycle()
+        index = await run_in_threadpool(nearby_service.live_index, cycle)
+    else:
+        cycle = None
+        await check_static_version()
+        index = nearby_service.cached_static_index(kind)
+        if index is None: # Concurrent first requests may each load it, only until one is stored
+            rows = await fetch_all(nearby_service.STATIC_QUERIES[kind], {})
+            index = await run_in_threadpool(nearby_service.store_static_index, kind, rows)
+    nearby_items = nearby_service.find_nearby(index, lat, lon, k, radius)
+    return json_response(request, nearby_service.format_nearby_response(kind, nearby_items, cycle))
+
+async def get_metrics(request: Request) -> Response:
+    body = metrics.render(await run_in_threadpool(collect_stats)) # Some stats come from redis
+    return Response(body, media_type='text/plain; version=0.0.4; charset=utf-8')
+
+class MetricsMiddleware:
+    '''The ASGI version of the Flask hooks in metrics.py, timing and tracing every API request'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith('/api/'):
+            return await self.app(scope, receive, send)
+        route = scope['path'] if scope['path'] in api_paths else 'unmatched'
+        timing = metrics.Timing(route, scope['method'])
+        trace = None
+        if Config.TRACE_ENABLED:
+            target = scope['path'] + ('?' + scope['query_string'].decode('latin-1') if scope['query_string'] else '')
+            trace = tracing.Trace(f'{scope["method"]} {route}', {'http.method': scope['method'], 'http.route': route, 'http.target': target})
+
+        async def send_timed(message):
+            if message['type'] == 'http.response.start':
+                timing.handler_done(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            if trace is not None:
+                trace.finish(timing.status)
+            timing.finish()
+
+methods = ['GET', 'POST']
+app = Starlette(
+    routes=[
+        Route('/api/stops', bbox_endpoint('stops', stops_service, stops_service.FIND_STOPS_QUERY, stops_service.format_stops_response), methods=methods),
+        Route('/api/quays', bbox_endpoint('quays', quays_service, quays_service.FIND_QUAYS_QUERY, quays_service.format_quays_response), methods=methods),
+        Route('/api/stop_groups', stop_groups, methods=methods),
+        Route('/api/journey_details', journey_details, methods=methods),
+        Route('/api/live', live, methods=methods),
+        Route('/api/nearby', nearby, methods=methods),
+        Route('/metrics', get_metrics, methods=['GET']),
+    ],
+    middleware=[Middleware(MetricsMiddleware)],
+    lifespan=lifespan,
+)
+
+api_paths = {route.path for route in app.routes if route.path.startswith('/api/')}
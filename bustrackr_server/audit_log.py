@@ -0,0 +1,214 @@
+from collections import defaultdict
+from threading import Event, Lock, Thread
+from flask import Flask, current_app
+from sqlalchemy import insert
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+import atexit
+import datetime
+import queue
+import time
+from bustrackr_server import Config, db, user_summary
+
+# Login/agreement/report logs are written in batches by a background thread instead of
+# one commit each on the request path. Rows get their time when they are queued, from now() below
+# and not from the columns' current_timestamp() default: that is the start of the transaction,
+# which would give every row of a batch the same time (and the time is part of the primary key).
+# A batch which fails (the database is down) is kept and retried with backoff, the queue is not
+# read meanwhile, so it buffers and then fills up to the synchronous writes.
+
+class AuditLogWriter:
+    '''Buffers audit log rows and writes them with multi-row inserts'''
+
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float, retry_max_delay: float):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_max_delay = retry_max_delay
+        self.failed = [] # Rows of failed batches, oldest first, only the writer thread touches these
+        self.retry_delay = 0.0
+        self.retry_at = 0.0
+        self.app: Flask = None
+        self.thread: Thread = None
+        self.stopping = Event()
+        self.start_lock = Lock()
+        self.pending_lock = Lock()
+        self.pending = {} # (table name, user id, agreement type) -> newest queued row, until it is written
+        self.stats_lock = Lock()
+        self.stats = {
+            'queued': 0,
+            'written': 0,
+            'batches': 0,
+            'failed': 0, # Rows in failed writes, retried
+            'lost': 0, # Refused by the database, or still failing when the process exited
+            'overflow': 0, # Written synchronously because the queue was full
+        }
+
+    def start(self, app: Flask) -> None:
+        with self.start_lock:
+            if self.thread is not None:
+                return
+            self.app = app
+            self.thread = Thread(target=self.run, name='audit-log-writer', daemon=True)
+            self.thread.start()
+            atexit.register(self.close) # Flush what is left on a clean shutdown
+
+    def enqueue(self, model, **values) -> dict:
+        """Queue a row for model, must be called inside an app context. Returns the row."""
+        values.setdefault('time' if 'time' in model.__table__.c else 'generatedOn', now())
+        if Config.AUDIT_LOG_MODE == 'sync':
+            self.write(model.__table__, [values])
+            user_summary.invalidate(values['userID'])
+            return values
+
+        self.start(current_app._get_current_object())
+        with self.pending_lock:
+            self.pending[pending_key(model.__table__, values)] = values
+        try:
+            self.queue.put_nowait((model.__table__, values))
+        except queue.Full:
+            self.count('overflow')
+            self.write(model.__table__, [values]) # Back pressure instead of losing rows
+            self.forget([(model.__table__, values)])
+            user_summary.invalidate(values['userID'])
+            return values
+        self.count('queued')
+        user_summary.invalidate(values['userID']) # The summary includes queued rows
+        return values
+
+    def latest_pending(self, model, user_id: int, type: str = None) -> dict | None:
+        """The newest row for the user (and agreement type) which is queued but not yet written."""
+        with self.pending_lock:
+            return self.pending.get((model.__tablename__, user_id, type))
+
+    def run(self) -> None:
+        while not self.stopping.is_set():
+            if not self.failed:
+                self.flush(wait=self.flush_interval)
+            elif not self.stopping.wait(self.retry_at - time.monotonic()):
+                self.retry()
+        self.retry()
+        if not self.failed:
+            self.flush()
+        if self.failed:
+            self.give_up()
+
+    def retry(self) -> None:
+        """Write the rows of the failed batches, in order, until one fails again."""
+        failed, self.failed = self.failed, []
+        while failed:
+            batch, failed = failed[:self.batch_size], failed[self.batch_size:]
+            if not self.write_batch(batch):
+                self.failed.extend(failed)
+                return
+
+    def give_up(self) -> None:
+        """At exit with the database still failing, the rows go to the log so they can be restored by hand."""
+        self.count('lost', len(self.failed))
+        for table, values in self.failed:
+            self.app.logger.error(f'Audit log row not written: {table.name} {values!r}')
+        self.forget(self.failed)
+        self.failed = []
+
+    def flush(self, wait: float = 0) -> None:
+        """Write everything queued, waiting up to wait seconds for the first row."""
+        try:
+            batch = [self.queue.get(timeout=wait) if wait else self.queue.get_nowait()]
+        except queue.Empty:
+            return
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                if not self.write_batch(batch):
+                    return # Retried before anything else is read from the queue
+                batch = []
+        if batch:
+            self.write_batch(batch)
+
+    def write_batch(self, batch: list) -> bool:
+        """Write a batch, or keep it in failed for a retry. Returns whether it was written."""
+        rows = defaultdict(list)
+        for table, values in batch:
+            rows[table].append(values)
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as conn: # One transaction, one multi-row insert per table
+                    for table, values in rows.items():
+                        conn.execute(insert(table), values)
+        except (OperationalError, InterfaceError, PoolTimeoutError) as e: # The database is unavailable
+            self.failed.extend(batch)
+            self.retry_delay = min(max(1.0, self.retry_delay * 2), self.retry_max_delay)
+            self.retry_at = time.monotonic() + self.retry_delay
+            self.count('failed', len(batch))
+            self.app.logger.error(f'Could not write {len(batch)} audit log rows, retrying in {self.retry_delay:g} s: {e!r}')
+            return False
+        except Exception as e: # A row the database refuses, written one by one so only it is dropped
+            if len(batch) > 1:
+                return self.write_rows(batch)
+            self.count('lost')
+            self.app.logger.error(f'Audit log row not written: {batch[0][0].name} {batch[0][1]!r}: {e!r}')
+            self.forget(batch)
+            return True
+        self.retry_delay = 0.0
+        self.count('written', len(batch))
+        self.count('batches')
+        self.forget(batch) # Still shown as pending while they are retried
+        user_summary.invalidate(*{values['userID'] for table, values in batch}) # Other workers could not see these rows before
+        return True
+
+    def write_rows(self, batch: list) -> bool:
+        for index, row in enumerate(batch):
+            if not self.write_batch([row]):
+                self.failed.extend(batch[index + 1:])
+                return False
+        return True
+
+    def write(self, table, values: list) -> None:
+        with db.engine.begin() as conn:
+            conn.execute(insert(table), values)
+        self.count('written', len(values))
+
+    def forget(self, batch: list) -> None:
+        with self.pending_lock:
+            for table, values in batch:
+                key = pending_key(table, values)
+                if self.pending.get(key) is values:
+                    del self.pending[key]
+
+    def close(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+
+    def count(self, key: str, amount: int = 1) -> None:
+        with self.stats_lock:
+            self.stats[key] += amount
+
+    def get_stats(self) -> dict:
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['queue_size'] = self.queue.qsize()
+        stats['retrying'] = len(self.failed)
+        stats['mode'] = Config.AUDIT_LOG_MODE
+        return stats
+
+def pending_key(table, values: dict) -> tuple:
+    return (table.name, values['userID'], values.get('type'))
+
+last_time = datetime.datetime.min
+time_lock = Lock()
+
+def now() -> datetime.datetime:
+    """Log times are naive UTC, what current_timestamp() gives in a database running in UTC, and
+    strictly increasing: the time is part of the primary key so two rows for a user must never share one."""
+    global last_time
+    with time_lock:
+        last_time = max(datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None), last_time + datetime.timedelta(microseconds=1))
+        return last_time
+
+audit_log = AuditLogWriter(Config.AUDIT_QUEUE_SIZE, Config.AUDIT_BATCH_SIZE, Config.AUDIT_FLUSH_INTERVAL, Config.AUDIT_RETRY_MAX_DELAY)
+
+def get_stats() -> dict:
+    return audit_log.get_stats()
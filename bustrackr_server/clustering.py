@@ -0,0 +1,105 @@
+from typing import Dict, List, NamedTuple, Sequence
+import math
+import numpy
+from bustrackr_server.config import Config
+
+# Points clustered on a grid for every map zoom level, for views too far out to show each point.
+# The grid is in web mercator, the projection of the map, with cells of CLUSTER_CELL_PIXELS
+# screen pixels, so a cluster looks the same size at every zoom. A cell at one zoom is exactly
+# four cells of the next, which makes the levels a quadtree: a cluster is the sum of the clusters
+# it splits into when zooming in, and never jumps between them. Every level is computed up front,
+# a query is then a bounding box mask over the clusters of one level.
+
+TILE_PIXELS = 256
+MAX_ZOOM = 22
+VIEW_TILES = 5 # Tiles across a typical map view, to guess the zoom of a request without one
+
+class Cluster(NamedTuple):
+    latitude: float # Centroid of the points
+    longitude: float
+    count: int
+    item: object # The point, if it is the only one
+
+class Level(NamedTuple):
+    latitudes: numpy.ndarray
+    longitudes: numpy.ndarray
+    counts: numpy.ndarray
+    members: numpy.ndarray # Index of one point of every cluster
+
+def mercator(latitudes: numpy.ndarray, longitudes: numpy.ndarray):
+    """Web mercator x and y in [0, 1), y grows southwards like tile numbers."""
+    x = (longitudes + 180) / 360
+    sin_lat = numpy.sin(numpy.radians(latitudes.clip(-85, 85)))
+    y = 0.5 - numpy.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x.clip(0, 1 - 1e-12), y.clip(0, 1 - 1e-12)
+
+class GridClusters:
+    '''Items clustered at every zoom level up to max_zoom'''
+
+    def __init__(self, items: Sequence, latitudes: Sequence[float], longitudes: Sequence[float], max_zoom: int):
+        self.items = items
+        self.max_zoom = max_zoom
+        self.levels: Dict[int, Level] = {}
+        latitudes = numpy.asarray(latitudes, float)
+        longitudes = numpy.asarray(longitudes, float)
+        cells = (1 << max_zoom) * TILE_PIXELS / Config.CLUSTER_CELL_PIXELS # Across the world at max_zoom
+        x, y = mercator(latitudes, longitudes)
+        column = (x * cells).astype(numpy.int64)
+        row = (y * cells).astype(numpy.int64)
+        for zoom in range(max_zoom, -1, -1):
+            shift = max_zoom - zoom
+            keys = ((column >> shift) << 32) | (row >> shift)
+            _, inverse, counts = numpy.unique(keys, return_inverse=True, return_counts=True)
+            members = numpy.empty(len(counts), numpy.int64)
+            members[inverse] = numpy.arange(len(keys))
+            self.levels[zoom] = Level(
+                numpy.bincount(inverse, weights=latitudes, minlength=len(counts)) / counts,
+                numpy.bincount(inverse, weights=longitudes, minlength=len(counts)) / counts,
+                counts,
+                members
+            )
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def query(self, lat_0: float, lon_0: float, lat_1: float, lon_1: float, zoom: int) -> List[Cluster]:
+        """The clusters of the zoom level (at most max_zoom) with their centroid inside the bounding box."""
+        if not len(self.items):
+            return []
+        level = self.levels[max(0, min(zoom, self.max_zoom))]
+        inside = numpy.flatnonzero(
+            (level.latitudes <= lat_0) & (level.latitudes >= lat_1) &
+            (level.longitudes >= lon_0) & (level.longitudes <= lon_1)
+        )
+        return [
+            Cluster(latitude, longitude, count, self.items[member] if count == 1 else None)
+            for latitude, longitude, count, member in zip(
+                level.latitudes[inside].tolist(),
+                level.longitudes[inside].tolist(),
+                level.counts[inside].tolist(),
+                level.members[inside].tolist()
+            )
+        ]
+
+def estimate_zoom(lon_0: float, lon_1: float) -> int:
+    """The zoom a map showing the longitudes would be at."""
+    span = max(lon_1 - lon_0, 1e-9)
+    return max(0, min(MAX_ZOOM, math.floor(math.log2(360 * VIEW_TILES / span))))
+
+def parse_zoom(value) -> int:
+    """A requested zoom as a level between 0 and MAX_ZOOM. Raises ValueError if it is not a finite number."""
+    try:
+        zoom = float(value)
+    except TypeError:
+        raise ValueError('zoom must be a number')
+    if not math.isfinite(zoom):
+        raise ValueError('zoom must be a finite number')
+    return max(0, min(MAX_ZOOM, int(zoom)))
+
+def view_zoom(req: dict, lon_0: float, lon_1: float) -> int:
+    """The zoom of a request, its own if it has one but never closer than its bounding box allows,
+    so a huge box can not ask for the clusters of a close zoom. Raises ValueError if zoom is invalid."""
+    estimated = estimate_zoom(lon_0, lon_1)
+    if req.get('zoom') is None:
+        return estimated
+    return min(parse_zoom(req['zoom']), estimated + 1) # One level of slack, views are not exactly VIEW_TILES wide
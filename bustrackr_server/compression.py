@@ -0,0 +1,156 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, Hashable
+from flask import Flask, Response, request
+import gzip
+from bustrackr_server.config import Config
+from bustrackr_server.metrics import dumps
+from bustrackr_server.tracing import span
+from bustrackr_server.static_version import get_static_version
+
+# brotli and zstandard are optional, gzip is always availible
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Server side preference, the client q-values decide first
+ENCODINGS = [encoding for encoding, module in (('br', brotli), ('zstd', zstandard), ('gzip', gzip)) if module is not None]
+
+stats_lock = Lock()
+stats = {
+    'responses': 0,      # Responses large enough to be considered
+    'compressed': 0,     # Responses sent with a content encoding
+    'bytes_in': 0,       # Uncompressed size of the compressed responses
+    'bytes_out': 0,      # Compressed size of the compressed responses
+    'cache_hits': 0,
+    'cache_misses': 0,
+}
+
+def count(**kwargs) -> None:
+    with stats_lock:
+        for key, value in kwargs.items():
+            stats[key] += value
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress data with the given content encoding."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=max(0, min(11, Config.COMPRESSION_LEVEL - 1)))
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=max(1, Config.COMPRESSION_LEVEL // 2)).compress(data)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=Config.COMPRESSION_LEVEL, mtime=0)
+    raise ValueError(f'Unsupported encoding: {encoding}')
+
+def negotiate_encoding() -> str | None:
+    """Pick the best encoding the current request accepts, None means identity."""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+class CompressedCache:
+    '''LRU cache of serialized responses, every body is kept once per content encoding
+    so each encoding is only compressed the first time it is requested'''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[Hashable, Dict[str, bytes]] = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key: Hashable, encoding: str) -> bytes | None:
+        with self.lock:
+            variants = self.entries.get(key)
+            if variants is None:
+                return None
+            self.entries.move_to_end(key)
+            return variants.get(encoding)
+
+    def put(self, key: Hashable, encoding: str, body: bytes) -> None:
+        with self.lock:
+            variants = self.entries.setdefault(key, {})
+            if encoding not in variants:
+                variants[encoding] = body
+                self.size += len(body)
+            self.entries.move_to_end(key)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= sum(len(data) for data in evicted.values())
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+response_cache = CompressedCache(Config.RESPONSE_CACHE_MAX_BYTES)
+
+def cached_response(key: Hashable, build: Callable[[], dict]) -> Response:
+    """Serve a cacheable JSON response, build is only called on a cache miss.
+    Only use this for data which does not change until the static data is reloaded."""
+    key = (get_static_version(), key) # Other workers may have reloaded the static data
+    identity = response_cache.get(key, 'identity')
+    hit = identity is not None
+    if not hit:
+        with span('build_response'):
+            obj = build()
+        identity = dumps(obj)
+        response_cache.put(key, 'identity', identity)
+
+    encoding = negotiate_encoding() if len(identity) >= Config.COMPRESSION_MIN_SIZE else None
+    body = identity
+    if encoding:
+        body = response_cache.get(key, encoding)
+        if body is None:
+            hit = False
+            body = compress(identity, encoding)
+            response_cache.put(key, encoding, body)
+
+    response = Response(body, status=200, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    count(cache_hits=int(hit), cache_misses=int(not hit))
+    if len(identity) >= Config.COMPRESSION_MIN_SIZE:
+        count(responses=1)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+        count(compressed=1, bytes_in=len(identity), bytes_out=len(body))
+    return response
+
+def compress_response(response: Response) -> Response:
+    """Compress uncached responses on the fly when they are large enough."""
+    if response.direct_passthrough or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if 'Accept-Encoding' in response.vary:
+        return response # Already negotiated, e.g. by cached_response
+
+    data = response.get_data()
+    if len(data) < Config.COMPRESSION_MIN_SIZE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    count(responses=1)
+    encoding = negotiate_encoding()
+    if not encoding:
+        return response
+
+    compressed = compress(data, encoding)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    count(compressed=1, bytes_in=len(data), bytes_out=len(compressed))
+    return response
+
+def get_stats() -> dict:
+    with stats_lock:
+        current = dict(stats)
+    lookups = current['cache_hits'] + current['cache_misses']
+    current['cache_hit_rate'] = current['cache_hits'] / lookups if lookups else None
+    current['bytes_saved'] = current['bytes_in'] - current['bytes_out']
+    current['cache_bytes'] = response_cache.size
+    current['cache_entries'] = len(response_cache.entries)
+    current['encodings'] = ENCODINGS
+    return current
+
+def register_compression(app: Flask):
+    app.after_request(compress_response)
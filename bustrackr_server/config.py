@@ -7,11 +7,11 @@ dev_env_file = dotenv_values(dotenv_path=dev_env_path)
 
 env_mode = os.getenv('FLASK_ENV', 'development')
 
-def get_env_value(key):
+def get_env_value(key, default=None):
     if env_mode == 'development':
-        return dev_env_file[key]
+        return dev_env_file[key] if default is None else dev_env_file.get(key, default)
     else:
-        return os.getenv(key)
+        return os.getenv(key, default)
 
 database_user = get_env_value('DATABASE_USER')
 database_pass = get_env_value('DATABASE_PASS')   
@@ -19,16 +19,117 @@ database_host = get_env_value('DATABASE_HOST')
 database_port = get_env_value('DATABASE_PORT')
 database_database = get_env_value('DATABASE_DATABASE')
 
+# Every worker process gets an equal share of the connections the database allows us
+web_workers = int(get_env_value('WEB_WORKERS', '1'))
+web_threads = int(get_env_value('WEB_THREADS', '4')) # waitress --threads
+db_max_connections = int(get_env_value('DB_MAX_CONNECTIONS', '20'))
+connections_per_worker = max(1, db_max_connections // web_workers)
+pool_size = min(web_threads, connections_per_worker) # One connection per request thread
+
 trafiklab_url = get_env_value('TRAFIKLAB_URL')
 trafiklab_key = get_env_value('TRAFIKLAB_KEY')
 
 class Config:
     SECRET_KEY = get_env_value('FLASK_SECRET')
     SQLALCHEMY_DATABASE_URI = f'postgresql+psycopg://{database_user}:{database_pass}@{database_host}:{database_port}/{database_database}'
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': pool_size,
+        'max_overflow': connections_per_worker - pool_size, # Bursts may use the rest of the share
+        'pool_timeout': float(get_env_value('DB_POOL_TIMEOUT', '10')),
+        'pool_recycle': int(get_env_value('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': True,
+        # psycopg 3 uses a server side prepared statement once a query has run this many times on a connection
+        'connect_args': {'prepare_threshold': int(get_env_value('DB_PREPARE_THRESHOLD', '1'))},
+    }
+    # Comma separated connection URIs of read replicas, read only queries are spread over them
+    SQLALCHEMY_REPLICA_URIS = [uri.strip() for uri in get_env_value('DATABASE_REPLICA_URIS', '').split(',') if uri.strip()]
+    SQLALCHEMY_BINDS = {f'replica_{i}': uri for i, uri in enumerate(SQLALCHEMY_REPLICA_URIS)} # Keys must match db_routing.REPLICA_PREFIX
+    DB_STICKY_SECONDS = int(get_env_value('DB_STICKY_SECONDS', '5')) # Reads of a user go to the primary this long after their write, keep above the replica lag
+    AUDIT_LOG_MODE = get_env_value('AUDIT_LOG_MODE', 'async') # 'async' batches login/agreement/report logs in the background, 'sync' writes each one right away
+    AUDIT_SYNC_AGREEMENTS = get_env_value('AUDIT_SYNC_AGREEMENTS', 'false').lower() == 'true' # Commit agreements together with the user, if they must never be lost
+    AUDIT_QUEUE_SIZE = int(get_env_value('AUDIT_QUEUE_SIZE', '10000')) # Rows, a full queue is written synchronously
+    AUDIT_BATCH_SIZE = int(get_env_value('AUDIT_BATCH_SIZE', '500')) # Rows per insert
+    AUDIT_FLUSH_INTERVAL = float(get_env_value('AUDIT_FLUSH_INTERVAL', '1')) # Seconds between writes when the queue is quiet
+    AUDIT_RETRY_MAX_DELAY = float(get_env_value('AUDIT_RETRY_MAX_DELAY', '60')) # Seconds, a failed batch is retried after 1, 2, 4... seconds up to this
+    USER_SUMMARY_TTL = int(get_env_value('USER_SUMMARY_TTL', '300')) # Seconds the account data of a user is cached in redis
+    # Argon2 parameters for new hashes, stored hashes are upgraded on the next login
+    ARGON2_TIME_COST = int(get_env_value('ARGON2_TIME_COST', '3'))
+    ARGON2_MEMORY_COST = int(get_env_value('ARGON2_MEMORY_COST', '65536')) # KiB
+    ARGON2_PARALLELISM = int(get_env_value('ARGON2_PARALLELISM', '4'))
+    HASH_WORKERS = int(get_env_value('HASH_WORKERS', '2')) # Processes hashing passwords, 0 hashes on the request thread
+    HASH_QUEUE_DEPTH = int(get_env_value('HASH_QUEUE_DEPTH', '8')) # Hashes waiting for a worker before requests are turned away
+    HASH_TIMEOUT = float(get_env_value('HASH_TIMEOUT', '5')) # Seconds
+    HASH_RETRY_AFTER = int(get_env_value('HASH_RETRY_AFTER', '2')) # Retry-After (seconds) sent when the hasher is busy
+    TOKEN_RENEW_FRACTION = float(get_env_value('TOKEN_RENEW_FRACTION', '0.5')) # Renew a token once this much of its life has passed
+    TOKEN_CACHE_SIZE = int(get_env_value('TOKEN_CACHE_SIZE', '100000')) # Verified tokens remembered per worker
+    TOKEN_REVOCATION_CHECK = get_env_value('TOKEN_REVOCATION_CHECK', 'true').lower() == 'true' # Check every token against the revocation list in redis
+    TIMEZONE = get_env_value('TIMEZONE', 'Europe/Stockholm') # The timetables are in this local time
+    DEPARTURES_WINDOW = int(get_env_value('DEPARTURES_WINDOW', '60')) # Minutes ahead upcoming departures are shown
+    DEPARTURES_LIMIT = int(get_env_value('DEPARTURES_LIMIT', '10')) # Departures per stop
     REDIS_HOST = get_env_value('REDIS_HOST')
     REDIS_PORT = get_env_value('REDIS_PORT')
     REDIS_PASS = get_env_value('REDIS_PASS')
     REDIS_DB = int(get_env_value('REDIS_DB'))
+    REDIS_MAX_CONNECTIONS = int(get_env_value('REDIS_MAX_CONNECTIONS', '50')) # Per process
+    REDIS_SOCKET_TIMEOUT = float(get_env_value('REDIS_SOCKET_TIMEOUT', '1')) # Seconds, for connecting and for every command
+    REDIS_HEALTH_CHECK_INTERVAL = int(get_env_value('REDIS_HEALTH_CHECK_INTERVAL', '15')) # Seconds idle before a pooled connection is pinged
+    REDIS_RETRIES = int(get_env_value('REDIS_RETRIES', '2')) # Retries of a command after a connection error, with exponential backoff
+    REDIS_BREAKER_FAILURES = int(get_env_value('REDIS_BREAKER_FAILURES', '5')) # Failures in a row which open the circuit breaker
+    REDIS_BREAKER_RESET = float(get_env_value('REDIS_BREAKER_RESET', '5')) # Seconds the breaker stays open before letting a trial command through
+    LIVE_STALE_MAX_AGE = float(get_env_value('LIVE_STALE_MAX_AGE', '120')) # Seconds the last live snapshot is still served while redis is down
+    TRAIL_WINDOW = int(get_env_value('TRAIL_WINDOW', '600')) # Seconds of history kept per vehicle
+    TRAIL_MAX_POINTS = int(get_env_value('TRAIL_MAX_POINTS', '240')) # Per vehicle, lowered automatically to stay within TRAIL_MEMORY_BUDGET
+    TRAIL_MIN_DISTANCE = float(get_env_value('TRAIL_MIN_DISTANCE', '15')) # Meters, closer fixes are dropped (a bus waiting at a stop)...
+    TRAIL_MAX_GAP = float(get_env_value('TRAIL_MAX_GAP', '60')) # ...unless this many seconds passed since the last kept one
+    TRAIL_MEMORY_BUDGET = int(get_env_value('TRAIL_MEMORY_BUDGET', str(64 * 1024 * 1024))) # Bytes of redis memory for all trails
+    TRAIL_ARCHIVE_DIR = get_env_value('TRAIL_ARCHIVE_DIR', '') # Write every fix to daily compressed columnar files here, off if empty
+    TRAIL_ARCHIVE_ROWS = int(get_env_value('TRAIL_ARCHIVE_ROWS', '200000')) # Fixes per archive file
+    MOTION_SMOOTHING = float(get_env_value('MOTION_SMOOTHING', '0.4')) # Weight of the newest fix in a vehicle's smoothed speed and heading
+    MOTION_MAX_SPEED = float(get_env_value('MOTION_MAX_SPEED', '35')) # Meters per second, faster between two fixes is a GPS jump
+    MOTION_MAX_EXTRAPOLATION = float(get_env_value('MOTION_MAX_EXTRAPOLATION', '20')) # Seconds a position is moved forward at most (as_of now)
+    ROUTE_SNAP_DISTANCE = float(get_env_value('ROUTE_SNAP_DISTANCE', '40')) # Meters, a bus farther from its route is extrapolated in a straight line
+    ROUTE_GEOMETRY_CACHE_SIZE = int(get_env_value('ROUTE_GEOMETRY_CACHE_SIZE', '2048')) # Route shapes kept in memory per worker
+    ALERT_MAX_SUBSCRIPTIONS = int(get_env_value('ALERT_MAX_SUBSCRIPTIONS', '20')) # Per user
+    ALERT_MAX_METERS = int(get_env_value('ALERT_MAX_METERS', '5000')) # Largest distance threshold of a subscription
+    ALERT_MAX_MINUTES = int(get_env_value('ALERT_MAX_MINUTES', '30')) # Largest time threshold of a subscription
+    ALERT_REPEAT_AFTER = int(get_env_value('ALERT_REPEAT_AFTER', '1800')) # Seconds before the same bus alerts the same subscription again
+    ALERT_QUEUE_LENGTH = int(get_env_value('ALERT_QUEUE_LENGTH', '10000')) # Alerts kept in the redis queue for the push workers
+    ALERT_WEBHOOK_URL = get_env_value('ALERT_WEBHOOK_URL', '') # Also POST every cycle's alerts here, off if empty
+    CLUSTER_CELL_PIXELS = int(get_env_value('CLUSTER_CELL_PIXELS', '64')) # Size of a cluster cell on screen, must divide 256
+    NEARBY_MAX_K = int(get_env_value('NEARBY_MAX_K', '50')) # Most results /api/nearby returns
+    NEARBY_MAX_RADIUS = float(get_env_value('NEARBY_MAX_RADIUS', '5000')) # Meters
+    NEARBY_DEFAULT_RADIUS = float(get_env_value('NEARBY_DEFAULT_RADIUS', '1000')) # Meters, when the request has none
     API_URL = f'{trafiklab_url}?key={trafiklab_key}'
     JWT_SECRET = get_env_value('JWT_SECRET')
-    ENV = os.getenv('FLASK_ENV', 'development')
\ No newline at end of file
+    ENV = os.getenv('FLASK_ENV', 'development')
+    COMPRESSION_MIN_SIZE = int(get_env_value('COMPRESSION_MIN_SIZE', '1024')) # Bytes, smaller responses are sent as is
+    COMPRESSION_LEVEL = int(get_env_value('COMPRESSION_LEVEL', '6')) # gzip level, brotli/zstd levels are derived from it
+    RESPONSE_CACHE_MAX_BYTES = int(get_env_value('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+    STATIC_MAX_AGE = int(get_env_value('STATIC_MAX_AGE', '3600')) # Cache-Control max-age (seconds) for static data
+    STATIC_DATA_VERSION = get_env_value('STATIC_DATA_VERSION', '') # Pin the static data version instead of using the one in redis
+    HTTP_CACHE_PRECISION = int(get_env_value('HTTP_CACHE_PRECISION', '3')) # Decimals kept in canonical GET coordinates
+    TILE_SIZE = float(get_env_value('TILE_SIZE', '0.02')) # Degrees, bounding boxes are snapped to this grid
+    TILE_CACHE_TTL = float(get_env_value('TILE_CACHE_TTL', '3600')) # Seconds a static tile stays in the in-process cache
+    TILE_CACHE_REDIS_TTL = int(get_env_value('TILE_CACHE_REDIS_TTL', '86400')) # Seconds a static tile stays in redis
+    TILE_CACHE_MAX_TILES = int(get_env_value('TILE_CACHE_MAX_TILES', '4096')) # Per namespace
+    VIEWPORT_TRACE_FILE = get_env_value('VIEWPORT_TRACE_FILE', '') # Record requested viewports here (JSON lines) for replay
+    INGEST_ROLE = get_env_value('INGEST_ROLE', 'none') # 'none' only serves (run bustrackr_server.ingest), 'embedded' also fetches live data in this process, set it on one process only
+    INGEST_LOCK_TTL_MS = int(get_env_value('INGEST_LOCK_TTL_MS', '15000')) # A dead ingest leader is replaced after this long
+    FETCH_TIMEOUT = float(get_env_value('FETCH_TIMEOUT', '5')) # Seconds to connect and between bytes of a live data fetch, capped at half of INGEST_LOCK_TTL_MS
+    STARTUP_BUDGET_MS = float(get_env_value('STARTUP_BUDGET_MS', '1500')) # Warn if a cold start takes longer
+    STARTUP_PROFILE = get_env_value('STARTUP_PROFILE', '') # Write a cProfile of create_app() to this file
+    ADMIN_TOKEN = get_env_value('ADMIN_TOKEN', '') # X-Admin-Token of the /api/debug endpoints, which are off if empty
+    TRACE_ENABLED = get_env_value('TRACE_ENABLED', 'false').lower() == 'true' # Trace every API request, only slow ones are kept
+    TRACE_SLOW_MS = float(get_env_value('TRACE_SLOW_MS', '500')) # Keep the traces of requests slower than this
+    TRACE_BUFFER_SIZE = int(get_env_value('TRACE_BUFFER_SIZE', '200')) # Slow traces kept per worker for /api/debug/traces
+    TRACE_FILE = get_env_value('TRACE_FILE', '') # Also append slow traces here (OTLP JSON lines), off if empty
+    TRACE_OTLP_URL = get_env_value('TRACE_OTLP_URL', '') # Also POST slow traces to this OTLP/HTTP endpoint, e.g. http://localhost:4318/v1/traces
+    PROFILE_ENABLED = get_env_value('PROFILE_ENABLED', 'false').lower() == 'true' # CPU profiles (/api/debug/profile, SIGUSR2) and per cycle ingest profiles
+    PROFILE_INTERVAL_MS = float(get_env_value('PROFILE_INTERVAL_MS', '10')) # Between two samples of every thread's stack
+    PROFILE_MAX_SECONDS = float(get_env_value('PROFILE_MAX_SECONDS', '60')) # Longest CPU profile
+    PROFILE_SIGNAL_SECONDS = float(get_env_value('PROFILE_SIGNAL_SECONDS', '30')) # Length of the CPU profile started by SIGUSR2
+    PROFILE_DIR = get_env_value('PROFILE_DIR', '') # Where SIGUSR2 writes the profiles, the temp directory if empty
+    PROFILE_TRACEMALLOC = get_env_value('PROFILE_TRACEMALLOC', 'false').lower() == 'true' # Diff allocations between ingest cycles, slows every allocation down
+    PROFILE_TRACEMALLOC_FRAMES = int(get_env_value('PROFILE_TRACEMALLOC_FRAMES', '1')) # Frames kept per allocation
+    PROFILE_TOP_ALLOCATIONS = int(get_env_value('PROFILE_TOP_ALLOCATIONS', '15')) # Lines listed per cycle
+    PROFILE_CYCLES = int(get_env_value('PROFILE_CYCLES', '100')) # Profiled ingest cycles kept
\ No newline at end of file
@@ -1,14 +1,36 @@
-from bustrackr_server.routes import session_states
 from threading import Timer, Lock
-import os
+from flask import Flask
 from bustrackr_server.live_parser import process_live_data
+from bustrackr_server.activity import is_active
+from bustrackr_server.leader_lock import LeaderLock
+from bustrackr_server.profiling import ingest_cycle
 from bustrackr_server import Config
 import requests
 
+FETCH_INTERVAL = 5 # Seconds
+
 curr_timer = None
 timer_lock = Lock()
 
-def do_fetch():
+# Several processes may be allowed to ingest, only the leader actually does
+ingest_lock = LeaderLock('ingest', Config.INGEST_LOCK_TTL_MS)
+# A hung fetch must end well before the lock expires, or another process takes the lead while this one is still going to write
+FETCH_TIMEOUT = min(Config.FETCH_TIMEOUT, Config.INGEST_LOCK_TTL_MS / 2000)
+
+def fetch_once() -> bool:
+    """Fetch and store the live data once, if this process is the leader and someone is watching."""
+    if not ingest_lock.acquire():
+        return False
+
+    if not is_active():
+        return False  # If we have no "active" users, no need to fetch realtime
+    
+    with ingest_cycle(), requests.get(Config.API_URL, timeout=FETCH_TIMEOUT) as response:
+        process_live_data(response.text)
+    return True
+
+def do_fetch(app: Flask):
+    '''Fetch on a timer inside the API process (INGEST_ROLE=embedded)'''
     global curr_timer
 
     # Ensure only one thread can modify the timer at a time
@@ -17,13 +39,10 @@ def do_fetch():
             curr_timer.cancel()
 
         # Schedule the next fetch after 5 seconds
-        curr_timer = Timer(5, do_fetch)
+        curr_timer = Timer(FETCH_INTERVAL, do_fetch, args=(app,))
         curr_timer.daemon = True # If we quit we quit
+        curr_timer.name = 'ingest' # Shows up as such in CPU profiles
         curr_timer.start()
 
-    if len(session_states) == 0:
-        return  # If we have no "active" users, no need to fetch realtime
-    
-    with requests.get(Config.API_URL) as response:
-        process_live_data(response.text)
-    
\ No newline at end of file
+    with app.app_context(): # The line index looks up journeys in the database
+        fetch_once()
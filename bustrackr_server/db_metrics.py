@@ -0,0 +1,77 @@
+from collections import defaultdict
+from threading import Lock
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+import time
+from bustrackr_server.metrics import observe_query
+from bustrackr_server.tracing import db_span
+
+# Connection pool and query metrics for every engine in the process
+
+stats_lock = Lock()
+pool_stats = {
+    'checkouts': 0,
+    'wait_seconds': 0.0,
+    'max_wait_seconds': 0.0,
+    'timeouts': 0,
+}
+query_stats = defaultdict(lambda: {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+pools = []
+
+class TimedQueuePool(QueuePool):
+    '''QueuePool which records how long every checkout waited for a connection'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pools.append(self)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with stats_lock:
+                pool_stats['timeouts'] += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with stats_lock:
+                pool_stats['checkouts'] += 1
+                pool_stats['wait_seconds'] += waited
+                pool_stats['max_wait_seconds'] = max(pool_stats['max_wait_seconds'], waited)
+
+# Statements are labelled with .execution_options(query_name=...), everything else is 'other'.
+# The start time is kept on the statement's execution context, which is dropped with it when the
+# execute fails (after_cursor_execute never runs then), not on the pooled connection.
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+    else: # Some dialect internals, one slot which the next one overwrites
+        conn.info['query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = context.query_started if context is not None else conn.info.pop('query_started')
+    elapsed = time.perf_counter() - started
+    name = context.execution_options.get('query_name', 'other') if context is not None else 'other'
+    with stats_lock:
+        query = query_stats[name]
+        query['count'] += 1
+        query['seconds'] += elapsed
+        query['max_seconds'] = max(query['max_seconds'], elapsed)
+    observe_query(name, elapsed)
+    db_span(name, statement, elapsed)
+
+def get_stats() -> dict:
+    with stats_lock:
+        pool = dict(pool_stats)
+        queries = {name: dict(query) for name, query in query_stats.items()}
+    pool['mean_wait_ms'] = pool['wait_seconds'] * 1000 / pool['checkouts'] if pool['checkouts'] else None
+    pool['checked_out'] = sum(p.checkedout() for p in pools)
+    pool['size'] = sum(p.size() for p in pools)
+    pool['overflow'] = sum(max(0, p.overflow()) for p in pools)
+    for query in queries.values():
+        query['mean_ms'] = query['seconds'] * 1000 / query['count']
+    return {'pool': pool, 'queries': queries}
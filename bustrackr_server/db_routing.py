@@ -0,0 +1,89 @@
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+from flask_sqlalchemy.session import Session
+import random
+import redis
+
+# Reads marked with @read_only go to a random replica, everything else to the primary.
+# A user who just wrote is pinned to the primary for DB_STICKY_SECONDS so they always read their own writes.
+
+REPLICA_PREFIX = 'replica_'
+STICKY_PREFIX = 'sticky:'
+
+route = ContextVar('db_route', default=None) # None, 'replica' or 'primary'
+
+stats_lock = Lock()
+stats = {
+    'replica': 0, # Outermost calls routed to a replica
+    'primary': 0,
+    'sticky': 0, # Reads kept on the primary because the user just wrote
+}
+
+class RoutingSession(Session):
+    '''Session which sends the statements of @read_only functions to a replica'''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and route.get() == 'replica' and not self._flushing:
+            replicas = [engine for key, engine in self._db.engines.items() if key and key.startswith(REPLICA_PREFIX)]
+            if replicas:
+                return random.choice(replicas)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def is_sticky(user_id: int) -> bool:
+    try:
+        return bool(redis_client.exists(f'{STICKY_PREFIX}{user_id}'))
+    except redis.exceptions.RedisError:
+        return True # Better a busy primary than a stale read
+
+def mark_written(user_id: int) -> None:
+    """Pin the user to the primary until the replicas have caught up with this write."""
+    try:
+        redis_client.set(f'{STICKY_PREFIX}{user_id}', 1, ex=Config.DB_STICKY_SECONDS)
+    except redis.exceptions.RedisError:
+        pass
+
+def run_routed(target: str, func, args, kwargs, sticky: bool = False):
+    if route.get() is not None: # The outermost function decides, a read inside a write stays on the primary
+        return func(*args, **kwargs)
+    with stats_lock:
+        stats['sticky' if sticky else target] += 1
+    token = route.set(target)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        route.reset(token)
+
+def read_only(func):
+    """Run func against a replica, for reads which may be slightly stale (static data)."""
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        return run_routed('replica', func, args, kwargs)
+    return decorated
+
+def read_only_for_user(func):
+    """Like read_only, but the first argument is a user id and the user's own recent writes must be visible."""
+    @wraps(func)
+    def decorated(user_id, *args, **kwargs):
+        if route.get() is not None:
+            return func(user_id, *args, **kwargs)
+        if not Config.SQLALCHEMY_REPLICA_URIS: # Everything is read from the primary, no need to ask redis
+            return run_routed('primary', func, (user_id, *args), kwargs)
+        sticky = is_sticky(user_id)
+        return run_routed('primary' if sticky else 'replica', func, (user_id, *args), kwargs, sticky)
+    return decorated
+
+def primary(func):
+    """Run func and everything it calls against the primary."""
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        return run_routed('primary', func, args, kwargs)
+    return decorated
+
+def get_stats() -> dict:
+    with stats_lock:
+        result = dict(stats)
+    result['replicas'] = len(Config.SQLALCHEMY_REPLICA_URIS)
+    return result
+
+from bustrackr_server import Config, redis_client
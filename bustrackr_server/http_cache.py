@@ -0,0 +1,86 @@
+from threading import Lock
+from typing import Callable, Dict, List
+from flask import Response, make_response, request
+from werkzeug.datastructures import MultiDict
+import hashlib
+import math
+from bustrackr_server.config import Config
+from bustrackr_server.compression import negotiate_encoding
+from bustrackr_server.static_version import get_static_version
+from bustrackr_server.clustering import parse_zoom
+
+# HTTP validators for data that only changes when the static data is reloaded
+
+stats_lock = Lock()
+stats = {
+    'requests': 0,
+    'not_modified': 0,
+}
+
+def quantize(value: float, up: bool) -> str:
+    """Round a coordinate outwards to the cache grid so nearby views share a canonical query."""
+    scale = 10 ** Config.HTTP_CACHE_PRECISION
+    rounded = math.ceil(value * scale) if up else math.floor(value * scale)
+    return f'{rounded / scale:.{Config.HTTP_CACHE_PRECISION}f}'
+
+def canonical_bbox(args: MultiDict) -> Dict[str, str]:
+    """Canonical, quantized bounding box from query parameters. lat_0/lon_1 is the north east corner."""
+    lat_0 = float(args['lat_0'])
+    lon_0 = float(args['lon_0'])
+    lat_1 = float(args['lat_1'])
+    lon_1 = float(args['lon_1'])
+    if not all(math.isfinite(value) for value in (lat_0, lon_0, lat_1, lon_1)):
+        raise ValueError('Coordinates must be finite')
+    return {
+        'lat_0': quantize(lat_0, up=True),
+        'lon_0': quantize(lon_0, up=False),
+        'lat_1': quantize(lat_1, up=False),
+        'lon_1': quantize(lon_1, up=True),
+    }
+
+def canonical_view(args: MultiDict) -> Dict[str, str]:
+    """canonical_bbox, with the map zoom if the request has one."""
+    params = canonical_bbox(args)
+    if args.get('zoom') is not None:
+        params['zoom'] = str(parse_zoom(args['zoom']))
+    return params
+
+def canonical_ids(value: str) -> List[int]:
+    """Canonical list of ids from a comma separated query parameter."""
+    return sorted({int(part) for part in value.split(',') if part.strip()})
+
+def make_etag(namespace: str, params: dict, encoding: str | None) -> str:
+    """Strong ETag for a representation, derived from the static data version and the canonical query."""
+    query = '&'.join(f'{key}={params[key]}' for key in sorted(params))
+    digest = hashlib.sha256(f'{get_static_version()}|{namespace}|{query}'.encode()).hexdigest()[:32]
+    return f'{digest}-{encoding or "identity"}' # Every content encoding is a separate representation
+
+def conditional_response(namespace: str, params: dict, build: Callable) -> Response:
+    """Answer with 304 if the client already has the representation, else build it.
+    build is not called for a 304, so repeat views never reach the service layer."""
+    etag = make_etag(namespace, params, negotiate_encoding())
+
+    with stats_lock:
+        stats['requests'] += 1
+
+    if request.if_none_match.contains(etag):
+        with stats_lock:
+            stats['not_modified'] += 1
+        response = Response(status=304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response # Never cache errors
+
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = Config.STATIC_MAX_AGE
+    return response
+
+def get_stats() -> dict:
+    with stats_lock:
+        current = dict(stats)
+    current['not_modified_rate'] = current['not_modified'] / current['requests'] if current['requests'] else None
+    current['static_version'] = get_static_version()
+    return current
@@ -0,0 +1,56 @@
+'''Standalone ingest worker, owns fetching the live data and writing it to redis.
+
+    python -m bustrackr_server.ingest
+    flask --app run.py ingest
+
+The API workers only read (INGEST_ROLE defaults to none). Any number of ingest
+workers may run, a leader lock in redis makes sure only one of them is active.
+'''
+import argparse
+import signal
+import time
+from bustrackr_server import create_app
+from bustrackr_server.data_fetcher import FETCH_INTERVAL, fetch_once, ingest_lock
+
+stopping = False
+
+def stop(signum, frame):
+    global stopping
+    stopping = True
+
+def run(interval: float = FETCH_INTERVAL, once: bool = False) -> None:
+    """Fetch every interval seconds until stopped, must be called inside an app context."""
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    was_leader = False
+    try:
+        while not stopping:
+            started = time.monotonic()
+            try:
+                fetch_once()
+            except Exception as e:
+                print(f'Ingest cycle failed: {e!r}') # Keep going, the next cycle may work
+
+            if ingest_lock.is_leader != was_leader:
+                was_leader = ingest_lock.is_leader
+                print(f'{ingest_lock.node_id} is {"now" if was_leader else "no longer"} the ingest leader')
+
+            if once:
+                break
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    finally:
+        ingest_lock.release() # Let another node take over right away
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interval', type=float, default=FETCH_INTERVAL, help='Seconds between fetches')
+    parser.add_argument('--once', action='store_true', help='Run a single cycle and exit')
+    args = parser.parse_args()
+
+    app = create_app(ingest=False)
+    with app.app_context():
+        run(args.interval, args.once)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+from threading import Lock
+from typing import NamedTuple
+from sqlalchemy import select
+import sys
+import time
+from bustrackr_server import db
+from bustrackr_server.models import Journey, JourneyPattern, Route, Line, Authority
+from bustrackr_server.static_version import get_static_version
+
+# Journey -> what a map label needs, held in memory by the ingester so every live record can
+# carry its line and destination. Rebuilt whenever the static data version changes.
+
+class JourneyInfo(NamedTuple):
+    line_id: int
+    route_id: int
+    line: str
+    destination: str
+    operator: str
+
+JOURNEY_INFO_QUERY = select(
+    Journey.id,
+    Line.id,
+    Route.id,
+    Line.public_code,
+    Route.name,
+    Authority.name
+).join_from(
+    Journey, JourneyPattern,
+    Journey.journey_pattern_id == JourneyPattern.id
+).join(
+    Route,
+    JourneyPattern.route_id == Route.id
+).join(
+    Line,
+    Route.line_id == Line.id
+).outerjoin(
+    Authority,
+    Journey.operator_id == Authority.id
+).execution_options(query_name='journey_lookup', yield_per=10000)
+
+lookup_lock = Lock()
+journeys = {} # journey id -> JourneyInfo, shared between all journeys with the same info
+loaded_version = None
+stats = {
+    'journeys': 0,
+    'distinct': 0,
+    'bytes': 0,
+    'load_ms': 0.0,
+    'version': None,
+}
+
+def refresh() -> None:
+    """Load the table if the static data changed since it was loaded, needs an app context."""
+    global journeys, loaded_version
+    version = get_static_version()
+    if version == loaded_version:
+        return
+
+    start = time.perf_counter()
+    table = {}
+    distinct = {} # Thousands of journeys run the same line to the same place, keep one tuple for them
+    for journey_id, line_id, route_id, line, destination, operator in db.session.execute(JOURNEY_INFO_QUERY):
+        info = JourneyInfo(line_id, route_id, sys.intern(line or ''), sys.intern(destination or ''), sys.intern(operator or ''))
+        table[journey_id] = distinct.setdefault(info, info)
+
+    with lookup_lock:
+        journeys = table
+        loaded_version = version
+        stats.update(
+            journeys=len(table),
+            distinct=len(distinct),
+            bytes=footprint(table, distinct),
+            load_ms=(time.perf_counter() - start) * 1000,
+            version=version,
+        )
+    print(f'Loaded {len(table)} journeys ({len(distinct)} distinct) in {stats["load_ms"]:.0f} ms, ~{stats["bytes"] / 2**20:.1f} MiB')
+
+def footprint(table: dict, distinct: dict) -> int:
+    """Approximate bytes held by the table: the dict, its keys and the shared tuples with their strings."""
+    size = sys.getsizeof(table) + sum(sys.getsizeof(journey_id) for journey_id in table)
+    strings = set()
+    for info in distinct:
+        size += sys.getsizeof(info) + sys.getsizeof(info.line_id) + sys.getsizeof(info.route_id)
+        strings.update((info.line, info.destination, info.operator))
+    return size + sum(sys.getsizeof(string) for string in strings)
+
+def get(journey_id: int) -> JourneyInfo | None:
+    return journeys.get(journey_id)
+
+def get_stats() -> dict:
+    with lookup_lock:
+        return dict(stats)
@@ -0,0 +1,50 @@
+from bustrackr_server import redis_client
+import os
+import socket
+import uuid
+
+# Only compare-and-set through lua, so a node can never extend or release a lock it lost
+RENEW_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+RELEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+class LeaderLock:
+    '''Leader election through a single redis key with a TTL.
+    The leader renews the key every cycle, if it dies the key expires and another node takes over.'''
+
+    def __init__(self, name: str, ttl_ms: int):
+        self.key = f'leader:{name}'
+        self.ttl_ms = ttl_ms
+        self.node_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.is_leader = False
+
+    def acquire(self) -> bool:
+        """Become (or stay) the leader, returns True if this node is the leader."""
+        try:
+            if self.is_leader and redis_client.eval(RENEW_SCRIPT, 1, self.key, self.node_id, self.ttl_ms):
+                return True
+            self.is_leader = bool(redis_client.set(self.key, self.node_id, nx=True, px=self.ttl_ms))
+        except Exception:
+            self.is_leader = False # Without redis we cannot know, so assume someone else leads
+        return self.is_leader
+
+    def release(self) -> None:
+        if self.is_leader:
+            try:
+                redis_client.eval(RELEASE_SCRIPT, 1, self.key, self.node_id)
+            except Exception:
+                pass # It will expire
+        self.is_leader = False
+
+    def current_leader(self) -> str | None:
+        return redis_client.get(self.key)
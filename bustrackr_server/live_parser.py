@@ -1,8 +1,11 @@
-from bustrackr_server.models_redis import VehicleLive
-from bustrackr_server import redis_client, fix_redis
+from bustrackr_server import live_store, motion, trails, alerts
+from bustrackr_server import journey_lookup
+from bustrackr_server.live_store import LiveVehicle
+from bustrackr_server.redis_resilience import UNAVAILABLE_ERRORS
 import concurrent.futures as cf
 from threading import Thread
 from queue import Queue
+from typing import List
 import bs4
 from datetime import datetime
 
@@ -10,30 +13,32 @@ MAX_WORKERS = 8
 
 def parse_live_chunk(buffer):
     soup = bs4.BeautifulSoup(''.join(buffer), 'xml')
-    vehicle_live = VehicleLive(
-        service_journey_id=int(soup.find('DatedVehicleJourneyRef').text.split(':')[-1]),
+    service_journey_id = int(soup.find('DatedVehicleJourneyRef').text.split(':')[-1])
+    info = journey_lookup.get(service_journey_id)
+    vehicle_live = LiveVehicle(
+        service_journey_id=service_journey_id,
         vehicle_id=int(soup.find('VehicleRef').text),
         bearing=float(soup.find('Bearing').text),
         velocity=int(soup.find('Velocity').text),
         latitude=float(soup.find('Latitude').text),
         longitude=float(soup.find('Longitude').text),
-        timestamp=datetime.fromisoformat(soup.find('RecordedAtTime').text)
+        timestamp=datetime.fromisoformat(soup.find('RecordedAtTime').text),
+        **(info._asdict() if info else {})
     )
 
     return vehicle_live
 
-def write_to_redis(queue):
-    def write_to_the_server(vehicles):
-        try:
-            with redis_client.pipeline() as pipe:
-                for vehicle_live in vehicles:
-                    vehicle_live.save(pipeline=pipe)
-                    vehicle_live.expire(15, pipeline=pipe)
-                pipe.execute()
-        except ConnectionError:
-            fix_redis()
-            write_to_the_server(vehicles)
+def latest_fixes(vehicles: List[LiveVehicle]) -> List[LiveVehicle]:
+    """The newest fix of every (service_journey_id, vehicle_id), the feed can repeat a vehicle."""
+    latest = {}
+    for vehicle in vehicles:
+        key = (vehicle.service_journey_id, vehicle.vehicle_id)
+        kept = latest.get(key)
+        if kept is None or vehicle.timestamp > kept.timestamp:
+            latest[key] = vehicle
+    return list(latest.values())
 
+def write_to_redis(queue):
     vehicles = []
     while True:
         vehicle_live = queue.get()
@@ -41,7 +46,15 @@ def write_to_redis(queue):
             break
         vehicles.append(vehicle_live)
 
-    write_to_the_server(vehicles)
+    vehicles = motion.update(latest_fixes(vehicles))
+    try:
+        live_store.write_cycle(vehicles) # Readers see all of this cycle or none of it
+    except UNAVAILABLE_ERRORS as e: # Also raised while the breaker is open
+        # Nothing is lost by skipping, the next cycle has every vehicle again
+        print(f'Skipping a cycle of {len(vehicles)} vehicles, redis is unavailable: {e}')
+    finally: # Trails and alerts do not need the snapshot, they get the cycle even if it was not published
+        trails.append_cycle(vehicles)
+        alerts.process_cycle(vehicles)
 
 def process_data(data: str, writer_queue: Queue):
     buffer = []
@@ -76,9 +89,12 @@ def process_data(data: str, writer_queue: Queue):
             future.result() 
 
 def process_live_data(data: str):
+    '''Store a fetched cycle of live data, must be called inside an app context'''
+    journey_lookup.refresh() # Reloads after a static data import
+    alerts.refresh() # Reloads after a subscription changed
     writer_queue = Queue()
     writer_thread = Thread(target=write_to_redis, args=(writer_queue,))
     writer_thread.start()
     process_data(data, writer_queue)
     writer_queue.put(None)
-    writer_thread.join()
\ No newline at end of file
+    writer_thread.join()
@@ -0,0 +1,182 @@
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from typing import Dict, Iterable, List, NamedTuple
+import struct
+import time
+import orjson
+from bustrackr_server import redis_client
+from bustrackr_server.config import Config
+from bustrackr_server.redis_resilience import create_redis_client, count_degraded, UNAVAILABLE_ERRORS
+
+# Every ingest cycle is published as one snapshot: a binary value holding a header, a fixed width
+# record per vehicle and a table of the strings the records point into. A snapshot is written under
+# its own key, then the pointer key is flipped to it and the previous one is given a short grace
+# period, all in one MULTI. A reader reads the pointer once and gets every vehicle from that cycle,
+# never a mix. Readers decode a snapshot once and keep it in memory until the pointer moves,
+# searching it is then a loop over a few thousand tuples.
+
+CURRENT_KEY = 'live:current' # -> id of the current cycle
+CYCLE_ID_KEY = 'live:cycle_id' # Counter
+CYCLE_KEY_PREFIX = 'live:cycle:'
+CYCLE_TTL = 15 # Seconds, the live data disappears this long after the last cycle (no one watching)
+PREVIOUS_CYCLE_GRACE = 5 # Seconds a replaced cycle stays readable for requests which already read the pointer
+
+MAGIC = b'BTL4' # Bumped whenever RECORD changes
+HEADER = struct.Struct('<4sII') # magic, vehicles, bytes of the string table
+# service_journey_id, vehicle_id, bearing, velocity, latitude, longitude, timestamp (unix seconds),
+# utc offset (minutes), line_id, line, destination and operator as indexes into the string table,
+# route_id, smoothed speed (m/s) and heading (degrees). Ids are BIGINTs in the database, 16 digits.
+RECORD = struct.Struct('<qqdidddhqIIIqff') # Doubles, so the served values are exactly what was fetched
+
+binary_client = create_redis_client(decode_responses=False) # The cycles are not text
+
+class LiveVehicle(NamedTuple):
+    '''A vehicle of a snapshot: its fix, its journey and its motion'''
+    service_journey_id: int
+    vehicle_id: int
+    bearing: float
+    velocity: int
+    latitude: float
+    longitude: float
+    timestamp: datetime
+    # Looked up by the ingester (journey_lookup), 0 and '' if the journey is not in the static data
+    line_id: int = 0
+    line: str = ''
+    destination: str = ''
+    operator: str = ''
+    route_id: int = 0 # For following the route geometry (motion)
+    speed: float = 0.0 # Smoothed over the last fixes, see motion
+    heading: float = 0.0
+
+def pack_cycle(vehicles: Iterable[LiveVehicle]) -> bytes:
+    """Pack vehicles into one snapshot."""
+    strings = {'': 0}
+    records = []
+    for vehicle in vehicles:
+        offset = vehicle.timestamp.utcoffset()
+        records.append(RECORD.pack(
+            vehicle.service_journey_id,
+            vehicle.vehicle_id,
+            vehicle.bearing,
+            vehicle.velocity,
+            vehicle.latitude,
+            vehicle.longitude,
+            vehicle.timestamp.timestamp(),
+            int(offset.total_seconds() // 60) if offset is not None else 0,
+            vehicle.line_id or 0,
+            strings.setdefault(vehicle.line or '', len(strings)),
+            strings.setdefault(vehicle.destination or '', len(strings)),
+            strings.setdefault(vehicle.operator or '', len(strings)),
+            vehicle.route_id or 0,
+            vehicle.speed,
+            vehicle.heading,
+        ))
+    string_table = orjson.dumps(list(strings)) # Keys are in insertion order, so a string's index is its position
+    return HEADER.pack(MAGIC, len(records), len(string_table)) + b''.join(records) + string_table
+
+def unpack_cycle(blob: bytes) -> List[LiveVehicle]:
+    magic, count, string_bytes = HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError(f'Not a live snapshot: {magic!r}')
+    records_end = HEADER.size + count * RECORD.size
+    strings = orjson.loads(blob[records_end:records_end + string_bytes])
+    timezones = {}
+    vehicles = []
+    for (service_journey_id, vehicle_id, bearing, velocity, latitude, longitude, timestamp, offset,
+         line_id, line, destination, operator, route_id, speed, heading) in RECORD.iter_unpack(blob[HEADER.size:records_end]):
+        tz = timezones.get(offset)
+        if tz is None:
+            tz = timezones[offset] = timezone(timedelta(minutes=offset))
+        vehicles.append(LiveVehicle(
+            service_journey_id, vehicle_id, bearing, velocity, latitude, longitude,
+            datetime.fromtimestamp(timestamp, tz), line_id, strings[line], strings[destination], strings[operator],
+            route_id, speed, heading
+        ))
+    return vehicles
+
+class Cycle:
+    '''A decoded snapshot, shared by the requests which read it until the pointer moves'''
+
+    __slots__ = ('cycle_id', 'vehicles', 'lines')
+
+    def __init__(self, cycle_id: str | None, vehicles: List[LiveVehicle]):
+        self.cycle_id = cycle_id # None if nothing was ingested in the last CYCLE_TTL seconds
+        self.vehicles = vehicles
+        self.lines = None # line_id -> its vehicles, built the first time lines are looked up
+
+    def on_lines(self, line_ids: Iterable[int]) -> Dict[int, List[LiveVehicle]]:
+        """The vehicles on each of the lines."""
+        lines = self.lines
+        if lines is None:
+            lines = {}
+            for vehicle in self.vehicles:
+                lines.setdefault(vehicle.line_id, []).append(vehicle)
+            self.lines = lines # Requests racing here build the same map, either is kept
+        return {line_id: lines.get(line_id, []) for line_id in line_ids}
+
+EMPTY_CYCLE = Cycle(None, [])
+
+def write_cycle(vehicles: List[LiveVehicle]) -> int:
+    """Publish a cycle as the current one, returns its id. Only the ingest leader writes."""
+    blob = pack_cycle(vehicles)
+    cycle_id = redis_client.incr(CYCLE_ID_KEY)
+    previous = redis_client.get(CURRENT_KEY)
+    with binary_client.pipeline(transaction=True) as pipe:
+        pipe.set(f'{CYCLE_KEY_PREFIX}{cycle_id}', blob, ex=CYCLE_TTL)
+        pipe.set(CURRENT_KEY, cycle_id, ex=CYCLE_TTL)
+        if previous is not None:
+            pipe.expire(f'{CYCLE_KEY_PREFIX}{previous}', PREVIOUS_CYCLE_GRACE)
+        pipe.execute()
+    return cycle_id
+
+cycle_lock = Lock()
+cached_cycle = EMPTY_CYCLE # The last cycle this process decoded
+confirmed_at = 0.0 # When redis last said cached_cycle is current
+
+def remember_cycle(cycle: Cycle) -> None:
+    global cached_cycle, confirmed_at
+    with cycle_lock:
+        cached_cycle = cycle
+        confirmed_at = time.monotonic()
+
+def cached(cycle_id: str) -> Cycle | None:
+    """The decoded cycle if it is the one this process has, marking it as still current."""
+    global confirmed_at
+    cycle = cached_cycle
+    if cycle.cycle_id != cycle_id:
+        return None
+    confirmed_at = time.monotonic()
+    return cycle
+
+def stale_cycle() -> Cycle:
+    """What to serve while redis is unavailable: the last cycle seen, unless it is too old."""
+    count_degraded('live')
+    if time.monotonic() - confirmed_at > Config.LIVE_STALE_MAX_AGE:
+        return EMPTY_CYCLE
+    return cached_cycle
+
+def read_current_cycle() -> Cycle:
+    """The current cycle, a request should call this once and use the result throughout."""
+    try:
+        cycle_id = redis_client.get(CURRENT_KEY)
+        if cycle_id is None:
+            return EMPTY_CYCLE
+        cycle = cached(cycle_id)
+        if cycle is not None:
+            return cycle
+        blob = binary_client.get(f'{CYCLE_KEY_PREFIX}{cycle_id}')
+    except UNAVAILABLE_ERRORS:
+        return stale_cycle()
+
+    if blob is None: # Replaced and expired between the two reads, only when a request stalls for seconds
+        return EMPTY_CYCLE
+    cycle = Cycle(cycle_id, unpack_cycle(blob))
+    remember_cycle(cycle)
+    return cycle
+
+def in_box(vehicles: List[LiveVehicle], lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> List[LiveVehicle]:
+    """The vehicles strictly inside the bounding box."""
+    return [
+        vehicle for vehicle in vehicles
+        if lat_1 < vehicle.latitude < lat_0 and lon_0 < vehicle.longitude < lon_1
+    ]
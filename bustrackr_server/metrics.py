@@ -0,0 +1,243 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from typing import Dict, Iterable, List, Sequence, Tuple
+import math
+import time
+import orjson
+from flask import request
+from bustrackr_server.utils import orjson_default
+from bustrackr_server.config import Config
+from bustrackr_server.tracing import INTERNAL, Trace, record_span
+
+# Prometheus metrics of the API, served as text by /metrics.
+# Every request under /api is timed by the hooks below: its latency, status and the requests in
+# flight per route, plus how long it spent in each stage. The stages are the handler ('service', less its serialization), the database and redis calls it made and
+# the JSON serialization. Database and redis time is also recorded per query and per command,
+# wherever it is spent, ingest included. All metrics share one lock, a finished request takes it
+# once for everything it records.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0) # Seconds
+CALL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5) # Seconds, database and redis calls
+
+metrics_lock = Lock()
+registry = []
+STATS_LABELS = ('source', 'key')
+
+class Metric:
+    '''A metric family, one value (or histogram) per combination of label values'''
+
+    kind = ''
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.children = {}
+        registry.append(self)
+
+    def samples(self) -> Iterable[Tuple[str, tuple, str, float]]:
+        """(name, label values, extra labels, value) of every sample, call with metrics_lock held."""
+        raise NotImplementedError
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        """Call with metrics_lock held."""
+        self.children[labels] = self.children.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self.children.items():
+            yield self.name + '_total', labels, '', value
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def samples(self):
+        for labels, value in self.children.items():
+            yield self.name, labels, '', value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels: tuple, value: float) -> None:
+        """Call with metrics_lock held. Counts per bucket, made cumulative when rendered."""
+        child = self.children.get(labels) or self.add_child(labels)
+        child[bisect_left(self.buckets, value)] += 1
+        child[-1] += value
+
+    def add_child(self, labels: tuple) -> list:
+        child = self.children[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        return child
+
+    def samples(self):
+        for labels, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child):
+                cumulative += count
+                yield self.name + '_bucket', labels, f'le="{format_value(bound)}"', cumulative
+            yield self.name + '_sum', labels, '', child[-1]
+            yield self.name + '_count', labels, '', cumulative
+
+requests_total = Counter('bustrackr_http_requests', 'Finished API requests', ('route', 'method', 'status'))
+requests_in_flight = Gauge('bustrackr_http_requests_in_flight', 'API requests being handled', ('route',))
+request_seconds = Histogram('bustrackr_http_request_duration_seconds', 'Latency of API requests', ('route', 'method'))
+stage_seconds = Histogram('bustrackr_http_request_stage_seconds', 'Time an API request spent in each stage', ('route', 'stage'))
+db_seconds = Histogram('bustrackr_db_query_duration_seconds', 'Database queries by query_name', ('query',), CALL_BUCKETS)
+redis_seconds = Histogram('bustrackr_redis_command_duration_seconds', 'Redis commands, a pipeline is one', ('command',), CALL_BUCKETS)
+
+# The Timing of the request being handled, None outside of requests. A context variable rather
+# than flask.g, which is slow to reach and does not exist in the ASGI worker.
+current_timing: ContextVar['Timing | None'] = ContextVar('current_timing', default=None)
+
+def add_stage_time(stage: str, seconds: float) -> None:
+    timing = current_timing.get()
+    if timing is not None:
+        stages = timing.stages
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+def observe_query(name: str, seconds: float) -> None:
+    with metrics_lock:
+        db_seconds.observe((name,), seconds)
+    add_stage_time('db', seconds)
+
+def observe_redis(command: str, seconds: float) -> None:
+    with metrics_lock:
+        redis_seconds.observe((command,), seconds)
+    add_stage_time('redis', seconds)
+
+def dumps(obj) -> bytes:
+    """orjson.dumps for response bodies, timed as the serialize stage."""
+    start = time.perf_counter()
+    try:
+        return orjson.dumps(obj, default=orjson_default)
+    finally:
+        seconds = time.perf_counter() - start
+        add_stage_time('serialize', seconds)
+        record_span('serialize', seconds, {}, INTERNAL)
+
+class Timing:
+    '''The timing of one request, current_timing while it is handled'''
+
+    __slots__ = ('route', 'method', 'started', 'handler_started', 'handler_seconds', 'status', 'stages', 'trace', 'token')
+
+    def __init__(self, route: str, method: str):
+        self.route = route
+        self.method = method
+        self.started = time.perf_counter()
+        self.handler_started = self.started
+        self.handler_seconds = None
+        self.status = 500 # Unless a response is sent
+        self.stages = {}
+        self.trace = None # The Trace of the request, when tracing is on
+        self.token = current_timing.set(self)
+        in_flight = requests_in_flight.children
+        with metrics_lock:
+            in_flight[(route,)] = in_flight.get((route,), 0) + 1
+
+    def handler_done(self, status: int) -> None:
+        self.handler_seconds = time.perf_counter() - self.handler_started
+        self.status = status
+
+    def finish(self) -> None:
+        """Record the request, in the context it was started in. Every API request runs this, so
+        Counter.inc and Histogram.observe are inlined and the lock is taken once."""
+        elapsed = time.perf_counter() - self.started
+        current_timing.reset(self.token)
+        stages = self.stages
+        if self.handler_seconds is not None:
+            stages['service'] = max(0.0, self.handler_seconds - stages.get('serialize', 0.0))
+        route, method = self.route, self.method
+        status_key = (route, method, self.status)
+        totals, latencies, stage_latencies = requests_total.children, request_seconds.children, stage_seconds.children
+        with metrics_lock:
+            requests_in_flight.children[(route,)] -= 1
+            totals[status_key] = totals.get(status_key, 0) + 1
+            child = latencies.get((route, method)) or request_seconds.add_child((route, method))
+            child[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            child[-1] += elapsed
+            for stage, seconds in stages.items():
+                child = stage_latencies.get((route, stage)) or stage_seconds.add_child((route, stage))
+                child[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+                child[-1] += seconds
+
+# The Flask hooks, the only ones timing an API request (see routes/__init__.py). Every hook Flask
+# calls costs microseconds of its own, so metrics and tracing share one before_request and one
+# after_request. The route label is the URL rule, never the URL itself.
+def request_started() -> Timing:
+    """Start timing (and tracing) the request. Called by the before_request hook of api_bp."""
+    stale = current_timing.get()
+    if stale is not None: # The last handler raised with PROPAGATE_EXCEPTIONS on (debug, tests), no after_request ran
+        finish_request(stale, 500)
+    current = request._get_current_object() # One trip through the proxy instead of two
+    route = current.url_rule.rule if current.url_rule is not None else 'unmatched'
+    timing = Timing(route, current.method)
+    if Config.TRACE_ENABLED:
+        timing.trace = Trace(f'{current.method} {route}', {'http.method': current.method, 'http.route': route, 'http.target': current.full_path.rstrip('?')})
+    return timing
+
+def request_finished(response):
+    """after_request of the app, so it runs after the other after_request hooks (compression).
+    Flask also runs it for the 500 of a handler which raised, unless exceptions propagate."""
+    timing = current_timing.get()
+    if timing is not None:
+        finish_request(timing, response.status_code)
+    return response
+
+def finish_request(timing: Timing, status: int) -> None:
+    timing.handler_done(status)
+    if timing.trace is not None:
+        timing.trace.finish(status)
+    timing.finish()
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def format_labels(names: Tuple[str, ...], values: tuple, extra: str) -> str:
+    pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def flatten(prefix: str, value, into: List[Tuple[str, float]]) -> None:
+    """The numbers in a get_stats() dict as (key, value), nested keys joined with _."""
+    if isinstance(value, dict):
+        for key, child in value.items():
+            flatten(f'{prefix}_{key}' if prefix else str(key), child, into)
+    elif isinstance(value, (int, float)) and not (isinstance(value, float) and math.isnan(value)):
+        into.append((prefix, value))
+
+def render(stats: Dict[str, dict] | None = None) -> str:
+    """Every metric in the Prometheus text format, and the numbers of stats as bustrackr_stats.
+    The stats keys (some are per table, per cache...) are label values, the metric names stay fixed."""
+    lines = []
+    with metrics_lock:
+        families = [(metric, list(metric.samples())) for metric in registry]
+    for metric, samples in families:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, extra, value in samples:
+            lines.append(f'{name}{format_labels(metric.labels, labels, extra)} {format_value(value)}')
+    if stats:
+        lines.append('# HELP bustrackr_stats The numbers of /api/stats, by source and key')
+        lines.append('# TYPE bustrackr_stats gauge')
+        for source, source_stats in stats.items():
+            numbers = []
+            flatten('', source_stats, numbers)
+            for key, value in numbers:
+                lines.append(f'bustrackr_stats{format_labels(STATS_LABELS, (source, key), "")} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
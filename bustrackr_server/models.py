@@ -435,18 +435,46 @@ class FavoriteLine(db.Model):
     userID = db.Column(INTEGER, db.ForeignKey('user.id'), name='userID', nullable=False, primary_key=True)
     line_id = db.Column(BIGINT, db.ForeignKey('line.id'), name='line_id', nullable=False, primary_key=True)
 
+class AlertSubscription(db.Model):
+    '''Alert the user when a bus of a journey or a line gets within meters or minutes of a stop'''
+    __tablename__ = 'alert_subscriptions'
+    id = db.Column(BIGINT, name='id', primary_key=True, autoincrement=True)
+    userID = db.Column(INTEGER, db.ForeignKey('user.id'), name='userID', nullable=False)
+    journey_id = db.Column(BIGINT, db.ForeignKey('journey.id'), name='journey_id', nullable=True)
+    line_id = db.Column(BIGINT, db.ForeignKey('line.id'), name='line_id', nullable=True)
+    stop_id = db.Column(BIGINT, db.ForeignKey('stop.id'), name='stop_id', nullable=False)
+    meters = db.Column(INTEGER, name='meters', nullable=True)
+    minutes = db.Column(SMALLINT, name='minutes', nullable=True)
+    created = db.Column(TIMESTAMP, name='created', nullable=False, default=db.func.current_timestamp())
+
+    __table_args__ = (
+        db.CheckConstraint('(journey_id IS NULL) <> (line_id IS NULL)', name='check_alert_journey_or_line'),
+        db.CheckConstraint('meters IS NOT NULL OR minutes IS NOT NULL', name='check_alert_threshold'),
+        db.Index('ix_alert_subscriptions_user', userID),
+    )
+
 class LoginLog(db.Model):
     __tablename__ = 'login_logs'
     userID = db.Column(INTEGER, db.ForeignKey('user.id'), name='userID', nullable=False, primary_key=True)
     time = db.Column(TIMESTAMP, name='time', nullable=False, primary_key=True, default=db.func.current_timestamp())
     ip = db.Column(VARCHAR(15), name='ip', nullable=False)
 
+    # Newest login of a user
+    __table_args__ = (
+        db.Index('ix_login_logs_user_time', userID, time.desc()),
+    )
+
 class ReportLog(db.Model):
     __tablename__ = 'report_logs'
     userID = db.Column(INTEGER, db.ForeignKey('user.id'), name='userID', nullable=False, primary_key=True)
     generatedOn = db.Column(TIMESTAMP, name='generatedOn', nullable=False, primary_key=True, default=db.func.current_timestamp())
     ip = db.Column(VARCHAR(15), name='ip', nullable=False)
 
+    # Newest report of a user
+    __table_args__ = (
+        db.Index('ix_report_logs_user_generated_on', userID, generatedOn.desc()),
+    )
+
 agreement_enum = db.Enum('terms_of_service', 'data_policy', name='agreement_type')
 
 class AgreementLog(db.Model):
@@ -454,4 +482,9 @@ class AgreementLog(db.Model):
     userID = db.Column(INTEGER, db.ForeignKey('user.id'), name='userID', nullable=False, primary_key=True)
     time = db.Column(TIMESTAMP, name='time', nullable=False, primary_key=True, default=db.func.current_timestamp())
     type = db.Column(agreement_enum, name='type', nullable=False)
-    ip = db.Column(VARCHAR(15), name='ip', nullable=False)
\ No newline at end of file
+    ip = db.Column(VARCHAR(15), name='ip', nullable=False)
+
+    # Newest agreement of each type for a user
+    __table_args__ = (
+        db.Index('ix_agreement_logs_user_type_time', userID, type, time.desc()),
+    )
\ No newline at end of file
@@ -0,0 +1,139 @@
+from typing import Dict, List, NamedTuple
+import numpy
+from bustrackr_server.config import Config
+from bustrackr_server.live_store import LiveVehicle
+from bustrackr_server.route_geometry import RouteGeometry
+
+# Smoothed speed and heading of every vehicle, and positions moved forward from them.
+# The ingester keeps the last fix of every vehicle in arrays sorted by vehicle id and matches the
+# whole fleet against them once per cycle. Speed is an exponential moving average of distance over
+# time between consecutive fixes. Heading is one of the direction of travel as a unit vector, so
+# 359 and 1 average to 0, and only moves when the vehicle did (GPS noise at a stop has no
+# direction). A vehicle without history, or one that jumped faster than MOTION_MAX_SPEED, starts
+# again from standing still with its reported bearing. A fix repeated by the feed changes nothing.
+
+EARTH_RADIUS = 6371000 # Meters
+MIN_HEADING_DISTANCE = 5 # Meters between fixes before the direction counts
+
+class FleetState(NamedTuple):
+    vehicle_ids: numpy.ndarray # Sorted
+    times: numpy.ndarray # Unix seconds of the last fix
+    latitudes: numpy.ndarray
+    longitudes: numpy.ndarray
+    speeds: numpy.ndarray # Meters per second
+    heading_x: numpy.ndarray # East component of the heading
+    heading_y: numpy.ndarray # North component of the heading
+
+def empty_state() -> FleetState:
+    return FleetState(numpy.empty(0, numpy.int64), *(numpy.empty(0) for _ in range(6)))
+
+state = empty_state() # Only the ingest thread touches this, holds the vehicles of the last cycle
+
+class Position(NamedTuple):
+    latitude: float
+    longitude: float
+    heading: float
+
+def offsets(lat_0: numpy.ndarray, lon_0: numpy.ndarray, lat_1: numpy.ndarray, lon_1: numpy.ndarray):
+    """Meters east and north from the first points to the second ones."""
+    east = numpy.radians(lon_1 - lon_0) * numpy.cos(numpy.radians((lat_0 + lat_1) / 2)) * EARTH_RADIUS
+    north = numpy.radians(lat_1 - lat_0) * EARTH_RADIUS
+    return east, north
+
+def previous_of(vehicle_ids: numpy.ndarray) -> tuple:
+    """Which vehicles were in the last cycle, and their state aligned with vehicle_ids."""
+    if not len(state.vehicle_ids):
+        return numpy.zeros(len(vehicle_ids), bool), FleetState(vehicle_ids, *(numpy.zeros(len(vehicle_ids)) for _ in range(6)))
+    index = numpy.searchsorted(state.vehicle_ids, vehicle_ids).clip(max=len(state.vehicle_ids) - 1)
+    known = state.vehicle_ids[index] == vehicle_ids
+    return known, FleetState(*(column[index] for column in state))
+
+def update(vehicles: List) -> List[LiveVehicle]:
+    """The cycle's vehicles with their smoothed speed and heading, called by the ingester."""
+    global state
+    count = len(vehicles)
+    vehicle_ids = numpy.fromiter((vehicle.vehicle_id for vehicle in vehicles), numpy.int64, count)
+    times = numpy.fromiter((vehicle.timestamp.timestamp() for vehicle in vehicles), float, count)
+    latitudes = numpy.fromiter((vehicle.latitude for vehicle in vehicles), float, count)
+    longitudes = numpy.fromiter((vehicle.longitude for vehicle in vehicles), float, count)
+    bearings = numpy.radians(numpy.fromiter((vehicle.bearing for vehicle in vehicles), float, count))
+
+    known, previous = previous_of(vehicle_ids)
+    elapsed = times - previous.times
+    new_fix = known & (elapsed > 0)
+    east, north = offsets(previous.latitudes, previous.longitudes, latitudes, longitudes)
+    moved = numpy.hypot(east, north)
+    observed = numpy.where(new_fix, moved / numpy.where(new_fix, elapsed, 1), 0)
+    jumped = new_fix & (observed > Config.MOTION_MAX_SPEED)
+    tracked = new_fix & ~jumped
+    restart = ~known | jumped
+
+    weight = Config.MOTION_SMOOTHING
+    speeds = numpy.where(tracked, weight * observed + (1 - weight) * previous.speeds, previous.speeds)
+    speeds[restart] = 0
+
+    moving = tracked & (moved >= MIN_HEADING_DISTANCE)
+    direction = numpy.arctan2(east, north)
+    heading_x = numpy.where(moving, weight * numpy.sin(direction) + (1 - weight) * previous.heading_x, previous.heading_x)
+    heading_y = numpy.where(moving, weight * numpy.cos(direction) + (1 - weight) * previous.heading_y, previous.heading_y)
+    length = numpy.hypot(heading_x, heading_y)
+    restart |= length < 1e-6 # Turned exactly around, nothing to average
+    heading_x = numpy.where(restart, numpy.sin(bearings), heading_x / numpy.where(restart, 1, length))
+    heading_y = numpy.where(restart, numpy.cos(bearings), heading_y / numpy.where(restart, 1, length))
+    headings = numpy.degrees(numpy.arctan2(heading_x, heading_y)) % 360
+
+    order = numpy.argsort(vehicle_ids, kind='stable')
+    state = FleetState(*(column[order] for column in (vehicle_ids, times, latitudes, longitudes, speeds, heading_x, heading_y)))
+
+    return [
+        LiveVehicle(
+            vehicle.service_journey_id,
+            vehicle.vehicle_id,
+            vehicle.bearing,
+            vehicle.velocity,
+            vehicle.latitude,
+            vehicle.longitude,
+            vehicle.timestamp,
+            vehicle.line_id or 0,
+            vehicle.line or '',
+            vehicle.destination or '',
+            vehicle.operator or '',
+            vehicle.route_id or 0,
+            speed,
+            heading
+        )
+        for vehicle, speed, heading in zip(vehicles, speeds.tolist(), headings.tolist())
+    ]
+
+def extrapolate(vehicles: List[LiveVehicle], now: float, geometries: Dict[int, RouteGeometry]) -> List[Position]:
+    """Where the vehicles should be at now, following their route's shape when they are on it.
+    Vehicles are moved at most MOTION_MAX_EXTRAPOLATION seconds forward, never backwards."""
+    if not vehicles:
+        return []
+    count = len(vehicles)
+    latitudes = numpy.fromiter((vehicle.latitude for vehicle in vehicles), float, count)
+    longitudes = numpy.fromiter((vehicle.longitude for vehicle in vehicles), float, count)
+    times = numpy.fromiter((vehicle.timestamp.timestamp() for vehicle in vehicles), float, count)
+    speeds = numpy.fromiter((vehicle.speed for vehicle in vehicles), float, count)
+    headings = numpy.fromiter((vehicle.heading for vehicle in vehicles), float, count)
+    distances = speeds * (now - times).clip(0, Config.MOTION_MAX_EXTRAPOLATION)
+
+    # A straight line along the heading for everyone...
+    radians = numpy.radians(headings)
+    new_latitudes = latitudes + numpy.degrees(distances * numpy.cos(radians) / EARTH_RADIUS)
+    new_longitudes = longitudes + numpy.degrees(distances * numpy.sin(radians) / (EARTH_RADIUS * numpy.cos(numpy.radians(latitudes))))
+    new_headings = headings.copy()
+
+    # ...replaced by the route's shape for the vehicles on their route, one batch per route
+    route_ids = numpy.fromiter((vehicle.route_id for vehicle in vehicles), numpy.int64, count)
+    for route_id, geometry in geometries.items():
+        batch = numpy.flatnonzero((route_ids == route_id) & (distances > 0))
+        if not len(batch):
+            continue
+        route_latitudes, route_longitudes, route_headings, snapped = geometry.advance(latitudes[batch], longitudes[batch], distances[batch])
+        batch = batch[snapped]
+        new_latitudes[batch] = route_latitudes[snapped]
+        new_longitudes[batch] = route_longitudes[snapped]
+        new_headings[batch] = route_headings[snapped]
+
+    return [Position(*position) for position in zip(new_latitudes.tolist(), new_longitudes.tolist(), new_headings.tolist())]
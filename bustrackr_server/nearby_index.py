@@ -0,0 +1,62 @@
+from typing import List, Sequence, Tuple
+import math
+import numpy
+
+# scipy is optional, without it queries compare against every point (still fast for a city's buses)
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# k nearest neighbours over points on the unit sphere. Latitude and longitude are turned into 3D
+# unit vectors, so the straight line (chord) distance between two of them grows with the distance
+# along the earth everywhere, from Skåne to Kiruna, and a k-d tree over them finds the nearest
+# points without any projection error.
+
+EARTH_RADIUS = 6371000 # Meters
+
+def unit_vectors(latitudes: numpy.ndarray, longitudes: numpy.ndarray) -> numpy.ndarray:
+    lat = numpy.radians(latitudes)
+    lon = numpy.radians(longitudes)
+    return numpy.column_stack((numpy.cos(lat) * numpy.cos(lon), numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat)))
+
+def meters_to_chord(meters: float) -> float:
+    return 2 * math.sin(min(meters / EARTH_RADIUS, math.pi) / 2)
+
+def chords_to_meters(chords: numpy.ndarray) -> numpy.ndarray:
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.minimum(chords / 2, 1))
+
+class NearbyIndex:
+    '''The k nearest of a set of items to a location'''
+
+    def __init__(self, items: Sequence, latitudes: Sequence[float], longitudes: Sequence[float], use_tree: bool = True):
+        self.items = items
+        self.points = unit_vectors(numpy.asarray(latitudes, float), numpy.asarray(longitudes, float)).reshape(-1, 3)
+        self.tree = cKDTree(self.points) if use_tree and cKDTree is not None and len(self.points) else None
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def query(self, latitude: float, longitude: float, k: int, radius: float) -> List[Tuple[object, float]]:
+        """Up to k items within radius meters, nearest first, with their distance in meters."""
+        k = min(k, len(self.items))
+        if k <= 0:
+            return []
+        target = unit_vectors(numpy.array([latitude]), numpy.array([longitude]))[0]
+        max_chord = meters_to_chord(radius)
+        if self.tree is not None:
+            chords, indexes = self.tree.query(target, k=k, distance_upper_bound=max_chord)
+            chords, indexes = numpy.atleast_1d(chords), numpy.atleast_1d(indexes)
+            found = numpy.isfinite(chords) # Missing neighbours are inf
+            chords, indexes = chords[found], indexes[found]
+        else:
+            distances = numpy.linalg.norm(self.points - target, axis=1)
+            indexes = numpy.argpartition(distances, k - 1)[:k]
+            indexes = indexes[numpy.argsort(distances[indexes])]
+            chords = distances[indexes]
+            within = chords <= max_chord
+            chords, indexes = chords[within], indexes[within]
+        return [(self.items[index], distance) for index, distance in zip(indexes.tolist(), chords_to_meters(chords).tolist())]
+
+def has_tree() -> bool:
+    return cKDTree is not None
@@ -0,0 +1,150 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from threading import BoundedSemaphore, Lock
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+import multiprocessing
+import time
+from bustrackr_server.config import Config
+
+# Argon2 is slow and memory hungry on purpose, so it runs in its own processes instead of on
+# the request threads. A burst of logins then queues here (or is turned away) while the
+# rest of the API keeps its threads.
+
+class HasherBusy(Exception):
+    '''Too many hashes in flight, the client should retry after Config.HASH_RETRY_AFTER seconds'''
+
+def current_params() -> tuple:
+    return (Config.ARGON2_TIME_COST, Config.ARGON2_MEMORY_COST, Config.ARGON2_PARALLELISM)
+
+@lru_cache(maxsize=4)
+def hasher(params: tuple) -> PasswordHasher:
+    time_cost, memory_cost, parallelism = params
+    return PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+
+# These run in the pool processes
+
+def hash_in_worker(password: str, params: tuple) -> str:
+    return hasher(params).hash(password)
+
+def verify_in_worker(stored_hash: bytes | str, password: str, params: tuple) -> tuple[bool, bool]:
+    """Returns (password matches, hash should be recomputed with the current parameters)."""
+    ph = hasher(params)
+    try:
+        ph.verify(stored_hash, password)
+    except (VerificationError, InvalidHashError):
+        return (False, False)
+    return (True, ph.check_needs_rehash(stored_hash))
+
+executor: ProcessPoolExecutor = None
+executor_lock = Lock()
+admission = BoundedSemaphore(max(1, Config.HASH_WORKERS) + Config.HASH_QUEUE_DEPTH)
+
+stats_lock = Lock()
+stats = {
+    'hashed': 0,
+    'verified': 0,
+    'rejected': 0, # Turned away with HasherBusy
+    'in_flight': 0,
+    'pool_restarts': 0, # After a worker died
+    'seconds': 0.0,
+}
+
+def get_executor() -> ProcessPoolExecutor:
+    global executor
+    with executor_lock:
+        if executor is None:
+            # spawn, forking a process with running request threads is not safe
+            executor = ProcessPoolExecutor(max_workers=Config.HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return executor
+
+def reset_executor(broken: ProcessPoolExecutor) -> None:
+    """Drop a pool whose worker died, the next get_executor() starts a new one."""
+    global executor
+    with executor_lock:
+        if executor is not broken:
+            return # Another thread got here first
+        executor = None
+    with stats_lock:
+        stats['pool_restarts'] += 1
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def admit() -> float:
+    if not admission.acquire(blocking=False):
+        with stats_lock:
+            stats['rejected'] += 1
+        raise HasherBusy()
+    with stats_lock:
+        stats['in_flight'] += 1
+    return time.perf_counter()
+
+def release(start: float) -> None:
+    admission.release()
+    with stats_lock:
+        stats['in_flight'] -= 1
+        stats['seconds'] += time.perf_counter() - start
+
+def run_in_pool(func, *args):
+    pool = get_executor()
+    start = admit()
+    try:
+        future = pool.submit(func, *args)
+    except BrokenProcessPool:
+        release(start)
+        reset_executor(pool)
+        raise
+    # The slot is held until the work is done or cancelled, not just until we stop waiting for it
+    future.add_done_callback(lambda _: release(start))
+    try:
+        return future.result(timeout=Config.HASH_TIMEOUT)
+    except TimeoutError:
+        future.cancel() # Still queued, never run it. Already running, it keeps its slot until it ends.
+        with stats_lock:
+            stats['rejected'] += 1
+        raise HasherBusy()
+    except BrokenProcessPool:
+        reset_executor(pool)
+        raise
+
+def run(func, *args):
+    """Run func in the pool, or inline if HASH_WORKERS is 0. Raises HasherBusy when saturated."""
+    if Config.HASH_WORKERS == 0:
+        start = admit()
+        try:
+            return func(*args)
+        finally:
+            release(start)
+
+    try:
+        return run_in_pool(func, *args)
+    except BrokenProcessPool: # A worker died (out of memory, killed), try once more in a new pool
+        pass
+    try:
+        return run_in_pool(func, *args)
+    except BrokenProcessPool:
+        with stats_lock:
+            stats['rejected'] += 1
+        raise HasherBusy()
+
+def hash_password(password: str) -> str:
+    result = run(hash_in_worker, password, current_params())
+    with stats_lock:
+        stats['hashed'] += 1
+    return result
+
+def verify_password(stored_hash: bytes | str, password: str) -> tuple[bool, bool]:
+    """Check a password, returns (matches, needs rehash)."""
+    result = run(verify_in_worker, stored_hash, password, current_params())
+    with stats_lock:
+        stats['verified'] += 1
+    return result
+
+def get_stats() -> dict:
+    with stats_lock:
+        result = dict(stats)
+    done = result['hashed'] + result['verified']
+    result['mean_ms'] = result.pop('seconds') * 1000 / done if done else None
+    result['workers'] = Config.HASH_WORKERS
+    result['params'] = dict(zip(('time_cost', 'memory_cost', 'parallelism'), current_params()))
+    return result
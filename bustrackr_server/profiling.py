@@ -0,0 +1,195 @@
+from collections import Counter, deque
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import Dict, List
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import orjson
+import redis
+from bustrackr_server import redis_client
+from bustrackr_server.config import Config
+
+# Opt-in profiling for production, everything here is off unless PROFILE_ENABLED.
+# - A sampling CPU profiler: every PROFILE_INTERVAL_MS the stack of every thread (request threads,
+#   the ingest thread, everything but the sampler) is recorded, for a number of seconds. The result
+#   is collapsed stacks, one "thread;outer;...;inner count" line per stack, which flamegraph.pl,
+#   speedscope and inferno read. Started by GET /api/debug/profile, or by SIGUSR2, which writes
+#   PROFILE_SIGNAL_SECONDS of it to PROFILE_DIR (for the standalone ingester, which has no API).
+# - Per ingest cycle: how long it took, the RSS after it and the peak RSS during it. With
+#   PROFILE_TRACEMALLOC also the lines which allocated the most since the previous cycle. The
+#   ingester pushes these onto CYCLES_KEY, so every API worker can show them (/api/debug/ingest).
+
+CYCLES_KEY = 'profiling:cycles' # Newest first, trimmed to PROFILE_CYCLES
+
+class ProfilerBusy(Exception):
+    '''Only one CPU profile runs at a time'''
+
+profile_lock = Lock()
+
+def frame_name(code) -> str:
+    path = code.co_filename.replace('\\', '/').split('/')
+    return f'{"/".join(path[-2:])}:{code.co_name}'.replace(';', ':').replace(' ', '_')
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """Collapsed stack -> samples, of every other thread, for seconds. Raises ProfilerBusy."""
+    if not profile_lock.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        own = threading.get_ident()
+        stacks: Counter = Counter()
+        names: Dict[int, str] = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if frames.keys() - names.keys(): # A new thread, names are looked up only then
+                names = {thread.ident: thread.name.replace(';', ':').replace(' ', '_') for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            frames = frame = None # Do not keep the threads' frames alive while sleeping
+            time.sleep(interval)
+        return stacks
+    finally:
+        profile_lock.release()
+
+def collapsed(stacks: Counter) -> str:
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+def profile_cpu(seconds: float, interval_ms: float | None = None) -> str:
+    """A CPU profile of the whole process as collapsed stacks."""
+    seconds = min(seconds, Config.PROFILE_MAX_SECONDS)
+    return collapsed(sample_stacks(seconds, (interval_ms or Config.PROFILE_INTERVAL_MS) / 1000))
+
+def profile_to_file() -> None:
+    path = os.path.join(Config.PROFILE_DIR or tempfile.gettempdir(), f'cpu-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}.folded')
+    try:
+        profile = profile_cpu(Config.PROFILE_SIGNAL_SECONDS)
+    except ProfilerBusy:
+        print('A CPU profile is already running, ignoring SIGUSR2')
+        return
+    with open(path, 'w') as profile_file:
+        profile_file.write(profile)
+    print(f'CPU profile of {Config.PROFILE_SIGNAL_SECONDS:g} seconds written to {path}')
+
+def on_signal(signum, frame) -> None:
+    Thread(target=profile_to_file, name='profiler', daemon=True).start() # Never block the main thread
+
+def install() -> None:
+    """Start tracemalloc and listen for SIGUSR2, if profiling is enabled. Called by create_app."""
+    if not Config.PROFILE_ENABLED:
+        return
+    if Config.PROFILE_TRACEMALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start(Config.PROFILE_TRACEMALLOC_FRAMES)
+    if hasattr(signal, 'SIGUSR2') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR2, on_signal)
+
+# Linux resets the peak RSS (VmHWM) when 5 is written to clear_refs, elsewhere it is the peak of the process
+def reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def read_rss() -> Dict[str, float | None]:
+    """RSS and peak RSS in MB."""
+    try:
+        with open('/proc/self/status') as status:
+            fields = dict(line.split(':', 1) for line in status if line.startswith(('VmRSS', 'VmHWM')))
+        return {'rss_mb': int(fields['VmRSS'].split()[0]) / 1024, 'peak_rss_mb': int(fields['VmHWM'].split()[0]) / 1024}
+    except (OSError, KeyError, ValueError):
+        import resource # Not on Windows
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'rss_mb': None, 'peak_rss_mb': peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)}
+
+previous_snapshot: tracemalloc.Snapshot | None = None # Only the ingest thread touches this
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+]
+
+def allocation_diff() -> List[dict]:
+    """The lines which allocated the most since the previous cycle."""
+    global previous_snapshot
+    snapshot = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+    previous, previous_snapshot = previous_snapshot, snapshot
+    if previous is None:
+        return []
+    return [
+        {
+            'where': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+            'size_kb_diff': round(stat.size_diff / 1024, 1),
+            'count_diff': stat.count_diff,
+            'size_kb': round(stat.size / 1024, 1),
+        }
+        for stat in snapshot.compare_to(previous, 'lineno')[:Config.PROFILE_TOP_ALLOCATIONS]
+    ]
+
+cycles_lock = Lock()
+cycles: deque = deque(maxlen=Config.PROFILE_CYCLES) # This process's own cycles, newest last
+
+@contextmanager
+def ingest_cycle():
+    """Profile the ingest cycle run inside, if profiling is enabled."""
+    if not Config.PROFILE_ENABLED:
+        yield
+        return
+    per_cycle = reset_peak_rss()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = {
+            'time': time.time(),
+            'ms': round((time.perf_counter() - started) * 1000, 3),
+            **read_rss(),
+            'peak_is_per_cycle': per_cycle,
+        }
+        if tracemalloc.is_tracing():
+            snapshot_started = time.perf_counter()
+            record['allocations'] = allocation_diff()
+            record['traced_mb'] = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+            record['snapshot_ms'] = round((time.perf_counter() - snapshot_started) * 1000, 3)
+        with cycles_lock:
+            cycles.append(record)
+        try:
+            with redis_client.pipeline(transaction=False) as pipe:
+                pipe.lpush(CYCLES_KEY, orjson.dumps(record))
+                pipe.ltrim(CYCLES_KEY, 0, Config.PROFILE_CYCLES - 1)
+                pipe.execute()
+        except redis.exceptions.RedisError:
+            pass # Still in this process's own list
+
+def get_cycles(limit: int) -> List[dict]:
+    """The profiled ingest cycles, newest first, of the ingester wherever it runs."""
+    try:
+        shared = redis_client.lrange(CYCLES_KEY, 0, limit - 1)
+    except redis.exceptions.RedisError:
+        shared = None
+    if shared:
+        return [orjson.loads(record) for record in shared]
+    with cycles_lock:
+        return list(reversed(cycles))[:limit]
+
+def get_stats() -> dict:
+    with cycles_lock:
+        last = cycles[-1] if cycles else None
+    return {
+        'enabled': Config.PROFILE_ENABLED,
+        'tracemalloc': tracemalloc.is_tracing(),
+        'cpu_profile_running': profile_lock.locked(),
+        'last_cycle': {key: value for key, value in last.items() if key != 'allocations'} if last else None,
+    }
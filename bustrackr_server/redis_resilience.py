@@ -0,0 +1,181 @@
+from threading import Lock
+import time
+import redis
+from redis.backoff import ExponentialBackoff
+from redis.client import Pipeline
+from redis.retry import Retry
+from bustrackr_server.config import Config
+from bustrackr_server.metrics import observe_redis
+from bustrackr_server.tracing import redis_span
+
+# Every redis command goes through one circuit breaker per process. A command which fails to reach
+# redis is first retried (with backoff) by redis-py, only when the retries fail as well is it
+# counted as a failure. After REDIS_BREAKER_FAILURES of those in a row commands fail right away
+# instead of each waiting for a timeout, until a trial command after REDIS_BREAKER_RESET seconds works.
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Only these mean redis is unreachable, any other error is an answer from redis
+UNAVAILABLE_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+class CircuitOpenError(redis.exceptions.ConnectionError):
+    '''Raised instead of running a command while the breaker is open.
+    A ConnectionError, so code which handles redis being down handles this as well.'''
+
+class CircuitBreaker:
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0 # In a row
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.lock = Lock()
+        self.stats = {
+            'calls': 0,
+            'failures': 0,
+            'rejected': 0, # Calls failed right away because the breaker was open
+            'opened': 0,
+            'recoveries': 0, # Times the breaker closed again after being open
+        }
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError if the call should not be tried."""
+        with self.lock:
+            self.stats['calls'] += 1
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True # Only one trial at a time, everyone else waits for its result
+                return
+            self.stats['rejected'] += 1
+        raise CircuitOpenError(f'{self.name} is unavailable, circuit breaker is open')
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.state != CLOSED:
+                self.stats['recoveries'] += 1
+            self.state = CLOSED
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.stats['failures'] += 1
+            self.failures += 1
+            self.trial_running = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.stats['opened'] += 1
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except UNAVAILABLE_ERRORS:
+            self.record_failure()
+            raise
+        except BaseException:
+            self.record_success() # Redis answered, with an error
+            raise
+        self.record_success()
+        return result
+
+    async def call_async(self, func, *args, **kwargs):
+        """call, for the commands of the async clients (asgi.py)."""
+        self.before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except UNAVAILABLE_ERRORS:
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        except BaseException: # Cancelled before redis answered, no verdict
+            with self.lock:
+                self.trial_running = False
+            raise
+        self.record_success()
+        return result
+
+    @property
+    def is_open(self) -> bool:
+        """True while commands are being rejected (a trial may still be let through)."""
+        return self.state != CLOSED
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            result = dict(self.stats)
+            result['state'] = self.state
+            result['failures_in_a_row'] = self.failures
+            result['open_seconds'] = time.monotonic() - self.opened_at if self.state != CLOSED else 0.0
+        return result
+
+redis_breaker = CircuitBreaker('redis', Config.REDIS_BREAKER_FAILURES, Config.REDIS_BREAKER_RESET)
+
+class ResilientPipeline(Pipeline):
+    '''A pipeline is sent as one call, so it counts as one call to the breaker'''
+
+    def execute(self, raise_on_error: bool = True):
+        commands = len(self.command_stack) # Empty once executed
+        start = time.perf_counter()
+        try:
+            return redis_breaker.call(super().execute, raise_on_error)
+        finally:
+            elapsed = time.perf_counter() - start
+            observe_redis('PIPELINE', elapsed)
+            redis_span('PIPELINE', elapsed, commands)
+
+class ResilientRedis(redis.Redis):
+    '''redis.Redis with every command and pipeline going through the circuit breaker'''
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return redis_breaker.call(super().execute_command, *args, **options)
+        finally:
+            elapsed = time.perf_counter() - start
+            observe_redis(args[0], elapsed)
+            redis_span(args[0], elapsed)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> ResilientPipeline:
+        return ResilientPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+def create_redis_client(decode_responses: bool = True) -> ResilientRedis:
+    """Creating the client does not connect, the first command does."""
+    return ResilientRedis(
+        host=Config.REDIS_HOST,
+        port=Config.REDIS_PORT,
+        password=Config.REDIS_PASS,
+        db=Config.REDIS_DB,
+        decode_responses=decode_responses,
+        max_connections=Config.REDIS_MAX_CONNECTIONS,
+        socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=Config.REDIS_SOCKET_TIMEOUT,
+        socket_keepalive=True,
+        health_check_interval=Config.REDIS_HEALTH_CHECK_INTERVAL,
+        retry=Retry(ExponentialBackoff(cap=0.5, base=0.05), Config.REDIS_RETRIES),
+        retry_on_error=list(UNAVAILABLE_ERRORS),
+    )
+
+# Responses served from what this process last saw because redis was unavailable, per source
+degraded_lock = Lock()
+degraded = {}
+
+def count_degraded(source: str, served: int = 1) -> None:
+    with degraded_lock:
+        degraded[source] = degraded.get(source, 0) + served
+
+def get_stats() -> dict:
+    result = redis_breaker.get_stats()
+    with degraded_lock:
+        result['degraded'] = dict(degraded)
+    return result
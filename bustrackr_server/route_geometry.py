@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy import select, and_, bindparam, func, true
+import math
+import numpy
+from bustrackr_server import db
+from bustrackr_server.config import Config
+from bustrackr_server.db_routing import read_only
+from bustrackr_server.models import PointOnRoute, ServiceLink, Coordinate
+from bustrackr_server.static_version import get_static_version
+
+# The shape of a route, for moving a bus forward along the road instead of in a straight line.
+# The stop points of a route (point_on_route, in order) are paired with the next one, each pair
+# is the service link between them and a link's coordinates are its shape. A route is loaded the
+# first time a bus on it needs extrapolating and kept until the static data changes.
+
+EARTH_RADIUS = 6371000 # Meters
+
+# Every stop point of the requested routes with the stop point after it
+ROUTE_STOP_PAIRS = select(
+    PointOnRoute.route_id.label('route_id'),
+    PointOnRoute.order.label('order'),
+    PointOnRoute.scheduled_stop_point_id.label('point_from_id'),
+    func.lead(PointOnRoute.scheduled_stop_point_id).over(
+        partition_by=PointOnRoute.route_id,
+        order_by=PointOnRoute.order
+    ).label('point_to_id')
+).where(
+    PointOnRoute.route_id.in_(bindparam('route_ids', expanding=True))
+).subquery()
+
+# One link per pair, there can be several versions of the same link
+PAIR_LINK = select(
+    ServiceLink.id_0,
+    ServiceLink.id_1
+).where(
+    and_(
+        ServiceLink.point_from_id == ROUTE_STOP_PAIRS.c.point_from_id,
+        ServiceLink.point_to_id == ROUTE_STOP_PAIRS.c.point_to_id
+    )
+).order_by(
+    ServiceLink.to_datetime.desc().nulls_first()
+).limit(1).lateral()
+
+ROUTE_GEOMETRY_QUERY = select(
+    ROUTE_STOP_PAIRS.c.route_id.label('route_id'),
+    Coordinate.latitude.label('lat'),
+    Coordinate.longitude.label('lon')
+).select_from(
+    ROUTE_STOP_PAIRS
+).join(
+    PAIR_LINK, true()
+).join(
+    Coordinate,
+    and_(
+        Coordinate.service_link_id_0 == PAIR_LINK.c.id_0,
+        Coordinate.service_link_id_1 == PAIR_LINK.c.id_1
+    )
+).order_by(
+    ROUTE_STOP_PAIRS.c.route_id,
+    ROUTE_STOP_PAIRS.c.order,
+    Coordinate.number
+).execution_options(query_name='route_geometry')
+
+class RouteGeometry:
+    '''A route as a polyline in meters east and north of its first point'''
+
+    def __init__(self, latitudes: numpy.ndarray, longitudes: numpy.ndarray):
+        self.latitude = float(latitudes[0])
+        self.longitude = float(longitudes[0])
+        self.meters_per_lat = EARTH_RADIUS * math.pi / 180
+        self.meters_per_lon = self.meters_per_lat * math.cos(math.radians(self.latitude))
+        x = (longitudes - self.longitude) * self.meters_per_lon
+        y = (latitudes - self.latitude) * self.meters_per_lat
+        keep = numpy.concatenate(([True], (numpy.diff(x) != 0) | (numpy.diff(y) != 0))) # Links share their end points
+        x, y = x[keep], y[keep]
+        self.x = x[:-1] # Start of every segment
+        self.y = y[:-1]
+        self.dx = numpy.diff(x)
+        self.dy = numpy.diff(y)
+        self.lengths = numpy.hypot(self.dx, self.dy)
+        self.starts = numpy.concatenate(([0.0], numpy.cumsum(self.lengths)[:-1])) # Distance along the route at every segment start
+        self.total = float(self.starts[-1] + self.lengths[-1]) if len(self.lengths) else 0.0
+
+    def advance(self, latitudes: numpy.ndarray, longitudes: numpy.ndarray,
+                distances: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """Snap every point onto the route and move it the distance forward along it.
+        Returns latitudes, longitudes and headings, and which points were close enough to snap."""
+        px = ((longitudes - self.longitude) * self.meters_per_lon)[:, None]
+        py = ((latitudes - self.latitude) * self.meters_per_lat)[:, None]
+        # Closest point of every segment to every point (points x segments)
+        t = ((px - self.x) * self.dx + (py - self.y) * self.dy) / (self.lengths ** 2)
+        t = t.clip(0, 1)
+        squared = (px - (self.x + t * self.dx)) ** 2 + (py - (self.y + t * self.dy)) ** 2
+        rows = numpy.arange(len(distances))
+        closest = squared.argmin(axis=1)
+        snapped = squared[rows, closest] <= Config.ROUTE_SNAP_DISTANCE ** 2
+
+        along = self.starts[closest] + t[rows, closest] * self.lengths[closest] + distances
+        along = numpy.minimum(along, self.total) # Buses wait at the end of their route
+        segment = (numpy.searchsorted(self.starts, along, side='right') - 1).clip(0, len(self.starts) - 1)
+        fraction = ((along - self.starts[segment]) / self.lengths[segment]).clip(0, 1)
+        x = self.x[segment] + fraction * self.dx[segment]
+        y = self.y[segment] + fraction * self.dy[segment]
+        headings = numpy.degrees(numpy.arctan2(self.dx[segment], self.dy[segment])) % 360
+        return (
+            self.latitude + y / self.meters_per_lat,
+            self.longitude + x / self.meters_per_lon,
+            headings,
+            snapped
+        )
+
+def build_geometries(rows: Iterable) -> Dict[int, RouteGeometry]:
+    """Route shapes from rows of ROUTE_GEOMETRY_QUERY, routes without two distinct points are left out."""
+    points: Dict[int, List[Tuple[float, float]]] = {}
+    for row in rows:
+        points.setdefault(row.route_id, []).append((float(row.lat), float(row.lon)))
+    geometries = {}
+    for route_id, route_points in points.items():
+        coordinates = numpy.array(route_points)
+        geometry = RouteGeometry(coordinates[:, 0], coordinates[:, 1])
+        if geometry.total > 0:
+            geometries[route_id] = geometry
+    return geometries
+
+cache_lock = Lock()
+cache: OrderedDict = OrderedDict() # route id -> RouteGeometry, or None for a route without a shape, least recently used first
+cached_version = None
+stats = {
+    'hits': 0,
+    'misses': 0,
+    'routes': 0,
+}
+
+def cached(route_ids: Iterable[int]) -> Tuple[Dict[int, RouteGeometry], List[int]]:
+    """The cached shapes of the routes and the routes which still have to be loaded."""
+    global cached_version
+    version = get_static_version()
+    found = {}
+    missing = []
+    with cache_lock:
+        if version != cached_version:
+            cache.clear()
+            cached_version = version
+        for route_id in route_ids:
+            if route_id in cache:
+                cache.move_to_end(route_id)
+                if cache[route_id] is not None:
+                    found[route_id] = cache[route_id]
+            else:
+                missing.append(route_id)
+        stats['hits'] += len(found)
+        stats['misses'] += len(missing)
+    return found, missing
+
+def store(route_ids: List[int], geometries: Dict[int, RouteGeometry]) -> None:
+    with cache_lock:
+        for route_id in route_ids:
+            cache[route_id] = geometries.get(route_id) # Remember routes without a shape too
+            cache.move_to_end(route_id)
+        while len(cache) > Config.ROUTE_GEOMETRY_CACHE_SIZE:
+            cache.popitem(last=False)
+        stats['routes'] = len(cache)
+
+@read_only
+def load_geometries(route_ids: List[int]) -> Dict[int, RouteGeometry]:
+    return build_geometries(db.session.execute(ROUTE_GEOMETRY_QUERY, {'route_ids': route_ids}))
+
+def get_geometries(route_ids: Iterable[int]) -> Dict[int, RouteGeometry]:
+    """The shapes of the routes, loading the ones not cached yet in one query."""
+    found, missing = cached(route_id for route_id in set(route_ids) if route_id)
+    if missing:
+        loaded = load_geometries(missing)
+        store(missing, loaded)
+        found.update(loaded)
+    return found
+
+def get_stats() -> dict:
+    with cache_lock:
+        return dict(stats)
@@ -1,12 +1,20 @@
-from flask import Flask, Blueprint, session
+from flask import Flask, Blueprint
 from bustrackr_server.routes.quays import quays_bp
 from bustrackr_server.routes.stops import stops_bp
 from bustrackr_server.routes.stop_groups import groups_bp
 from bustrackr_server.routes.live import live_bp
+from bustrackr_server.routes.trail import trail_bp
+from bustrackr_server.routes.nearby import nearby_bp
+from bustrackr_server.routes.alerts import alerts_bp
 from bustrackr_server.routes.journey_details import journey_details_bp
 from bustrackr_server.routes.account import account_bp
+from bustrackr_server.routes.favorites import favorites_bp
+from bustrackr_server.routes.stats import stats_bp
+from bustrackr_server.routes.metrics import metrics_bp
+from bustrackr_server.routes.debug import debug_bp
+from bustrackr_server import metrics
+from bustrackr_server.activity import mark_active
 
-from threading import Timer
 import time
 
 api_bp = Blueprint('api', __name__)
@@ -14,37 +22,25 @@ api_bp.register_blueprint(quays_bp)
 api_bp.register_blueprint(stops_bp)
 api_bp.register_blueprint(groups_bp)
 api_bp.register_blueprint(live_bp)
+api_bp.register_blueprint(trail_bp)
+api_bp.register_blueprint(nearby_bp)
 api_bp.register_blueprint(journey_details_bp)
 api_bp.register_blueprint(account_bp)
-
-# TODO: Find a better place for the session stuff
-session_timers = {} # Stores all the timers
-session_states = {} # We cannot access the session outside the request context, so this is needed, simply stores TRUE if active
-
-def set_session_inactive(session_id):
-    if session_id in session_states:
-        del session_states[session_id] # The len of this is checked to see if anyone is active
-
+api_bp.register_blueprint(favorites_bp)
+api_bp.register_blueprint(alerts_bp)
+api_bp.register_blueprint(stats_bp)
+api_bp.register_blueprint(debug_bp)
+
+# The only before_request hook of api_bp, each hook Flask calls costs microseconds. Requests are
+# timed (and traced) from here until metrics.request_finished, the handler from after mark_active.
+# The API never touches the Flask session, so no response sets a cookie or varies on it.
 @api_bp.before_request
-def extend_timer():
-    global session_timers, session_states
-
-    # Check if the session has a id, else create and set as active
-    session_id = session.get('session_id')
-    if not session_id:
-        session_id = str(time.time())
-        session['session_id'] = session_id
-
-    # We want to extend the timer, cancel the last one
-    if session_id in session_timers:
-        session_timers[session_id].cancel()
-
-    session_states[session_id] = True
-
-    # Create a new timer and start it
-    timer = Timer(15, set_session_inactive, args=(session_id,))
-    session_timers[session_id] = timer
-    timer.start()
+def before_api_request():
+    timing = metrics.request_started()
+    mark_active() # Tells the ingester, which may be another process, that someone is watching
+    timing.handler_started = time.perf_counter()
 
 def register_routes(app: Flask):
-    app.register_blueprint(api_bp, url_prefix='/api')
\ No newline at end of file
+    app.register_blueprint(api_bp, url_prefix='/api')
+    app.after_request(metrics.request_finished) # Registered before compression, so it runs after it
+    app.register_blueprint(metrics_bp) # /metrics, where Prometheus looks for it
\ No newline at end of file
@@ -3,20 +3,18 @@ from flask import Blueprint, Response, make_response, request
 from functools import wraps
 import orjson
 from bustrackr_server.config import Config
-from bustrackr_server.models import User
 from bustrackr_server.utils import orjson_default
+from bustrackr_server.password_hasher import HasherBusy
 from bustrackr_server.services.authentication_service import (
     add_jwt_token,
-    get_latest_agreements,
-    get_latest_login,
-    get_latest_report,
+    get_user_summary,
     renew_jwt_token,
     validate_jwt_token,
     clear_jwt_token,
+    revoke_jwt_token,
     authenticate,
     create_user,
     update_user,
-    getUserDetails,
     change_password
 )
 import jwt
@@ -81,12 +79,14 @@ def authenticate_user():
         if not user:
             return orjson.dumps({'status': 'error', 'message': 'Invalid email or password'}), 401
 
-        response = generate_userdata_response(user, "Login successfull")
+        response = generate_userdata_response(get_user_summary(user.id), "Login successfull")
 
         add_jwt_token(response, user.id, long_expire)
 
         return response, 200
     
+    except HasherBusy:
+        return busy_response()
     except KeyError as e:
         return orjson.dumps({'status': 'error', 'message': f'Missing required field: {str(e)}'}), 400
     except Exception as e:
@@ -158,10 +158,12 @@ def register_user():
                 return orjson.dumps({'status': 'error', 'message': 'Email is already taken'}), 400
             else:
                 return orjson.dumps({'status': 'error', 'message': 'Internal server error'}), 500
+        except HasherBusy:
+            return busy_response()
         except:
             return orjson.dumps({'status': 'error', 'message': 'Internal server error'}), 500
         
-        response = generate_userdata_response(user, "Registration successful")
+        response = generate_userdata_response(get_user_summary(user.id), "Registration successful")
 
         # Add JWT token.
         add_jwt_token(response, user.id, long_expire)
@@ -178,12 +180,12 @@ def register_user():
 @token_required
 def reauthenticate_user():
     try:
-        user = getUserDetails(request.user['id'])
+        summary = get_user_summary(request.user['id'])
         
-        if not user:
+        if not summary:
             return orjson.dumps({'status': 'error', 'message': 'Invalid user.'}), 401
 
-        response = generate_userdata_response(user, "Reauthentication successful")
+        response = generate_userdata_response(summary, "Reauthentication successful")
 
         # Renew authToken.
         renew_jwt_token(response, request)
@@ -204,7 +206,8 @@ def logout_user():
             'message': 'Logout successful',
         }, default=orjson_default))
 
-        # Clear the JWT token
+        # Revoke the JWT token, clearing the cookie alone leaves copies of it valid
+        revoke_jwt_token(request)
         clear_jwt_token(response)
 
         return response, 200
@@ -321,6 +324,8 @@ def update_password():
                 return orjson.dumps({'status': 'error', 'message': 'Old password is incorrect'}), 400
             else:
                 return orjson.dumps({'status': 'error', 'message': 'Internal server error'}), 500
+        except HasherBusy:
+            return busy_response()
         except IntegrityError as e:
             return orjson.dumps({'status': 'error', 'message': 'Database error occurred'}), 500
         except Exception as e:
@@ -344,21 +349,25 @@ def update_password():
 @token_required
 def make_change():
     try:
-        response = {
+        response = make_response(orjson.dumps({
             'status': 'success',
             'message': 'Change successful',
             'changeBy': request.user['id'],
-        }
+        }, default=orjson_default))
         
         renew_jwt_token(response, request)
         
-        return orjson.dumps(response, default=orjson_default), 200
+        return response, 200
     
     except KeyError as e:
         return orjson.dumps({'status': 'error', 'message': f'Missing required field: {str(e)}'}), 400
     except Exception as e:
         return orjson.dumps({'status': 'error', 'message': 'Internal server error'}), 500
 
+def busy_response() -> Tuple[bytes, int, Dict[str, str]]:
+    """Too many logins at once, turn the client away quickly instead of queueing it."""
+    return orjson.dumps({'status': 'error', 'message': 'Server is busy, please try again shortly'}), 503, {'Retry-After': str(Config.HASH_RETRY_AFTER)}
+
 def validate_request(req: Dict[str, Any], required_fields: Dict[str, Union[type, Tuple[type, bool]]]) -> None:
     """
     Validates the request against the required fields.
@@ -394,28 +403,9 @@ def validate_request(req: Dict[str, Any], required_fields: Dict[str, Union[type,
         if convert_to_lowercase and isinstance(value, str):
             req[field] = value.lower()
 
-def generate_userdata_response(user: User, successMsg: str) -> Response:
-    agreements_dict = get_latest_agreements(user.id)
-    latest_login = get_latest_login(user.id)
-    latest_report = get_latest_report(user.id)
-
-    terms_of_service = agreements_dict.get('terms_of_service', None)
-    data_policy = agreements_dict.get('data_policy', None)
-
+def generate_userdata_response(summary: dict, successMsg: str) -> Response:
     return make_response(orjson.dumps({
         'status': 'success',
         'message': successMsg,
-        'userData': {
-            'id': user.id,
-            'username': user.username,
-            'email': user.email,
-            'date_of_birth': user.date_of_birth,
-            'registration_date': user.registration_date,
-            'latest_login': {'ip': latest_login.ip, 'timestamp': latest_login.time}
-        },
-        'agreements': {
-            'terms_of_service': {'ip': terms_of_service.ip, 'timestamp': terms_of_service.time,} if terms_of_service else None,
-            'data_policy': {'ip': data_policy.ip, 'timestamp': data_policy.time} if data_policy else None
-        },
-        'latest_report': {'ip': latest_report.ip, 'timestamp': latest_report.time,} if latest_report else None,
-    }, default=orjson_default))
\ No newline at end of file
+        **summary,
+    }, default=orjson_default))
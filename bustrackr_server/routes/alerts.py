@@ -0,0 +1,49 @@
+from flask import Blueprint, request
+import orjson
+from bustrackr_server.config import Config
+from bustrackr_server.routes.account import token_required
+from bustrackr_server.services.alerts_service import (
+    subscription_fields,
+    get_subscriptions,
+    add_subscription,
+    remove_subscription,
+    format_subscription,
+    TooManySubscriptions
+)
+
+alerts_bp = Blueprint('alerts', __name__)
+
+@alerts_bp.route('/alerts/subscriptions', methods=['GET'])
+@token_required
+def list_subscriptions():
+    return orjson.dumps({
+        'status': 'ok',
+        'type': 'alert_subscriptions',
+        'list': [format_subscription(subscription) for subscription in get_subscriptions(request.user['id'])],
+    }), 200
+
+@alerts_bp.route('/alerts/subscriptions', methods=['POST'])
+@token_required
+def create_subscription():
+    """Alert when a bus of a journey or line is within meters and/or minutes of a stop"""
+    try:
+        fields = subscription_fields(request.get_json(silent=True))
+    except ValueError as e:
+        return orjson.dumps({'status': 'error', 'message': str(e)}), 400
+    except TypeError as e:
+        return orjson.dumps({'status': 'error', 'message': str(e)}), 415
+
+    try:
+        subscription = add_subscription(request.user['id'], fields)
+    except TooManySubscriptions:
+        return orjson.dumps({'status': 'error', 'message': f'At most {Config.ALERT_MAX_SUBSCRIPTIONS} subscriptions'}), 409
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': 'No such stop, journey or line'}), 404
+    return orjson.dumps({'status': 'success', 'subscription': format_subscription(subscription)}), 201
+
+@alerts_bp.route('/alerts/subscriptions/<int:subscription_id>', methods=['DELETE'])
+@token_required
+def delete_subscription(subscription_id: int):
+    if not remove_subscription(request.user['id'], subscription_id):
+        return orjson.dumps({'status': 'error', 'message': 'No such subscription'}), 404
+    return orjson.dumps({'status': 'success', 'message': 'Subscription removed'}), 200
@@ -0,0 +1,79 @@
+from flask import Blueprint, Response, request
+from functools import wraps
+import hmac
+import orjson
+from bustrackr_server.config import Config
+from bustrackr_server.metrics import dumps
+from bustrackr_server.tracing import get_slow_traces, breakdown, export
+from bustrackr_server.profiling import ProfilerBusy, profile_cpu, get_cycles
+
+debug_bp = Blueprint('debug', __name__)
+
+def admin_required(f):
+    """
+    A decorator for the debug endpoints, the X-Admin-Token header must match ADMIN_TOKEN.
+    Without an ADMIN_TOKEN the endpoints do not exist.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not Config.ADMIN_TOKEN:
+            return orjson.dumps({'status': 'error', 'message': 'Not found'}), 404
+        token = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token.encode(), Config.ADMIN_TOKEN.encode()):
+            return orjson.dumps({'status': 'error', 'message': 'Invalid admin token'}), 403
+        return f(*args, **kwargs)
+
+    return decorated
+
+@debug_bp.route('/debug/traces', methods=['GET'])
+@admin_required
+def get_traces():
+    """The kept traces of slow requests, slowest first. format=otlp for the OTLP/JSON export."""
+    traces = get_slow_traces()
+    try:
+        limit = int(request.args.get('limit', len(traces)))
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+    traces = traces[:max(0, limit)]
+    if request.args.get('format') == 'otlp':
+        return dumps(export(traces)), 200
+    return dumps({'status': 'ok', 'type': 'traces', 'slow_ms': Config.TRACE_SLOW_MS, 'list': [breakdown(trace) for trace in traces]}), 200
+
+def profiling_required(f):
+    """Profiling is off unless PROFILE_ENABLED, for admins as well."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not Config.PROFILE_ENABLED:
+            return orjson.dumps({'status': 'error', 'message': 'Profiling is not enabled'}), 404
+        return f(*args, **kwargs)
+
+    return decorated
+
+@debug_bp.route('/debug/profile', methods=['GET'])
+@admin_required
+@profiling_required
+def get_profile():
+    """A CPU profile of every thread of this worker over seconds, as collapsed stacks (flamegraph.pl, speedscope)."""
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval_ms = float(request.args.get('interval_ms', Config.PROFILE_INTERVAL_MS))
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+    if not 0 < seconds <= Config.PROFILE_MAX_SECONDS or not 1 <= interval_ms <= 1000:
+        return orjson.dumps({'status': 'error', 'message': f'seconds must be between 0 and {Config.PROFILE_MAX_SECONDS:g}, interval_ms between 1 and 1000'}), 400
+    try:
+        profile = profile_cpu(seconds, interval_ms)
+    except ProfilerBusy:
+        return orjson.dumps({'status': 'error', 'message': 'A profile is already running'}), 409
+    return Response(profile, status=200, mimetype='text/plain')
+
+@debug_bp.route('/debug/ingest', methods=['GET'])
+@admin_required
+@profiling_required
+def get_ingest_profile():
+    """The profiled ingest cycles, newest first: duration, RSS, peak RSS and (with PROFILE_TRACEMALLOC) allocation diffs."""
+    try:
+        limit = min(max(1, int(request.args.get('limit', 10))), Config.PROFILE_CYCLES)
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+    return dumps({'status': 'ok', 'type': 'ingest_profile', 'list': get_cycles(limit)}), 200
@@ -0,0 +1,69 @@
+from flask import Blueprint, request
+from zoneinfo import ZoneInfo
+import datetime
+import orjson
+from bustrackr_server.config import Config
+from bustrackr_server.utils import orjson_default
+from bustrackr_server.live_store import read_current_cycle
+from bustrackr_server.routes.account import token_required
+from bustrackr_server.services.favorites_service import (
+    get_favorites,
+    add_favorite_stop,
+    remove_favorite_stop,
+    add_favorite_line,
+    remove_favorite_line,
+    find_favorite_line_buses,
+    find_upcoming_departures,
+    format_departures_response
+)
+
+favorites_bp = Blueprint('favorites', __name__)
+
+ADDERS = {'stops': add_favorite_stop, 'lines': add_favorite_line}
+REMOVERS = {'stops': remove_favorite_stop, 'lines': remove_favorite_line}
+
+@favorites_bp.route('/favorites', methods=['GET'])
+@token_required
+def list_favorites():
+    favorites = get_favorites(request.user['id'])
+    return orjson.dumps({
+        'status': 'ok',
+        'type': 'favorites',
+        'stops': [str(stop_id) for stop_id in favorites['stops']],
+        'lines': [str(line_id) for line_id in favorites['lines']],
+    }), 200
+
+@favorites_bp.route('/favorites/<kind>/<int:item_id>', methods=['PUT', 'DELETE'])
+@token_required
+def change_favorite(kind: str, item_id: int):
+    if kind not in ADDERS:
+        return orjson.dumps({'status': 'error', 'message': 'Favorites are either stops or lines'}), 404
+
+    if request.method == 'DELETE':
+        if not REMOVERS[kind](request.user['id'], item_id):
+            return orjson.dumps({'status': 'error', 'message': 'Not a favorite'}), 404
+        return orjson.dumps({'status': 'success', 'message': 'Favorite removed'}), 200
+
+    try:
+        ADDERS[kind](request.user['id'], item_id)
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': f'No such {kind[:-1]}'}), 404
+    return orjson.dumps({'status': 'success', 'message': 'Favorite added'}), 200
+
+@favorites_bp.route('/my-live-view', methods=['GET'])
+@token_required
+def my_live_view():
+    """Live buses on the favorite lines and the next departures from the favorite stops"""
+    favorites = get_favorites(request.user['id'])
+    now = datetime.datetime.now(ZoneInfo(Config.TIMEZONE)).replace(tzinfo=None) # Timetables are in local time
+
+    cycle = read_current_cycle()
+    lines = find_favorite_line_buses(cycle, favorites['lines']) if favorites['lines'] else {}
+    departures = find_upcoming_departures(favorites['stops'], now) if favorites['stops'] else []
+    return orjson.dumps({
+        'status': 'ok',
+        'type': 'my_live_view',
+        'cycle_id': cycle.cycle_id,
+        'lines': lines,
+        'departures': format_departures_response(departures),
+    }, default=orjson_default), 200
@@ -1,6 +1,8 @@
 from flask import Blueprint, request
 import orjson
-from bustrackr_server.utils import orjson_default
+from bustrackr_server.compression import cached_response
+from bustrackr_server.http_cache import conditional_response
+from bustrackr_server.tracing import span
 from bustrackr_server.services.journey_details_service import (
     is_info_availible,
     get_journey_info,
@@ -22,6 +24,29 @@ def get_journey_details():
     except:
         return orjson.dumps({'status': 'error', 'message': str(e)}), 500
 
+    try:
+        details_key = ('journey_details', int(req['service_journey_id']), int(req['vehicle_id']))
+    except (TypeError, ValueError):
+        return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+
+    return cached_response(details_key, lambda: build_journey_details(req))
+
+@journey_details_bp.route('/journey_details', methods=['GET'])
+def get_journey_details_cacheable():
+    try:
+        req = {
+            'service_journey_id': int(request.args['service_journey_id']),
+            'vehicle_id': int(request.args['vehicle_id']),
+        }
+    except KeyError:
+        return orjson.dumps({'status': 'error', 'message': 'Missing required fields'}), 400
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+
+    details_key = ('journey_details', req['service_journey_id'], req['vehicle_id'])
+    return conditional_response('journey_details', req, lambda: cached_response(details_key, lambda: build_journey_details(req)))
+
+def build_journey_details(req: dict) -> dict:
     journey_availible, vehicle_availible = is_info_availible(req)
 
     journey_data = None
@@ -32,8 +57,8 @@ def get_journey_details():
     if vehicle_availible:
         vehicle_data = get_vehicle_info(req)
 
-    response = format_journey_details_response(journey_data, vehicle_data)
-    return orjson.dumps(response, default=orjson_default), 200
+    with span('format_journey_details'):
+        return format_journey_details_response(journey_data, vehicle_data)
 
 
 
@@ -1,11 +1,22 @@
 from flask import Blueprint, request
 import orjson
-from bustrackr_server.utils import orjson_default
+import time
+from bustrackr_server.metrics import dumps
+from bustrackr_server.live_store import read_current_cycle
+from bustrackr_server.tile_cache import record_viewport
+from bustrackr_server.tracing import span
+from bustrackr_server.clustering import view_zoom
+from bustrackr_server.services.cluster_service import clustered, live_clusters, find_clusters, format_clusters_response
 from bustrackr_server.services.live_service import (
     process_coordinates,
     is_area_too_large,
     find_live_buses,
+    wants_as_of_now,
+    extrapolate_buses,
     format_live_buses_response,
+    format_unchanged_response,
+    view_token,
+    is_unchanged
 )
 
 live_bp = Blueprint('live', __name__)
@@ -24,15 +35,37 @@ def get_live_buses():
     
     try:
         lat_0, lon_0, lat_1, lon_1 = process_coordinates(req)
+        zoom = view_zoom(req, lon_0, lon_1)
     except ValueError:
         return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
-    
-    if is_area_too_large(lat_0, lon_0, lat_1, lon_1):
-        return orjson.dumps({'status': 'error', 'message': 'Requested area is too large'}), 422
+    try:
+        as_of_now = wants_as_of_now(req)
+    except ValueError as e:
+        return orjson.dumps({'status': 'error', 'message': str(e)}), 400
+
+    if clustered('live', req, zoom, is_area_too_large(lat_0, lon_0, lat_1, lon_1)):
+        cycle = read_current_cycle()
+        clusters = find_clusters(live_clusters(cycle), lat_0, lon_0, lat_1, lon_1, zoom)
+        return dumps(format_clusters_response('live', zoom, clusters, cycle)), 200
 
-    live_buses = find_live_buses(lat_0, lon_0, lat_1, lon_1)
-    response = format_live_buses_response(live_buses)
-    return orjson.dumps(response, default=orjson_default), 200
+    record_viewport('live_buses', lat_0, lon_0, lat_1, lon_1)
+    cycle = read_current_cycle() # Everything in the response comes from this one cycle
+    token = view_token(cycle, lat_0, lon_0, lat_1, lon_1)
+    # Extrapolated positions change with every request, so they are never unchanged
+    if not as_of_now and is_unchanged(req, token):
+        return orjson.dumps(format_unchanged_response(cycle, token)), 200
+    with span('find_live_buses'):
+        live_buses = find_live_buses(cycle, lat_0, lon_0, lat_1, lon_1)
+    if as_of_now:
+        now = time.time()
+        with span('extrapolate_buses'):
+            positions = extrapolate_buses(live_buses, now)
+        with span('format_live_buses'):
+            response = format_live_buses_response(cycle, live_buses, positions=positions, as_of=now)
+    else:
+        with span('format_live_buses'):
+            response = format_live_buses_response(cycle, live_buses, token)
+    return dumps(response), 200
 
 
 def validate_request(req: dict) -> None:
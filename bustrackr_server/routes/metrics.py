@@ -0,0 +1,9 @@
+from flask import Blueprint, Response
+from bustrackr_server.metrics import render
+from bustrackr_server.routes.stats import collect_stats
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(render(collect_stats()), status=200, content_type='text/plain; version=0.0.4; charset=utf-8')
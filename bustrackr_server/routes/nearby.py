@@ -0,0 +1,40 @@
+from flask import Blueprint, request
+import orjson
+from bustrackr_server.metrics import dumps
+from bustrackr_server.live_store import read_current_cycle
+from bustrackr_server.tracing import span
+from bustrackr_server.services.nearby_service import (
+    nearby_params,
+    static_index,
+    live_index,
+    find_nearby,
+    format_nearby_response
+)
+
+nearby_bp = Blueprint('nearby', __name__)
+
+@nearby_bp.route('/nearby', methods=['GET', 'POST'])
+def get_nearby():
+    """The k nearest stops, quays or live vehicles to a point, within a radius"""
+    try:
+        req = request.args if request.method == 'GET' else request.get_json(silent=True)
+        validate_request(req)
+        kind, lat, lon, k, radius = nearby_params(req)
+    except ValueError as e:
+        return orjson.dumps({'status': 'error', 'message': str(e)}), 400
+    except TypeError as e:
+        return orjson.dumps({'status': 'error', 'message': str(e)}), 415
+
+    cycle = read_current_cycle() if kind == 'live' else None
+    with span('find_nearby'):
+        nearby = find_nearby(live_index(cycle) if cycle is not None else static_index(kind), lat, lon, k, radius)
+    with span('format_nearby'):
+        response = format_nearby_response(kind, nearby, cycle)
+    return dumps(response), 200
+
+def validate_request(req: dict) -> None:
+    if req is None:
+        raise TypeError("Content-Type is incorrect, JSON is malformed, or empty")
+    required_fields = {'lat', 'lon'}
+    if not required_fields.issubset(req):
+        raise ValueError("Missing required fields")
@@ -1,11 +1,15 @@
 from flask import Blueprint, request
 import orjson
-from bustrackr_server.utils import orjson_default
+from bustrackr_server.metrics import dumps
+from bustrackr_server.compression import cached_response
+from bustrackr_server.http_cache import canonical_view, conditional_response
+from bustrackr_server.clustering import view_zoom
+from bustrackr_server.services.cluster_service import clustered, static_clusters_response
+from bustrackr_server.tile_cache import snap_to_tiles, record_viewport, format_tiled_response
 from bustrackr_server.services.quays_service import (
     process_coordinates,
     is_area_too_large,
-    find_quays,
-    format_quays_response,
+    find_quays_tiled,
 )
 
 quays_bp = Blueprint('quays', __name__)
@@ -22,17 +26,33 @@ def get_quays():
     except:
         return orjson.dumps({'status': 'error', 'message': 'Internal server error'}), 500
     
+    return quays_response(req)
+
+@quays_bp.route('/quays', methods=['GET'])
+def get_quays_cacheable():
+    try:
+        params = canonical_view(request.args)
+    except KeyError:
+        return orjson.dumps({'status': 'error', 'message': 'Missing required fields'}), 400
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+
+    return conditional_response('quays', params, lambda: quays_response(params))
+
+def quays_response(req: dict):
     try:
         lat_0, lon_0, lat_1, lon_1 = process_coordinates(req)
+        zoom = view_zoom(req, lon_0, lon_1)
     except ValueError:
         return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
     
-    if is_area_too_large(lat_0, lon_0, lat_1, lon_1):
-        return orjson.dumps({'status': 'error', 'message': 'Requested area is too large'}), 422
+    if clustered('quays', req, zoom, is_area_too_large(lat_0, lon_0, lat_1, lon_1)):
+        return dumps(static_clusters_response('quays', lat_0, lon_0, lat_1, lon_1, zoom)), 200
 
-    quays = find_quays(lat_0, lon_0, lat_1, lon_1)
-    response = format_quays_response(quays)
-    return orjson.dumps(response, default=orjson_default), 200
+    record_viewport('quays', lat_0, lon_0, lat_1, lon_1)
+    tiles = snap_to_tiles(lat_0, lon_0, lat_1, lon_1)
+    quays_key = ('quays', *tiles)
+    return cached_response(quays_key, lambda: format_tiled_response('quays', find_quays_tiled(tiles)))
 
 
 def validate_request(req: dict) -> None:
@@ -40,4 +60,4 @@ def validate_request(req: dict) -> None:
         raise TypeError("Content-Type is incorrect, JSON is malformed, or empty")
     required_fields = {'lat_0', 'lon_0', 'lat_1', 'lon_1'}
     if not required_fields.issubset(req):
-        raise ValueError("Missing required fields")
\ No newline at end of file
+        raise ValueError("Missing required fields")
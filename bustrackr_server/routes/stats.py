@@ -0,0 +1,57 @@
+from flask import Blueprint
+import orjson
+from bustrackr_server.utils import orjson_default
+from bustrackr_server import get_startup_stats
+from bustrackr_server.compression import get_stats as get_compression_stats
+from bustrackr_server.http_cache import get_stats as get_http_cache_stats
+from bustrackr_server.tile_cache import get_stats as get_tile_cache_stats
+from bustrackr_server.db_metrics import get_stats as get_db_stats
+from bustrackr_server.db_routing import get_stats as get_db_routing_stats
+from bustrackr_server.audit_log import get_stats as get_audit_log_stats
+from bustrackr_server.password_hasher import get_stats as get_password_hasher_stats
+from bustrackr_server.tokens import get_stats as get_token_stats
+from bustrackr_server.journey_lookup import get_stats as get_journey_lookup_stats
+from bustrackr_server.redis_resilience import get_stats as get_redis_stats
+from bustrackr_server.trails import get_stats as get_trail_stats
+from bustrackr_server.route_geometry import get_stats as get_route_geometry_stats
+from bustrackr_server.services.nearby_service import get_stats as get_nearby_stats
+from bustrackr_server.services.cluster_service import get_stats as get_cluster_stats
+from bustrackr_server.alerts import get_stats as get_alert_stats
+from bustrackr_server.tracing import get_stats as get_tracing_stats
+from bustrackr_server.profiling import get_stats as get_profiling_stats
+
+stats_bp = Blueprint('stats', __name__)
+
+# Every module's stats, also exported as gauges by /metrics
+STATS_SOURCES = {
+    'startup_ms': get_startup_stats,
+    'compression': get_compression_stats,
+    'http_cache': get_http_cache_stats,
+    'tile_cache': get_tile_cache_stats,
+    'db': get_db_stats,
+    'db_routing': get_db_routing_stats,
+    'audit_log': get_audit_log_stats,
+    'password_hasher': get_password_hasher_stats,
+    'tokens': get_token_stats,
+    'journey_lookup': get_journey_lookup_stats, # Only filled in the process which ingests
+    'redis': get_redis_stats,
+    'trails': get_trail_stats,
+    'route_geometry': get_route_geometry_stats,
+    'nearby': get_nearby_stats,
+    'clusters': get_cluster_stats,
+    'alerts': get_alert_stats,
+    'tracing': get_tracing_stats,
+    'profiling': get_profiling_stats,
+}
+
+def collect_stats() -> dict:
+    return {name: get_source_stats() for name, get_source_stats in STATS_SOURCES.items()}
+
+@stats_bp.route('/stats', methods=['GET'])
+def get_stats():
+    response = {
+        'status': 'ok',
+        'type': 'stats',
+        **collect_stats(),
+    }
+    return orjson.dumps(response, default=orjson_default), 200
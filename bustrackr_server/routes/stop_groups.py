@@ -1,10 +1,15 @@
 from flask import Blueprint, request
 import orjson
-from bustrackr_server.utils import orjson_default
+from bustrackr_server.metrics import dumps
+from bustrackr_server.compression import cached_response
+from bustrackr_server.http_cache import canonical_view, canonical_ids, conditional_response
+from bustrackr_server.clustering import view_zoom
+from bustrackr_server.services.cluster_service import clustered, static_clusters_response
+from bustrackr_server.tile_cache import snap_to_tiles, record_viewport, format_tiled_response
 from bustrackr_server.services.stop_groups_service import (
     process_coordinates,
     is_area_too_large,
-    find_groups_coords,
+    find_groups_tiled,
     find_groups_list,
     format_groups_response
 )
@@ -16,7 +21,6 @@ def stop_groups():
     try:
         req = request.get_json()
         validate_request(req)
-        req_type = req['type']
     except ValueError as e:
         return orjson.dumps({'status': 'error', 'message': str(e)}), 400
     except TypeError as e:
@@ -24,18 +28,47 @@ def stop_groups():
     except:
         return orjson.dumps({'status': 'error', 'message': 'Internal server error'}), 500
     
+    return stop_groups_response(req)
+
+@groups_bp.route('/stop_groups', methods=['GET'])
+def stop_groups_cacheable():
+    req_type = request.args.get('type')
+    try:
+        if req_type == 'list':
+            params = {'type': 'list', 'list': ','.join(str(group_id) for group_id in canonical_ids(request.args['list']))}
+        elif req_type == 'coordinates':
+            params = {'type': 'coordinates', **canonical_view(request.args)}
+        else:
+            return orjson.dumps({'status': 'error', 'message': 'Invalid request type'}), 400
+    except KeyError:
+        return orjson.dumps({'status': 'error', 'message': 'Missing required fields'}), 400
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+
+    req = {**params, 'list': canonical_ids(params['list'])} if req_type == 'list' else params
+    return conditional_response('stop_groups', params, lambda: stop_groups_response(req))
+
+def stop_groups_response(req: dict):
+    req_type = req['type']
     if req_type == 'list':
         groups = find_groups_list(req['list'])
     elif req_type == 'coordinates':
-        lat_0, lon_0, lat_1, lon_1 = process_coordinates(req)
-        if is_area_too_large(lat_0, lon_0, lat_1, lon_1):
-            return orjson.dumps({'status': 'error', 'message': 'Area is too large'}), 400
-        groups = find_groups_coords(lat_0, lon_0, lat_1, lon_1)
+        try:
+            lat_0, lon_0, lat_1, lon_1 = process_coordinates(req)
+            zoom = view_zoom(req, lon_0, lon_1)
+        except ValueError:
+            return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+        if clustered('stop_groups', req, zoom, is_area_too_large(lat_0, lon_0, lat_1, lon_1)):
+            return dumps(static_clusters_response('stop_groups', lat_0, lon_0, lat_1, lon_1, zoom)), 200
+        record_viewport('stop_groups', lat_0, lon_0, lat_1, lon_1)
+        tiles = snap_to_tiles(lat_0, lon_0, lat_1, lon_1)
+        groups_key = ('stop_groups', *tiles)
+        return cached_response(groups_key, lambda: format_tiled_response('stop_groups', find_groups_tiled(tiles)))
     else:
         return orjson.dumps({'status': 'error', 'message': 'Invalid request type'}), 400
     
     response = format_groups_response(groups)
-    return orjson.dumps(response, default=orjson_default), 200
+    return dumps(response), 200
     
 
 def validate_request(req: dict) -> None:
@@ -51,4 +84,4 @@ def validate_request(req: dict) -> None:
         if not required_fields.issubset(req):
             raise ValueError("Missing required fields")
     else:
-        raise ValueError("Invalid 'type' value")
\ No newline at end of file
+        raise ValueError("Invalid 'type' value")
@@ -1,11 +1,15 @@
 from flask import Blueprint, request
 import orjson
-from bustrackr_server.utils import orjson_default
+from bustrackr_server.metrics import dumps
+from bustrackr_server.compression import cached_response
+from bustrackr_server.http_cache import canonical_view, conditional_response
+from bustrackr_server.clustering import view_zoom
+from bustrackr_server.services.cluster_service import clustered, static_clusters_response
+from bustrackr_server.tile_cache import snap_to_tiles, record_viewport, format_tiled_response
 from bustrackr_server.services.stops_service import (
     process_coordinates,
     is_area_too_large,
-    find_stops,
-    format_stops_response
+    find_stops_tiled
 )
 
 stops_bp = Blueprint('stops', __name__)
@@ -22,21 +26,37 @@ def get_stops():
     except:
         return orjson.dumps({'status': 'error', 'message': 'Internal server error'}), 500
     
+    return stops_response(req)
+
+@stops_bp.route('/stops', methods=['GET'])
+def get_stops_cacheable():
+    try:
+        params = canonical_view(request.args)
+    except KeyError:
+        return orjson.dumps({'status': 'error', 'message': 'Missing required fields'}), 400
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+
+    return conditional_response('stops', params, lambda: stops_response(params))
+
+def stops_response(req: dict):
     try:
         lat_0, lon_0, lat_1, lon_1 = process_coordinates(req)
+        zoom = view_zoom(req, lon_0, lon_1)
     except ValueError:
         return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
     
-    if is_area_too_large(lat_0, lon_0, lat_1, lon_1):
-        return orjson.dumps({'status': 'error', 'message': 'Requested area is too large'}), 422
+    if clustered('stops', req, zoom, is_area_too_large(lat_0, lon_0, lat_1, lon_1)):
+        return dumps(static_clusters_response('stops', lat_0, lon_0, lat_1, lon_1, zoom)), 200
     
-    stops = find_stops(lat_0, lon_0, lat_1, lon_1)
-    response = format_stops_response(stops)
-    return orjson.dumps(response, default=orjson_default), 200
+    record_viewport('stops', lat_0, lon_0, lat_1, lon_1)
+    tiles = snap_to_tiles(lat_0, lon_0, lat_1, lon_1)
+    stops_key = ('stops', *tiles)
+    return cached_response(stops_key, lambda: format_tiled_response('stops', find_stops_tiled(tiles)))
 
 def validate_request(req: dict) -> None:
     if req is None:
         raise TypeError("Content-Type is incorrect, JSON is malformed, or empty")
     required_fields = {'lat_0', 'lon_0', 'lat_1', 'lon_1'}
     if not required_fields.issubset(req):
-        raise ValueError("Missing required fields")
\ No newline at end of file
+        raise ValueError("Missing required fields")
@@ -0,0 +1,29 @@
+from flask import Blueprint, request
+import math
+import orjson
+from bustrackr_server.config import Config
+from bustrackr_server.redis_resilience import UNAVAILABLE_ERRORS
+from bustrackr_server.metrics import dumps
+from bustrackr_server.trails import read_trail, format_trail_response
+
+trail_bp = Blueprint('trail', __name__)
+
+@trail_bp.route('/trail', methods=['GET'])
+def get_trail():
+    """Where a vehicle has been in the last minutes (at most TRAIL_WINDOW)"""
+    try:
+        vehicle_id = int(request.args['vehicle_id'])
+        minutes = float(request.args.get('minutes', Config.TRAIL_WINDOW / 60))
+    except KeyError:
+        return orjson.dumps({'status': 'error', 'message': 'Missing required fields'}), 400
+    except ValueError:
+        return orjson.dumps({'status': 'error', 'message': 'Invalid values'}), 400
+    if not math.isfinite(minutes) or minutes <= 0:
+        return orjson.dumps({'status': 'error', 'message': 'minutes must be a positive number'}), 400
+    seconds = min(minutes * 60, Config.TRAIL_WINDOW)
+
+    try:
+        points = read_trail(vehicle_id, seconds)
+    except UNAVAILABLE_ERRORS:
+        return orjson.dumps({'status': 'error', 'message': 'Trails are unavailable right now'}), 503
+    return dumps(format_trail_response(vehicle_id, points)), 200
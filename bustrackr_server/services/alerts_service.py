@@ -0,0 +1,87 @@
+from typing import List
+from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError
+from bustrackr_server import db
+from bustrackr_server.alerts import bump_version
+from bustrackr_server.config import Config
+from bustrackr_server.db_routing import read_only_for_user, primary, mark_written
+from bustrackr_server.models import AlertSubscription, User
+
+def subscription_fields(req: dict) -> dict:
+    """The columns of a new subscription from a request, raises ValueError if it is invalid."""
+    if req is None:
+        raise TypeError("Content-Type is incorrect, JSON is malformed, or empty")
+    if 'stop_id' not in req:
+        raise ValueError("Missing required field: 'stop_id'")
+    if (req.get('journey_id') is None) == (req.get('line_id') is None):
+        raise ValueError("Exactly one of 'journey_id' and 'line_id' is required")
+    if req.get('meters') is None and req.get('minutes') is None:
+        raise ValueError("At least one of 'meters' and 'minutes' is required")
+    try:
+        fields = {
+            'stop_id': int(req['stop_id']),
+            'journey_id': int(req['journey_id']) if req.get('journey_id') is not None else None,
+            'line_id': int(req['line_id']) if req.get('line_id') is not None else None,
+            'meters': int(req['meters']) if req.get('meters') is not None else None,
+            'minutes': int(req['minutes']) if req.get('minutes') is not None else None,
+        }
+    except (TypeError, ValueError):
+        raise ValueError('Invalid values')
+    if fields['meters'] is not None and not 0 < fields['meters'] <= Config.ALERT_MAX_METERS:
+        raise ValueError(f'meters must be between 1 and {Config.ALERT_MAX_METERS}')
+    if fields['minutes'] is not None and not 0 < fields['minutes'] <= Config.ALERT_MAX_MINUTES:
+        raise ValueError(f'minutes must be between 1 and {Config.ALERT_MAX_MINUTES}')
+    return fields
+
+@read_only_for_user
+def get_subscriptions(user_id: int) -> List[AlertSubscription]:
+    return db.session.execute(
+        select(AlertSubscription).where(AlertSubscription.userID == user_id).order_by(AlertSubscription.id)
+    ).scalars().all()
+
+class TooManySubscriptions(Exception):
+    pass
+
+@primary
+def add_subscription(user_id: int, fields: dict) -> AlertSubscription:
+    """Add a subscription, raises ValueError if what it refers to does not exist."""
+    # Locks the user's row until the commit, so concurrent adds are counted one after the other
+    db.session.execute(select(User.id).where(User.id == user_id).with_for_update())
+    existing = db.session.execute(
+        select(func.count()).select_from(AlertSubscription).where(AlertSubscription.userID == user_id)
+    ).scalar()
+    if existing >= Config.ALERT_MAX_SUBSCRIPTIONS:
+        db.session.rollback() # Releases the lock
+        raise TooManySubscriptions()
+    subscription = AlertSubscription(userID=user_id, **fields)
+    try:
+        db.session.add(subscription)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise ValueError('Not found')
+    mark_written(user_id)
+    bump_version()
+    return subscription
+
+@primary
+def remove_subscription(user_id: int, subscription_id: int) -> bool:
+    """Remove a subscription, returns False if the user has no such subscription."""
+    subscription = db.session.get(AlertSubscription, subscription_id)
+    if subscription is None or subscription.userID != user_id:
+        return False
+    db.session.delete(subscription)
+    db.session.commit()
+    mark_written(user_id)
+    bump_version()
+    return True
+
+def format_subscription(subscription: AlertSubscription) -> dict:
+    return {
+        'id': str(subscription.id),
+        'stop_id': str(subscription.stop_id),
+        'journey_id': str(subscription.journey_id) if subscription.journey_id is not None else None,
+        'line_id': str(subscription.line_id) if subscription.line_id is not None else None,
+        'meters': subscription.meters,
+        'minutes': subscription.minutes,
+    }
@@ -1,41 +1,55 @@
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, bindparam, true
 from sqlalchemy.exc import IntegrityError
 from bustrackr_server import db
+from bustrackr_server.db_routing import read_only_for_user, primary, mark_written
+from bustrackr_server.audit_log import audit_log, now
+from bustrackr_server import user_summary
+from bustrackr_server import password_hasher
+from bustrackr_server import tokens
 from bustrackr_server.models import AgreementLog, LoginLog, ReportLog, User, agreement_enum
 from bustrackr_server import Config
-from argon2 import PasswordHasher
 import jwt
 import datetime
+import uuid
 from flask import Request, Response
 
-ph = PasswordHasher()
-
 def hash_password(password: str) -> str:
-    """Hash a password using Argon2."""
-    return ph.hash(password)
+    """Hash a password using Argon2, in the hasher pool. May raise HasherBusy."""
+    return password_hasher.hash_password(password)
 
 def validate_password(stored_hash: str, password: str) -> bool:
-    """Validate the password using Argon2."""
-    try:
-        ph.verify(stored_hash, password)
-        return True
-    except Exception:
-        return False
+    """Validate the password using Argon2, in the hasher pool. May raise HasherBusy."""
+    return password_hasher.verify_password(stored_hash, password)[0]
 
+@primary
 def authenticate(email: str, password: str, ip: str) -> User:
     """Authenticate user details with database."""
     user_query = select(User).where(User.email == email)
     user = db.session.execute(user_query).scalars().first()
-    if user and validate_password(user.password_hash, password):
-        log_login(user.id, ip)
-        return user
-    return None
+    if not user:
+        return None
 
+    matches, needs_rehash = password_hasher.verify_password(user.password_hash, password)
+    if not matches:
+        return None
+
+    if needs_rehash: # The Argon2 parameters changed since the hash was made
+        try:
+            user.password_hash = hash_password(password).encode('utf-8')
+            db.session.commit()
+            mark_written(user.id)
+        except password_hasher.HasherBusy:
+            pass # The password is correct, the rehash waits for the next login
+    log_login(user.id, ip)
+    return user
+
+@read_only_for_user
 def getUserDetails(id: int) -> User:
     """Get user details from an user ID."""
     user_query = select(User).where(User.id == id)
     return db.session.execute(user_query).scalars().first()
 
+@primary
 def create_user(username: str, email: str, password: str, date_of_birth: str, ip: str) -> User:
     """Create a user in the database."""
     # Check if username or email already exists
@@ -50,72 +64,129 @@ def create_user(username: str, email: str, password: str, date_of_birth: str, ip
         hashed_password = hash_password(password)
         new_user = User(username=username, email=email, password_hash=hashed_password.encode('utf-8'), date_of_birth=date_of_birth)
         db.session.add(new_user)
+        if Config.AUDIT_SYNC_AGREEMENTS:
+            db.session.flush() # Assigns the id, the agreements are committed together with the user
+            log_agreement(new_user.id, "terms_of_service", ip, commit=False)
+            log_agreement(new_user.id, "data_policy", ip, commit=False)
         db.session.commit()        
     except IntegrityError as e:
         db.session.rollback()
         raise e
+    mark_written(new_user.id)
     
-    log_agreement(new_user.id, "terms_of_service", ip)
-    log_agreement(new_user.id, "data_policy", ip)
+    if not Config.AUDIT_SYNC_AGREEMENTS:
+        log_agreement(new_user.id, "terms_of_service", ip)
+        log_agreement(new_user.id, "data_policy", ip)
     log_login(new_user.id, ip)
     
     return new_user
     
-def log_agreement(user_id: int, agreement_type: str, ip: str) -> None:
-    """Log user agreement to the database."""
+@primary
+def log_agreement(user_id: int, agreement_type: str, ip: str, commit: bool = True) -> None:
+    """Log user agreement, queued for the audit log writer unless AUDIT_SYNC_AGREEMENTS is set."""
+    if not Config.AUDIT_SYNC_AGREEMENTS:
+        audit_log.enqueue(AgreementLog, userID=user_id, type=agreement_type, ip=ip)
+        return
+
     try:
         new_log = AgreementLog(
             userID=user_id,
             type=agreement_type,
             ip=ip,
+            time=now(),
         )
         db.session.add(new_log)
-        db.session.commit()
+        if commit:
+            db.session.commit()
     except IntegrityError as e:
         db.session.rollback()
         raise e
+    mark_written(user_id)
     
-def get_latest_login(user_id: int) -> LoginLog:
-    """Get the latest login log for a user."""
-    login_query = select(LoginLog).where(LoginLog.userID == user_id).order_by(LoginLog.time.desc())
-    return db.session.execute(login_query).scalars().first()
+def latest_log(model, time_column, name: str, *conditions):
+    """The newest row of a log table for the user in USER_SUMMARY_QUERY, served by the (userID, time DESC) indexes."""
+    return select(
+        time_column.label('time'),
+        model.ip.label('ip')
+    ).where(
+        model.userID == User.id, *conditions
+    ).order_by(time_column.desc()).limit(1).lateral(name)
+
+latest_login = latest_log(LoginLog, LoginLog.time, 'latest_login')
+latest_terms = latest_log(AgreementLog, AgreementLog.time, 'latest_terms', AgreementLog.type == 'terms_of_service')
+latest_data_policy = latest_log(AgreementLog, AgreementLog.time, 'latest_data_policy', AgreementLog.type == 'data_policy')
+latest_report = latest_log(ReportLog, ReportLog.generatedOn, 'latest_report')
+
+# Everything generate_userdata_response needs in one round trip
+USER_SUMMARY_QUERY = select(
+    User.id,
+    User.username,
+    User.email,
+    User.date_of_birth,
+    User.registration_date,
+    latest_login.c.time.label('login_time'),
+    latest_login.c.ip.label('login_ip'),
+    latest_terms.c.time.label('terms_time'),
+    latest_terms.c.ip.label('terms_ip'),
+    latest_data_policy.c.time.label('data_policy_time'),
+    latest_data_policy.c.ip.label('data_policy_ip'),
+    latest_report.c.time.label('report_time'),
+    latest_report.c.ip.label('report_ip')
+).select_from(User).outerjoin(
+    latest_login, true()
+).outerjoin(
+    latest_terms, true()
+).outerjoin(
+    latest_data_policy, true()
+).outerjoin(
+    latest_report, true()
+).where(
+    User.id == bindparam('user_id')
+).execution_options(query_name='user_summary')
+
+def log_entry(time, ip: str, pending: dict | None) -> dict | None:
+    """The stored log entry, or the queued one if that is newer."""
+    if pending is not None and (time is None or pending['time'] > time):
+        return {'ip': pending['ip'], 'timestamp': pending['time']}
+    return {'ip': ip, 'timestamp': time} if time is not None else None
+
+@read_only_for_user
+def fetch_user_summary(user_id: int) -> dict | None:
+    """Get the account data of a user from the database."""
+    row = db.session.execute(USER_SUMMARY_QUERY, {'user_id': user_id}).first()
+    if row is None:
+        return None
 
-def get_latest_agreements(user_id: int) -> dict:
-    """Get the latest terms_of_service and data_policy agreement logs for a user."""
-    terms_query = select(AgreementLog).where(
-        and_(AgreementLog.userID == user_id, AgreementLog.type == "terms_of_service")
-    ).order_by(AgreementLog.time.desc()).limit(1)
-    
-    data_policy_query = select(AgreementLog).where(
-        and_(AgreementLog.userID == user_id, AgreementLog.type == "data_policy")
-    ).order_by(AgreementLog.time.desc()).limit(1)
-    
-    terms_log = db.session.execute(terms_query).scalars().first()
-    data_policy_log = db.session.execute(data_policy_query).scalars().first()
-    
     return {
-        "terms_of_service": terms_log,
-        "data_policy": data_policy_log
+        'userData': {
+            'id': row.id,
+            'username': row.username,
+            'email': row.email,
+            'date_of_birth': row.date_of_birth,
+            'registration_date': row.registration_date,
+            'latest_login': log_entry(row.login_time, row.login_ip, audit_log.latest_pending(LoginLog, user_id))
+        },
+        'agreements': {
+            'terms_of_service': log_entry(row.terms_time, row.terms_ip, audit_log.latest_pending(AgreementLog, user_id, 'terms_of_service')),
+            'data_policy': log_entry(row.data_policy_time, row.data_policy_ip, audit_log.latest_pending(AgreementLog, user_id, 'data_policy'))
+        },
+        'latest_report': log_entry(row.report_time, row.report_ip, None),
     }
-    
-def get_latest_report(user_id: int) -> ReportLog:
-    """Get the latest report log for a user."""
-    report_query = select(ReportLog).where(ReportLog.userID == user_id).order_by(ReportLog.generatedOn.desc())
-    return db.session.execute(report_query).scalars().first()
+
+def get_user_summary(user_id: int) -> dict | None:
+    """Get the account data of a user, usually a single redis lookup."""
+    summary, generation = user_summary.get(user_id)
+    if summary is None:
+        summary = fetch_user_summary(user_id)
+        if summary is not None:
+            user_summary.put(user_id, summary, generation)
+    return summary
     
 def log_login(user_id: int, ip: str) -> None:
-    """Log user login to the database."""
-    try:
-        new_log = LoginLog(
-            userID=user_id,
-            ip=ip,
-        )
-        db.session.add(new_log)
-        db.session.commit()
-    except IntegrityError as e:
-        db.session.rollback()
-        raise e
+    """Log user login, queued for the audit log writer."""
+    audit_log.enqueue(LoginLog, userID=user_id, ip=ip)
     
+@primary
 def update_user(user_id: int, username: str , email: str, date_of_birth: str) -> User:
     """Update user details in the database."""
     user = getUserDetails(user_id)
@@ -139,11 +210,14 @@ def update_user(user_id: int, username: str , email: str, date_of_birth: str) ->
             user.date_of_birth = date_of_birth
             
         db.session.commit()
+        mark_written(user_id)
+        user_summary.invalidate(user_id)
         return user
     except IntegrityError as e:
         db.session.rollback()
         raise e
 
+@primary
 def change_password(user_id: int, old_password: str, new_password: str) -> None:
     """Change the password for a user."""
     user = getUserDetails(user_id)
@@ -157,6 +231,8 @@ def change_password(user_id: int, old_password: str, new_password: str) -> None:
         hashed_password = hash_password(new_password)
         user.password_hash = hashed_password.encode('utf-8')
         db.session.commit()
+        mark_written(user_id)
+        user_summary.invalidate(user_id)
     except IntegrityError as e:
         db.session.rollback()
         raise e
@@ -173,11 +249,14 @@ def add_jwt_token(response: Response, userID: int, long_expire: bool) -> None:
         raise TypeError('long_expire must be a boolean')
     
     token_life = datetime.timedelta(days=30) if long_expire else datetime.timedelta(hours=1)
+    issued_at = datetime.datetime.now(datetime.timezone.utc)
     
     payload = {
         'user_id': userID,
         'long_expire': long_expire,
-        'exp': datetime.datetime.now(datetime.timezone.utc) + token_life
+        'iat': issued_at,
+        'exp': issued_at + token_life,
+        'jti': uuid.uuid4().hex # Lets the token be revoked
     }
     
     token = jwt.encode(payload, Config.JWT_SECRET, algorithm='HS256')
@@ -195,39 +274,16 @@ def add_jwt_token(response: Response, userID: int, long_expire: bool) -> None:
 def renew_jwt_token(response: Response, request: Request) -> None:
     """
     Function for renewing a JWT token.
-    This function will create and return a JWT token for the authenticated user.
+    Issues a new token for the authenticated user once TOKEN_RENEW_FRACTION of the old one's life has passed.
     """
     
     if not hasattr(request, 'tokenValidated') or not request.tokenValidated:
         raise jwt.InvalidTokenError()
     
-    userID = request.user['id']
-    long_expire = request.user['long_expire']
+    if not tokens.needs_renewal(request.user['claims']):
+        return
     
-    if not isinstance(userID, int):
-        raise TypeError('userID must be an integer')
-    if not isinstance(long_expire, bool):
-        raise TypeError('long_expire must be a boolean')
-    
-    token_life = datetime.timedelta(days=30) if long_expire else datetime.timedelta(hours=1)
-    
-    payload = {
-        'user_id': userID,
-        'long_expire': long_expire,
-        'exp': datetime.datetime.now(datetime.timezone.utc) + token_life
-    }
-    
-    token = jwt.encode(payload, Config.JWT_SECRET, algorithm='HS256')
-    
-    response.set_cookie(
-        'authToken',
-        token,
-        httponly=True,
-        secure=Config.ENV != "development",
-        samesite='Strict',
-        path='/',
-        max_age=token_life.total_seconds(),
-    )
+    add_jwt_token(response, request.user['id'], request.user['long_expire'])
     
 def clear_jwt_token(response: Response) -> None:
     """
@@ -247,10 +303,15 @@ def clear_jwt_token(response: Response) -> None:
         max_age=0,
     )
 
+def revoke_jwt_token(request: Request) -> None:
+    """Revoke the token of the request, it is refused from now on even if someone kept a copy."""
+    tokens.revoke(request.user['claims'])
+
 def validate_jwt_token(request: Request, token: str) -> None:
-    secret_key = Config.JWT_SECRET
-    decoded_token = jwt.decode(token, secret_key, algorithms=['HS256'])
+    decoded_token = tokens.decode(token) # Cached until the token expires
+    if tokens.is_revoked(decoded_token):
+        raise jwt.InvalidTokenError('Token has been revoked')
             
     # Attach user information to the request context
-    request.user = { 'id': decoded_token['user_id'], 'long_expire': decoded_token['long_expire'] }
-    request.tokenValidated = True
\ No newline at end of file
+    request.user = { 'id': decoded_token['user_id'], 'long_expire': decoded_token['long_expire'], 'claims': decoded_token }
+    request.tokenValidated = True
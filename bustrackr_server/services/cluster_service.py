@@ -0,0 +1,117 @@
+from threading import Lock
+from typing import Dict, List, Tuple
+import time
+from bustrackr_server.clustering import Cluster, GridClusters
+from bustrackr_server.live_store import Cycle
+from bustrackr_server.static_version import get_static_version
+from bustrackr_server.services.nearby_service import load_static_rows
+
+# Level of detail for the map endpoints. A view zoomed out below the detail zoom of its kind, or
+# larger than the kind's area limit, gets clusters (centroid and count) instead of every point.
+# The static sets are clustered once per worker and static data version, live vehicles once per
+# cycle, both the first time someone needs them.
+
+DETAIL_ZOOM = {
+    'stops': 13,
+    'quays': 15,
+    'stop_groups': 12,
+    'live': 11,
+}
+
+RESPONSE_TYPES = {
+    'stops': 'stops',
+    'quays': 'quays',
+    'stop_groups': 'stop_groups',
+    'live': 'live_buses',
+}
+
+cluster_lock = Lock()
+build_lock = Lock() # One worker thread clusters a set, the others wait for it
+static_clusters: Dict[str, Tuple[str, GridClusters]] = {} # kind -> (static version, clusters)
+live_clusters_cache: Tuple[str | None, GridClusters | None] = (None, None)
+stats = {
+    'responses': 0,
+    'build_ms': {},
+}
+
+def clustered(kind: str, req: dict, zoom: int, area_too_large: bool) -> bool:
+    """Whether a view gets clusters. Without a zoom in the request only too large areas do,
+    as before they were an error."""
+    if area_too_large:
+        return True
+    return req.get('zoom') is not None and zoom < DETAIL_ZOOM[kind]
+
+def build_clusters(kind: str, items: List, latitudes: List[float], longitudes: List[float]) -> GridClusters:
+    start = time.perf_counter()
+    clusters = GridClusters(items, latitudes, longitudes, DETAIL_ZOOM[kind] - 1)
+    with cluster_lock:
+        stats['build_ms'][kind] = round((time.perf_counter() - start) * 1000, 3)
+    return clusters
+
+def cached_static_clusters(kind: str) -> GridClusters | None:
+    """The clusters of a static set if they are built for the current static data."""
+    cached = static_clusters.get(kind)
+    if cached is not None and cached[0] == get_static_version():
+        return cached[1]
+    return None
+
+def store_static_clusters(kind: str, rows: List) -> GridClusters:
+    version = get_static_version()
+    clusters = build_clusters(kind, rows, [float(row.lat) for row in rows], [float(row.lon) for row in rows])
+    static_clusters[kind] = (version, clusters)
+    return clusters
+
+def static_clusters_of(kind: str) -> GridClusters:
+    clusters = cached_static_clusters(kind)
+    if clusters is not None:
+        return clusters
+    with build_lock:
+        return cached_static_clusters(kind) or store_static_clusters(kind, load_static_rows(kind))
+
+def live_clusters(cycle: Cycle) -> GridClusters:
+    """The clusters of the cycle's vehicles, built once per cycle."""
+    global live_clusters_cache
+    cycle_id, clusters = live_clusters_cache
+    if clusters is not None and cycle_id == cycle.cycle_id and cycle_id is not None:
+        return clusters
+    vehicles = cycle.vehicles
+    clusters = build_clusters('live', vehicles, [vehicle.latitude for vehicle in vehicles], [vehicle.longitude for vehicle in vehicles])
+    live_clusters_cache = (cycle.cycle_id, clusters)
+    return clusters
+
+def find_clusters(clusters: GridClusters, lat_0: float, lon_0: float, lat_1: float, lon_1: float, zoom: int) -> List[Cluster]:
+    with cluster_lock:
+        stats['responses'] += 1
+    return clusters.query(lat_0, lon_0, lat_1, lon_1, zoom)
+
+def static_clusters_response(kind: str, lat_0: float, lon_0: float, lat_1: float, lon_1: float, zoom: int) -> dict:
+    return format_clusters_response(kind, zoom, find_clusters(static_clusters_of(kind), lat_0, lon_0, lat_1, lon_1, zoom))
+
+def format_clusters_response(kind: str, zoom: int, clusters: List[Cluster], cycle: Cycle | None = None) -> dict:
+    """Format the clusters into a structured dict (ready to be parsed to JSON).
+    A cluster of one point has the point's id, live vehicles are identified by vehicle_id."""
+    formatted = []
+    for cluster in clusters:
+        entry = {
+            'count': cluster.count,
+            'location': {'lat': cluster.latitude, 'lon': cluster.longitude}
+        }
+        if cluster.item is not None:
+            entry['id'] = str(cluster.item.vehicle_id if kind == 'live' else cluster.item.id)
+        formatted.append(entry)
+    response = {
+        'status': 'ok',
+        'type': RESPONSE_TYPES[kind],
+        'clustered': True,
+        'zoom': min(zoom, DETAIL_ZOOM[kind] - 1),
+        'list': formatted
+    }
+    if cycle is not None:
+        response['cycle_id'] = cycle.cycle_id
+    return response
+
+def get_stats() -> dict:
+    with cluster_lock:
+        result = dict(stats)
+        result['build_ms'] = dict(stats['build_ms'])
+    return result
@@ -0,0 +1,172 @@
+from typing import Dict, List
+from sqlalchemy import select, and_, or_, any_, bindparam, case, func, Row
+from sqlalchemy.dialects.postgresql import ARRAY, BIGINT
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.types import Boolean, Integer
+import datetime
+from bustrackr_server import db
+from bustrackr_server.config import Config
+from bustrackr_server.db_routing import read_only, read_only_for_user, primary, mark_written
+from bustrackr_server.live_store import Cycle
+from bustrackr_server.services.live_service import format_live_bus
+from bustrackr_server.models import (
+    FavoriteStop,
+    FavoriteLine,
+    Journey,
+    JourneyTime,
+    JourneyPattern,
+    Route,
+    Line,
+    PointOnRoute,
+    PassengerStop,
+    Quay,
+    Stop,
+    DayType
+)
+
+@read_only_for_user
+def get_favorites(user_id: int) -> Dict[str, List[int]]:
+    """Get the ids of the favorite stops and lines of a user."""
+    stops = db.session.execute(select(FavoriteStop.stop_id).where(FavoriteStop.userID == user_id)).scalars().all()
+    lines = db.session.execute(select(FavoriteLine.line_id).where(FavoriteLine.userID == user_id)).scalars().all()
+    return {'stops': list(stops), 'lines': list(lines)}
+
+@primary
+def add_favorite(user_id: int, model, **ids) -> None:
+    """Add a favorite, raises ValueError if what it refers to does not exist."""
+    if db.session.get(model, {'userID': user_id, **ids}) is not None:
+        return # Already a favorite
+    try:
+        db.session.add(model(userID=user_id, **ids))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise ValueError('Not found')
+    mark_written(user_id)
+
+@primary
+def remove_favorite(user_id: int, model, **ids) -> bool:
+    """Remove a favorite, returns False if it was not one."""
+    favorite = db.session.get(model, {'userID': user_id, **ids})
+    if favorite is None:
+        return False
+    db.session.delete(favorite)
+    db.session.commit()
+    mark_written(user_id)
+    return True
+
+def add_favorite_stop(user_id: int, stop_id: int) -> None:
+    add_favorite(user_id, FavoriteStop, stop_id=stop_id)
+
+def remove_favorite_stop(user_id: int, stop_id: int) -> bool:
+    return remove_favorite(user_id, FavoriteStop, stop_id=stop_id)
+
+def add_favorite_line(user_id: int, line_id: int) -> None:
+    add_favorite(user_id, FavoriteLine, line_id=line_id)
+
+def remove_favorite_line(user_id: int, line_id: int) -> bool:
+    return remove_favorite(user_id, FavoriteLine, line_id=line_id)
+
+def find_favorite_line_buses(cycle: Cycle, line_ids: List[int]) -> Dict[str, List[dict]]:
+    """Live buses of a cycle on each of the lines"""
+    return {
+        str(line_id): [format_live_bus(bus) for bus in buses]
+        for line_id, buses in cycle.on_lines(line_ids).items()
+    }
+
+departure_time = JourneyTime.departure_time
+after_midnight = departure_time < bindparam('from_time') # Only in the window when it wraps
+
+# Departures from the stops in the next DEPARTURES_WINDOW minutes, on journeys running the day they
+# depart on. If the window passes midnight (wraps) the times after from_time and before to_time are
+# both in it, and those before from_time depart tomorrow. Ranked per stop, soonest first.
+RANKED_DEPARTURES = select(
+    Stop.id.label('stop_id'),
+    Journey.id.label('journey_id'),
+    Line.id.label('line_id'),
+    Line.public_code.label('line'),
+    Route.name.label('destination'),
+    departure_time.label('departure_time'),
+    func.row_number().over(partition_by=Stop.id, order_by=(after_midnight, departure_time)).label('rank')
+).join_from(
+    JourneyTime, PointOnRoute,
+    JourneyTime.jpsp_point_on_route_id == PointOnRoute.id
+).join(
+    PassengerStop,
+    PointOnRoute.scheduled_stop_point_id == PassengerStop.scheduled_stop_point_id
+).join(
+    Quay,
+    PassengerStop.quay_id == Quay.id
+).join(
+    Stop,
+    Quay.stop_id == Stop.id
+).join(
+    Journey,
+    JourneyTime.journey_id == Journey.id
+).join(
+    DayType,
+    Journey.day_type_id == DayType.id
+).join(
+    JourneyPattern,
+    Journey.journey_pattern_id == JourneyPattern.id
+).join(
+    Route,
+    JourneyPattern.route_id == Route.id
+).join(
+    Line,
+    Route.line_id == Line.id
+).where(
+    and_(
+        Stop.id == any_(bindparam('stop_ids', type_=ARRAY(BIGINT))),
+        DayType.days.op('&')(case(
+            (after_midnight, bindparam('tomorrow_bit', type_=Integer)),
+            else_=bindparam('today_bit', type_=Integer)
+        )) != 0,
+        or_(
+            and_(departure_time >= bindparam('from_time'), departure_time < bindparam('to_time')),
+            and_(bindparam('wraps', type_=Boolean), or_(departure_time >= bindparam('from_time'), departure_time < bindparam('to_time')))
+        )
+    )
+).subquery('ranked_departures')
+
+# At most DEPARTURES_LIMIT per stop, a busy stop does not crowd out the others
+UPCOMING_DEPARTURES_QUERY = select(
+    RANKED_DEPARTURES.c.stop_id,
+    RANKED_DEPARTURES.c.journey_id,
+    RANKED_DEPARTURES.c.line_id,
+    RANKED_DEPARTURES.c.line,
+    RANKED_DEPARTURES.c.destination,
+    RANKED_DEPARTURES.c.departure_time
+).where(
+    RANKED_DEPARTURES.c.rank <= bindparam('limit', type_=Integer)
+).order_by(
+    RANKED_DEPARTURES.c.stop_id,
+    RANKED_DEPARTURES.c.rank
+).execution_options(query_name='upcoming_departures')
+
+@read_only
+def find_upcoming_departures(stop_ids: List[int], now: datetime.datetime) -> List[Row]:
+    """Fetch the next departures from the stops"""
+    end = now + datetime.timedelta(minutes=Config.DEPARTURES_WINDOW)
+    return db.session.execute(UPCOMING_DEPARTURES_QUERY, {
+        'stop_ids': stop_ids,
+        'today_bit': 1 << now.weekday(), # Monday is bit 0
+        'tomorrow_bit': 1 << (now.weekday() + 1) % 7,
+        'from_time': now.time(),
+        'to_time': end.time(),
+        'wraps': end.date() != now.date(),
+        'limit': Config.DEPARTURES_LIMIT,
+    }).fetchall()
+
+def format_departures_response(departures: List[Row]) -> Dict[str, List[dict]]:
+    """Departures grouped by stop, at most DEPARTURES_LIMIT per stop"""
+    by_stop = {}
+    for departure in departures:
+        by_stop.setdefault(str(departure.stop_id), []).append({
+            'journey_id': str(departure.journey_id),
+            'line_id': str(departure.line_id),
+            'line': departure.line,
+            'destination': departure.destination,
+            'time': departure.departure_time.isoformat(),
+        })
+    return by_stop
@@ -1,6 +1,7 @@
 from typing import List, Tuple
-from sqlalchemy import select, Row
+from sqlalchemy import select, bindparam, Row
 from bustrackr_server import db
+from bustrackr_server.db_routing import read_only
 from bustrackr_server.models import (
     Journey,
     Vehicle,
@@ -15,86 +16,96 @@ from bustrackr_server.models import (
     Authority
 )
 
-def is_info_availible(req: dict) -> Tuple[bool, bool]:
-    find_journey_query = select(
-        Journey.id
-    ).select_from(Journey).where(
-        Journey.id == int(req['service_journey_id'])
-    )
+# The queries are built once and executed as server side prepared statements
+
+FIND_JOURNEY_QUERY = select(
+    Journey.id
+).select_from(Journey).where(
+    Journey.id == bindparam('service_journey_id')
+).execution_options(query_name='find_journey')
+
+FIND_VEHICLE_QUERY = select(
+    Vehicle.id
+).select_from(Vehicle).where(
+    Vehicle.id == bindparam('vehicle_id')
+).execution_options(query_name='find_vehicle')
+
+JOURNEY_INFO_QUERY = select(
+    Journey.id.label('journey_id'),
+    Line.public_code.label('line'),
+    Route.name.label('destination'),
+    PointOnRoute.order.label('stop_nr'),
+    Stop.id.label('stop_id'),
+    Stop.name.label('stop_name')
+).join_from(
+    Journey, JourneyPattern,
+    Journey.journey_pattern_id == JourneyPattern.id
+).join(
+    Route,
+    JourneyPattern.route_id == Route.id
+).join(
+    Line,
+    Route.line_id == Line.id
+).join(
+    PointOnRoute,
+    Route.id == PointOnRoute.route_id
+).join(
+    PassengerStop,
+    PointOnRoute.scheduled_stop_point_id == PassengerStop.scheduled_stop_point_id
+).join(
+    Quay,
+    PassengerStop.quay_id == Quay.id
+).join(
+    Stop,
+    Quay.stop_id == Stop.id
+).where(
+    Journey.id == bindparam('service_journey_id')
+).order_by(
+    PointOnRoute.order
+).execution_options(query_name='journey_info')
+
+VEHICLE_INFO_QUERY = select(
+    Vehicle.id.label('id'),
+    VehicleType.manufacturer.label('manufacturer'),
+    VehicleType.model_year.label('model_year'),
+    VehicleType.capacity_seated.label('seated'),
+    VehicleType.capacity_standing.label('standing'),
+    VehicleType.capacity_pushchair.label('pushchair'),
+    VehicleType.capacity_wheelchair.label('wheelchair'),
+    Authority.name.label('operator')
+).join_from(
+    Vehicle, VehicleType,
+    Vehicle.vehicle_type_id == VehicleType.id
+).join(
+    Authority,
+    Vehicle.operator_id == Authority.id
+).where(
+    Vehicle.id == bindparam('vehicle_id')
+).execution_options(query_name='vehicle_info')
 
-    find_vehicle_query = select(
-        Vehicle.id
-    ).select_from(Vehicle).where(
-        Vehicle.id == int(req['vehicle_id'])
-    )
+def journey_params(req: dict) -> dict:
+    """Parameters for the prepared journey detail queries."""
+    return {'service_journey_id': int(req['service_journey_id']), 'vehicle_id': int(req['vehicle_id'])}
 
-    journey_result = db.session.execute(find_journey_query).one_or_none()
-    vehicle_result = db.session.execute(find_vehicle_query).one_or_none()
+@read_only
+def is_info_availible(req: dict) -> Tuple[bool, bool]:
+    params = journey_params(req)
+    journey_result = db.session.execute(FIND_JOURNEY_QUERY, params).one_or_none()
+    vehicle_result = db.session.execute(FIND_VEHICLE_QUERY, params).one_or_none()
 
     journey_exists = True if journey_result else False
     vehicle_exists = True if vehicle_result else False
 
     return (journey_exists, vehicle_exists)
 
+@read_only
 def get_journey_info(req: dict) -> List:
     """Fetches relevant information regarding the journey from the database"""
-    journey_info_query = select(
-        Journey.id.label('journey_id'),
-        Line.public_code.label('line'),
-        Route.name.label('destination'),
-        PointOnRoute.order.label('stop_nr'),
-        Stop.id.label('stop_id'),
-        Stop.name.label('stop_name')
-    ).join_from(
-        Journey, JourneyPattern,
-        Journey.journey_pattern_id == JourneyPattern.id
-    ).join(
-        Route,
-        JourneyPattern.route_id == Route.id
-    ).join(
-        Line,
-        Route.line_id == Line.id
-    ).join(
-        PointOnRoute,
-        Route.id == PointOnRoute.route_id
-    ).join(
-        PassengerStop,
-        PointOnRoute.scheduled_stop_point_id == PassengerStop.scheduled_stop_point_id
-    ).join(
-        Quay,
-        PassengerStop.quay_id == Quay.id
-    ).join(
-        Stop,
-        Quay.stop_id == Stop.id
-    ).where(
-        Journey.id == int(req['service_journey_id'])
-    ).order_by(
-        PointOnRoute.order
-    )
-
-    return db.session.execute(journey_info_query).fetchall()
+    return db.session.execute(JOURNEY_INFO_QUERY, journey_params(req)).fetchall()
 
+@read_only
 def get_vehicle_info(req: dict) -> Row | None:
-    vehicle_info_query = select(
-        Vehicle.id.label('id'),
-        VehicleType.manufacturer.label('manufacturer'),
-        VehicleType.model_year.label('model_year'),
-        VehicleType.capacity_seated.label('seated'),
-        VehicleType.capacity_standing.label('standing'),
-        VehicleType.capacity_pushchair.label('pushchair'),
-        VehicleType.capacity_wheelchair.label('wheelchair'),
-        Authority.name.label('operator')
-    ).join_from(
-        Vehicle, VehicleType,
-        Vehicle.vehicle_type_id == VehicleType.id
-    ).join(
-        Authority,
-        Vehicle.operator_id == Authority.id
-    ).where(
-        Vehicle.id == int(req['vehicle_id'])
-    )
-
-    return db.session.execute(vehicle_info_query).first()
+    return db.session.execute(VEHICLE_INFO_QUERY, journey_params(req)).first()
 
 def format_journey_details_response(journey_data: List | None, vehicle_data: Row | None) -> dict:
     """Format the database results into a structured dict (ready to be parsed to JSON)"""
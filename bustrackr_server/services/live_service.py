@@ -1,7 +1,10 @@
-from typing import List, Tuple
-from bustrackr_server.models_redis import VehicleLive
-from bustrackr_server import fix_redis
-from threading import Timer
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+import time
+import zlib
+from bustrackr_server import live_store, motion, route_geometry
+from bustrackr_server.live_store import Cycle
+from bustrackr_server.route_geometry import RouteGeometry
 
 def process_coordinates(req: dict) -> Tuple[float, float, float, float]:
     """Process and slightly adjust input coordinates."""
@@ -18,43 +21,77 @@ def is_area_too_large(lat_0: float, lon_0: float, lat_1: float, lon_1: float) ->
     area = lat_len * lon_len
     return area > 0.125
 
-def find_live_buses(lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> List:
-    """Fetch live buses from redis based on input coordinates"""
-    try:
-        buses = VehicleLive.find(
-            (VehicleLive.latitude > lat_1) & (VehicleLive.latitude < lat_0) &  
-            (VehicleLive.longitude > lon_0) & (VehicleLive.longitude < lon_1)
-        ).all() # The resulting query is not optimized, but it works
-    except ConnectionError:
-        print('Redis seems to have crashed, try flushing etc')
-        Timer(1, fix_redis).start()
-        return []
-    return buses
-
-def format_live_buses_response(live_buses_in_area: List) -> dict:
-    """Format the redis results into a structured dict (ready to be parsed to JSON)"""
-    latest_entries = {}
-    
-    # Filter to only keep the latest entry of every bus
-    for bus in live_buses_in_area:
-        key = (bus.service_journey_id, bus.vehicle_id)
-        if key not in latest_entries or bus.timestamp > latest_entries[key].timestamp:
-            latest_entries[key] = bus
-
-    live_buses_in_area = list(latest_entries.values())
-    
+def wants_as_of_now(req: dict) -> bool:
+    """Whether the client asked for positions moved forward to the time of the response."""
+    as_of = req.get('as_of')
+    if as_of is None:
+        return False
+    if as_of != 'now':
+        raise ValueError("as_of must be 'now'")
+    return True
+
+def view_token(cycle: Cycle, lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> str | None:
+    """The cycle and the area of a response. A client sending it back as token gets unchanged only if both are the same."""
+    if cycle.cycle_id is None:
+        return None
+    area = zlib.crc32(f'{lat_0!r},{lon_0!r},{lat_1!r},{lon_1!r}'.encode()) # The same in every worker, unlike hash()
+    return f'{cycle.cycle_id}:{area:08x}'
+
+def is_unchanged(req: dict, token: str | None) -> bool:
+    return token is not None and req.get('token') == token
+
+def find_live_buses(cycle: Cycle, lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> List:
+    """Live buses of a cycle inside the input coordinates"""
+    return live_store.in_box(cycle.vehicles, lat_0, lon_0, lat_1, lon_1)
+
+def extrapolate_buses(buses: List, now: float, geometries: Dict[int, RouteGeometry] | None = None) -> List[motion.Position]:
+    """Where the buses should be at now, along their routes (loaded here unless given)"""
+    if geometries is None:
+        geometries = route_geometry.get_geometries(bus.route_id for bus in buses)
+    return motion.extrapolate(buses, now, geometries)
+
+def format_live_buses_response(cycle: Cycle, live_buses_in_area: List, token: str | None = None,
+                               positions: List[motion.Position] | None = None, as_of: float | None = None) -> dict:
+    """Format the buses into a structured dict (ready to be parsed to JSON).
+    The ingester keeps one fix per bus in a cycle (live_parser.latest_fixes), so there is nothing to deduplicate.
+    With positions (as_of now) location is the extrapolated position and fix_location the reported one."""
+    response = {
+        'status': 'ok',
+        'type': 'live_buses',
+        'cycle_id': cycle.cycle_id,
+        'token': token,
+        'list': [format_live_bus(bus) for bus in live_buses_in_area]
+    }
+    if positions is not None:
+        response['as_of'] = datetime.fromtimestamp(as_of, timezone.utc)
+        for bus, position in zip(response['list'], positions):
+            bus['fix_location'] = bus['location']
+            bus['location'] = {'lat': position.latitude, 'lon': position.longitude}
+            bus['heading'] = round(position.heading, 1)
+    return response
+
+def format_unchanged_response(cycle: Cycle, token: str) -> dict:
+    """The client already has this cycle for this area"""
     return {
         'status': 'ok',
         'type': 'live_buses',
-        'list': [
-            {
-                'service_journey_id': str(bus.service_journey_id),
-                'vehicle_id': str(bus.vehicle_id),
-                'time': bus.timestamp,
-                'bearing': bus.bearing,
-                'velocity': bus.velocity,
-                'location': {'lat': bus.latitude, 'lon': bus.longitude}
-            }
-            for bus in live_buses_in_area
-        ]
-    }
\ No newline at end of file
+        'cycle_id': cycle.cycle_id,
+        'token': token,
+        'unchanged': True,
+    }
+
+def format_live_bus(bus) -> dict:
+    return {
+        'service_journey_id': str(bus.service_journey_id),
+        'vehicle_id': str(bus.vehicle_id),
+        'time': bus.timestamp,
+        'bearing': bus.bearing,
+        'velocity': bus.velocity,
+        'speed': round(bus.speed, 2), # Meters per second, smoothed
+        'heading': round(bus.heading, 1), # Degrees, smoothed
+        'line_id': str(bus.line_id) if bus.line_id else None,
+        'line': bus.line or None,
+        'destination': bus.destination or None,
+        'operator': bus.operator or None,
+        'location': {'lat': bus.latitude, 'lon': bus.longitude}
+    }
@@ -0,0 +1,183 @@
+from threading import Lock
+from typing import Dict, List, Tuple
+from sqlalchemy import select
+import time
+from bustrackr_server import db
+from bustrackr_server.config import Config
+from bustrackr_server.db_routing import read_only
+from bustrackr_server.live_store import Cycle
+from bustrackr_server.models import Stop, Quay, StopGroup, AlternativeName
+from bustrackr_server.nearby_index import NearbyIndex, has_tree
+from bustrackr_server.static_version import get_static_version
+from bustrackr_server.services.stops_service import format_stops_response
+from bustrackr_server.services.quays_service import format_quays_response
+from bustrackr_server.services.live_service import format_live_bus
+
+# The k nearest stops, quays or live vehicles to a point. Every worker keeps an index of all bus
+# stops and quays, built the first time it is asked and rebuilt when the static data changes,
+# and one of the vehicles of the current cycle.
+
+KINDS = ('stops', 'quays', 'live')
+
+# Same rows as the bounding box queries, for every bus stop, quay and stop group. A stop with
+# several alternative names is still one row (with its first abbreviation), so it is counted once.
+ALL_STOPS_QUERY = select(
+    Stop.id.label('id'),
+    Stop.stop_group_id.label('group_id'),
+    Stop.name.label('name'),
+    Stop.latitude.label('lat'),
+    Stop.longitude.label('lon'),
+    AlternativeName.abbreviation.label('abb')
+).join_from(
+    Stop, AlternativeName,
+    Stop.id == AlternativeName.stop_id,
+    isouter=True
+).where(
+    Stop.transport_mode == 'bus'
+).distinct(
+    Stop.id
+).order_by(
+    Stop.id,
+    AlternativeName.id
+).execution_options(query_name='nearby_stops')
+
+ALL_QUAYS_QUERY = select(
+    Quay.id.label('id'),
+    Quay.stop_id.label('stop_id'),
+    Quay.public_code.label('code'),
+    Quay.latitude.label('lat'),
+    Quay.longitude.label('lon'),
+    Stop.name.label('name')
+).join_from(
+    Quay, Stop,
+    Quay.stop_id == Stop.id
+).where(
+    Stop.transport_mode == 'bus'
+).execution_options(query_name='nearby_quays')
+
+ALL_GROUPS_QUERY = select(
+    StopGroup.id.label('id'),
+    StopGroup.name.label('name'),
+    StopGroup.description.label('desc'),
+    StopGroup.latitude.label('lat'),
+    StopGroup.longitude.label('lon')
+).execution_options(query_name='all_groups')
+
+# Every row of a static set, also used for the clusters (cluster_service)
+STATIC_QUERIES = {
+    'stops': ALL_STOPS_QUERY,
+    'quays': ALL_QUAYS_QUERY,
+    'stop_groups': ALL_GROUPS_QUERY,
+}
+
+index_lock = Lock()
+static_indexes: Dict[str, Tuple[str, NearbyIndex]] = {} # kind -> (static version, index)
+live_index_cache: Tuple[str | None, NearbyIndex] = (None, NearbyIndex([], [], []))
+stats = {
+    'queries': 0,
+    'kd_tree': has_tree(),
+    'stops': 0, # Points in each index
+    'quays': 0,
+    'live': 0,
+    'build_ms': {},
+}
+
+def nearby_params(req: dict) -> Tuple[str, float, float, int, float]:
+    """kind, lat, lon, k and radius of a request, raises ValueError if any is invalid"""
+    kind = req.get('kind', 'stops')
+    if kind not in KINDS:
+        raise ValueError(f'kind must be one of {", ".join(KINDS)}')
+    try:
+        lat = float(req['lat'])
+        lon = float(req['lon'])
+        k = int(req.get('k', 10))
+        radius = float(req.get('radius', Config.NEARBY_DEFAULT_RADIUS))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid values')
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('Invalid values')
+    if not 1 <= k <= Config.NEARBY_MAX_K:
+        raise ValueError(f'k must be between 1 and {Config.NEARBY_MAX_K}')
+    if not 0 < radius <= Config.NEARBY_MAX_RADIUS:
+        raise ValueError(f'radius must be between 0 and {Config.NEARBY_MAX_RADIUS:g} meters')
+    return kind, lat, lon, k, radius
+
+def build_index(kind: str, rows: List) -> NearbyIndex:
+    start = time.perf_counter()
+    index = NearbyIndex(rows, [float(row.lat) for row in rows], [float(row.lon) for row in rows])
+    with index_lock:
+        stats[kind] = len(index)
+        stats['build_ms'][kind] = round((time.perf_counter() - start) * 1000, 3)
+    return index
+
+def cached_static_index(kind: str) -> NearbyIndex | None:
+    """The index of stops or quays if it is built for the current static data."""
+    cached = static_indexes.get(kind)
+    if cached is not None and cached[0] == get_static_version():
+        return cached[1]
+    return None
+
+def store_static_index(kind: str, rows: List) -> NearbyIndex:
+    version = get_static_version()
+    index = build_index(kind, rows)
+    static_indexes[kind] = (version, index)
+    return index
+
+@read_only
+def load_static_rows(kind: str) -> List:
+    return db.session.execute(STATIC_QUERIES[kind]).fetchall()
+
+static_build_lock = Lock() # One worker thread loads a set, the others wait for it
+
+def static_index(kind: str) -> NearbyIndex:
+    index = cached_static_index(kind)
+    if index is not None:
+        return index
+    with static_build_lock:
+        return cached_static_index(kind) or store_static_index(kind, load_static_rows(kind))
+
+def live_index(cycle: Cycle) -> NearbyIndex:
+    """The index of the cycle's vehicles, built once per cycle."""
+    global live_index_cache
+    cycle_id, index = live_index_cache
+    if cycle_id == cycle.cycle_id and cycle_id is not None:
+        return index
+    vehicles = cycle.vehicles
+    start = time.perf_counter()
+    index = NearbyIndex(vehicles, [vehicle.latitude for vehicle in vehicles], [vehicle.longitude for vehicle in vehicles])
+    live_index_cache = (cycle.cycle_id, index)
+    with index_lock:
+        stats['live'] = len(index)
+        stats['build_ms']['live'] = round((time.perf_counter() - start) * 1000, 3)
+    return index
+
+def find_nearby(index: NearbyIndex, lat: float, lon: float, k: int, radius: float) -> List[Tuple[object, float]]:
+    with index_lock:
+        stats['queries'] += 1
+    return index.query(lat, lon, k, radius)
+
+def format_nearby_response(kind: str, nearby: List[Tuple[object, float]], cycle: Cycle | None = None) -> dict:
+    """Format the items into a structured dict (ready to be parsed to JSON), nearest first"""
+    items = [item for item, _ in nearby]
+    if kind == 'stops':
+        formatted = format_stops_response(items)['list']
+    elif kind == 'quays':
+        formatted = format_quays_response(items)['list']
+    else:
+        formatted = [format_live_bus(item) for item in items]
+    for entry, (_, distance) in zip(formatted, nearby):
+        entry['distance'] = round(distance, 1) # Meters
+    response = {
+        'status': 'ok',
+        'type': f'nearby_{kind}',
+        'list': formatted
+    }
+    if cycle is not None:
+        response['cycle_id'] = cycle.cycle_id
+    return response
+
+def get_stats() -> dict:
+    with index_lock:
+        result = dict(stats)
+        result['build_ms'] = dict(stats['build_ms'])
+    return result
@@ -1,6 +1,11 @@
 from typing import List, Tuple
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, bindparam
 from bustrackr_server import db
+from bustrackr_server.db_routing import read_only
+from bustrackr_server.config import Config
+from bustrackr_server.utils import bbox_params
+from bustrackr_server.static_version import get_static_version
+from bustrackr_server.tile_cache import TileCache, TileRange, register_tile_cache
 from bustrackr_server.models import Quay, Stop
 
 def process_coordinates(req: dict) -> Tuple[float, float, float, float]:
@@ -18,28 +23,31 @@ def is_area_too_large(lat_0: float, lon_0: float, lat_1: float, lon_1: float) ->
     area = lat_len * lon_len
     return area > 0.025
 
+# Built once, executed as a server side prepared statement
+FIND_QUAYS_QUERY = select(
+    Quay.id.label('id'),
+    Quay.stop_id.label('stop_id'),
+    Quay.public_code.label('code'),
+    Quay.latitude.label('lat'),
+    Quay.longitude.label('lon'),
+    Stop.name.label('name')
+).join_from(
+    Quay, Stop,
+    Quay.stop_id == Stop.id
+).where(
+    and_(
+        Stop.transport_mode == 'bus',
+        Quay.latitude <= bindparam('lat_0'),
+        Quay.latitude >= bindparam('lat_1'),
+        Quay.longitude >= bindparam('lon_0'),
+        Quay.longitude <= bindparam('lon_1')
+    )
+).execution_options(query_name='find_quays')
+
+@read_only
 def find_quays(lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> List:
     """Fetch quays from the database based on input coordinates"""
-    find_quays_query = select(
-        Quay.id.label('id'),
-        Quay.stop_id.label('stop_id'),
-        Quay.public_code.label('code'),
-        Quay.latitude.label('lat'),
-        Quay.longitude.label('lon'),
-        Stop.name.label('name')
-    ).join_from(
-        Quay, Stop,
-        Quay.stop_id == Stop.id
-    ).where(
-        and_(
-            Stop.transport_mode == 'bus',
-            Quay.latitude <= lat_0,
-            Quay.latitude >= lat_1,
-            Quay.longitude >= lon_0,
-            Quay.longitude <= lon_1
-        )
-    )
-    return db.session.execute(find_quays_query).fetchall()
+    return db.session.execute(FIND_QUAYS_QUERY, bbox_params(lat_0, lon_0, lat_1, lon_1)).fetchall()
 
 def format_quays_response(quays_in_area: List) -> dict:
     """Format the database results into a structured dict (ready to be parsed to JSON)"""
@@ -56,4 +64,16 @@ def format_quays_response(quays_in_area: List) -> dict:
                 }
                 for quay in quays_in_area
             ]
-    }
\ No newline at end of file
+    }
+
+def find_quays_tiled(tiles: TileRange) -> List[dict]:
+    """Fetch formatted quays for a range of tiles, shared between requests and workers"""
+    return quays_tile_cache.get(tiles)
+
+quays_tile_cache = register_tile_cache(TileCache(
+    'quays',
+    lambda lat_0, lon_0, lat_1, lon_1: format_quays_response(find_quays(lat_0, lon_0, lat_1, lon_1))['list'],
+    ttl=Config.TILE_CACHE_TTL,
+    use_redis=True,
+    version=get_static_version
+))
@@ -1,7 +1,13 @@
 from typing import List, Tuple
-from sqlalchemy import select, and_, any_
+from sqlalchemy import select, and_, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY, BIGINT
 # from sqlalchemy.dialects.postgresql import array
 from bustrackr_server import db
+from bustrackr_server.db_routing import read_only
+from bustrackr_server.config import Config
+from bustrackr_server.utils import bbox_params
+from bustrackr_server.static_version import get_static_version
+from bustrackr_server.tile_cache import TileCache, TileRange, register_tile_cache
 from bustrackr_server.models import StopGroup
 
 def process_coordinates(req: dict) -> Tuple[float, float, float, float]:
@@ -19,36 +25,41 @@ def is_area_too_large(lat_0: float, lon_0: float, lat_1: float, lon_1: float) ->
     area = lat_len * lon_len
     return area > 0.325
 
+# Built once, executed as a server side prepared statement
+FIND_GROUPS_COORDS_QUERY = select(
+    StopGroup.id.label('id'),
+    StopGroup.name.label('name'),
+    StopGroup.description.label('desc'),
+    StopGroup.latitude.label('lat'),
+    StopGroup.longitude.label('lon')
+).where(
+    and_(
+        StopGroup.latitude <= bindparam('lat_0'),
+        StopGroup.latitude >= bindparam('lat_1'),
+        StopGroup.longitude >= bindparam('lon_0'),
+        StopGroup.longitude <= bindparam('lon_1')
+    )
+).execution_options(query_name='find_groups_coords')
+
+@read_only
 def find_groups_coords(lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> List:
     """Fetch stop groups from the database based on input coordinates"""
-    find_groups_query = select(
-        StopGroup.id.label('id'),
-        StopGroup.name.label('name'),
-        StopGroup.description.label('desc'),
-        StopGroup.latitude.label('lat'),
-        StopGroup.longitude.label('lon')
-    ).where(
-        and_(
-            StopGroup.latitude <= lat_0,
-            StopGroup.latitude >= lat_1,
-            StopGroup.longitude >= lon_0,
-            StopGroup.longitude <= lon_1
-        )
-    )
-    return db.session.execute(find_groups_query).fetchall()
+    return db.session.execute(FIND_GROUPS_COORDS_QUERY, bbox_params(lat_0, lon_0, lat_1, lon_1)).fetchall()
+
+FIND_GROUPS_LIST_QUERY = select(
+    StopGroup.id.label('id'),
+    StopGroup.name.label('name'),
+    StopGroup.description.label('desc'),
+    StopGroup.latitude.label('lat'),
+    StopGroup.longitude.label('lon')
+).where(
+    StopGroup.id == any_(bindparam('ids', type_=ARRAY(BIGINT)))
+).execution_options(query_name='find_groups_list')
 
+@read_only
 def find_groups_list(ids: List) -> List:
     """Fetch stop groups from the database based on list of ids"""
-    find_groups_query = select(
-        StopGroup.id.label('id'),
-        StopGroup.name.label('name'),
-        StopGroup.description.label('desc'),
-        StopGroup.latitude.label('lat'),
-        StopGroup.longitude.label('lon')
-    ).where(
-        StopGroup.id == any_(ids)
-    )
-    return db.session.execute(find_groups_query).fetchall()
+    return db.session.execute(FIND_GROUPS_LIST_QUERY, {'ids': ids}).fetchall()
 
 def format_groups_response(groups_in_area: List) -> dict:
     """Format the database results into a structured dict (ready to be parsed to JSON)"""
@@ -64,4 +75,16 @@ def format_groups_response(groups_in_area: List) -> dict:
                 }
                 for group in groups_in_area
             ]
-    }
\ No newline at end of file
+    }
+
+def find_groups_tiled(tiles: TileRange) -> List[dict]:
+    """Fetch formatted stop groups for a range of tiles, shared between requests and workers"""
+    return groups_tile_cache.get(tiles)
+
+groups_tile_cache = register_tile_cache(TileCache(
+    'stop_groups',
+    lambda lat_0, lon_0, lat_1, lon_1: format_groups_response(find_groups_coords(lat_0, lon_0, lat_1, lon_1))['list'],
+    ttl=Config.TILE_CACHE_TTL,
+    use_redis=True,
+    version=get_static_version
+))
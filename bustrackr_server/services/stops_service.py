@@ -1,6 +1,11 @@
 from typing import List, Tuple
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, bindparam
 from bustrackr_server import db
+from bustrackr_server.db_routing import read_only
+from bustrackr_server.config import Config
+from bustrackr_server.utils import bbox_params
+from bustrackr_server.static_version import get_static_version
+from bustrackr_server.tile_cache import TileCache, TileRange, register_tile_cache
 from bustrackr_server.models import Stop, AlternativeName
 
 def process_coordinates(req: dict) -> Tuple[float, float, float, float]:
@@ -18,29 +23,32 @@ def is_area_too_large(lat_0: float, lon_0: float, lat_1: float, lon_1: float) ->
     area = lat_len * lon_len
     return area > 0.125
 
+# Built once, executed as a server side prepared statement
+FIND_STOPS_QUERY = select(
+    Stop.id.label('id'),
+    Stop.stop_group_id.label('group_id'),
+    Stop.name.label('name'),
+    Stop.latitude.label('lat'),
+    Stop.longitude.label('lon'),
+    AlternativeName.abbreviation.label('abb')
+).join_from(
+    Stop, AlternativeName,
+    Stop.id == AlternativeName.stop_id,
+    isouter=True
+).where(
+    and_(
+        Stop.transport_mode == 'bus',
+        Stop.latitude <= bindparam('lat_0'),
+        Stop.latitude >= bindparam('lat_1'),
+        Stop.longitude >= bindparam('lon_0'),
+        Stop.longitude <= bindparam('lon_1')
+    )
+).execution_options(query_name='find_stops')
+
+@read_only
 def find_stops(lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> List:
     """Fetch stops from the database based on input coordinates"""
-    find_stops_query = select(
-        Stop.id.label('id'),
-        Stop.stop_group_id.label('group_id'),
-        Stop.name.label('name'),
-        Stop.latitude.label('lat'),
-        Stop.longitude.label('lon'),
-        AlternativeName.abbreviation.label('abb')
-    ).join_from(
-        Stop, AlternativeName,
-        Stop.id == AlternativeName.stop_id,
-        isouter=True
-    ).where(
-        and_(
-            Stop.transport_mode == 'bus',
-            Stop.latitude <= lat_0,
-            Stop.latitude >= lat_1,
-            Stop.longitude >= lon_0,
-            Stop.longitude <= lon_1
-        )
-    )
-    return db.session.execute(find_stops_query).fetchall()
+    return db.session.execute(FIND_STOPS_QUERY, bbox_params(lat_0, lon_0, lat_1, lon_1)).fetchall()
 
 def format_stops_response(stops_in_area: List) -> dict:
     """Format the database results into a structured dict (ready to be parsed to JSON)"""
@@ -57,4 +65,16 @@ def format_stops_response(stops_in_area: List) -> dict:
                 }
                 for stop in stops_in_area
             ]
-    }
\ No newline at end of file
+    }
+
+def find_stops_tiled(tiles: TileRange) -> List[dict]:
+    """Fetch formatted stops for a range of tiles, shared between requests and workers"""
+    return stops_tile_cache.get(tiles)
+
+stops_tile_cache = register_tile_cache(TileCache(
+    'stops',
+    lambda lat_0, lon_0, lat_1, lon_1: format_stops_response(find_stops(lat_0, lon_0, lat_1, lon_1))['list'],
+    ttl=Config.TILE_CACHE_TTL,
+    use_redis=True,
+    version=get_static_version
+))
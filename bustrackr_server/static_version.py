@@ -0,0 +1,44 @@
+from threading import Lock
+import time
+from bustrackr_server import redis_client
+from bustrackr_server.config import Config
+
+# Everything derived from the static data (ETags, cached tiles and responses) is tied to this version
+
+STATIC_VERSION_KEY = 'static_data_version'
+STATIC_VERSION_TTL = 30 # Seconds a worker trusts its copy of the version
+
+version_lock = Lock()
+cached_version = (None, 0.0) # (version, fetched at)
+
+def is_version_fresh() -> bool:
+    """True if get_static_version answers from this worker's copy, without asking redis."""
+    version, fetched_at = cached_version
+    return bool(Config.STATIC_DATA_VERSION) or (version is not None and time.monotonic() - fetched_at < STATIC_VERSION_TTL)
+
+def get_static_version() -> str:
+    """Get the version of the static data, shared by all workers through redis."""
+    global cached_version
+    if Config.STATIC_DATA_VERSION:
+        return Config.STATIC_DATA_VERSION
+
+    version, fetched_at = cached_version
+    if version is not None and time.monotonic() - fetched_at < STATIC_VERSION_TTL:
+        return version
+
+    with version_lock:
+        try:
+            version = redis_client.get(STATIC_VERSION_KEY) or '0'
+        except Exception:
+            version = version or '0' # Keep serving the last known version if redis is unavailible
+        cached_version = (version, time.monotonic())
+    return version
+
+def bump_static_version() -> str:
+    """Give the static data a new version, invalidating every ETag handed out so far."""
+    global cached_version
+    version = str(time.time_ns())
+    redis_client.set(STATIC_VERSION_KEY, version)
+    with version_lock:
+        cached_version = (version, time.monotonic())
+    return version
@@ -0,0 +1,195 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, List, Tuple
+import math
+import time
+import orjson
+from bustrackr_server import redis_client
+from bustrackr_server.config import Config
+from bustrackr_server.utils import orjson_default
+
+# Bounding boxes are snapped to a fixed grid of tiles, every tile is cached on its own
+# so users looking at almost the same view share the work.
+# Coordinates follow the rest of the code: (lat_0, lon_0) is the north west corner, (lat_1, lon_1) the south east.
+
+Tile = Tuple[int, int] # (row, column)
+TileRange = Tuple[int, int, int, int] # (first row, last row, first column, last column), inclusive
+
+def snap_to_tiles(lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> TileRange:
+    """Snap a bounding box to the range of tiles covering it."""
+    size = Config.TILE_SIZE
+    return (
+        math.floor(lat_1 / size), math.floor(lat_0 / size),
+        math.floor(lon_0 / size), math.floor(lon_1 / size),
+    )
+
+def tile_range_bounds(tiles: TileRange) -> Tuple[float, float, float, float]:
+    """The bounding box (lat_0, lon_0, lat_1, lon_1) of a range of tiles."""
+    size = Config.TILE_SIZE
+    row_0, row_1, col_0, col_1 = tiles
+    return (row_1 + 1) * size, col_0 * size, row_0 * size, (col_1 + 1) * size
+
+def tile_of(item: dict) -> Tile:
+    """The tile an item belongs to, every item belongs to exactly one tile."""
+    size = Config.TILE_SIZE
+    return math.floor(float(item['location']['lat']) / size), math.floor(float(item['location']['lon']) / size)
+
+def format_tiled_response(response_type: str, items: List[dict]) -> dict:
+    """Format the assembled tiles into a structured dict (ready to be parsed to JSON)"""
+    return {
+        'status': 'ok',
+        'type': response_type,
+        'list': items,
+    }
+
+def record_viewport(namespace: str, lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> None:
+    """Append the requested viewport to the trace file (if enabled), used by benchmarks/replay_viewports.py"""
+    if not Config.VIEWPORT_TRACE_FILE:
+        return
+    line = orjson.dumps({'t': time.time(), 'type': namespace, 'lat_0': lat_0, 'lon_0': lon_0, 'lat_1': lat_1, 'lon_1': lon_1})
+    with open(Config.VIEWPORT_TRACE_FILE, 'ab') as trace_file:
+        trace_file.write(line + b'\n')
+
+class TileCache:
+    '''Per tile results in an in-process LRU, optionally backed by redis so all workers share them.
+    loader(lat_0, lon_0, lat_1, lon_1) returns the formatted items in a bounding box.'''
+
+    def __init__(self, namespace: str, loader: Callable[[float, float, float, float], List[dict]],
+                 ttl: float, use_redis: bool, version: Callable[[], str] = lambda: '0'):
+        self.namespace = namespace
+        self.loader = loader
+        self.ttl = ttl
+        self.use_redis = use_redis
+        self.version = version
+        self.tiles: OrderedDict[Tuple[str, Tile], Tuple[float, List[dict]]] = OrderedDict()
+        self.lock = Lock()
+        self.stats = {
+            'requests': 0,
+            'request_seconds': 0.0,
+            'tiles': 0,
+            'local_hits': 0,
+            'redis_hits': 0,
+            'misses': 0,
+            'loads': 0,
+            'load_seconds': 0.0,
+        }
+
+    def count(self, **kwargs) -> None:
+        with self.lock:
+            for key, value in kwargs.items():
+                self.stats[key] += value
+
+    def redis_key(self, version: str, tile: Tile) -> str:
+        return f'tile:{self.namespace}:{version}:{tile[0]}:{tile[1]}'
+
+    def get_local(self, version: str, tile: Tile) -> List[dict] | None:
+        with self.lock:
+            entry = self.tiles.get((version, tile))
+            if entry is None:
+                return None
+            expires, items = entry
+            if expires < time.monotonic():
+                del self.tiles[(version, tile)]
+                return None
+            self.tiles.move_to_end((version, tile))
+            return items
+
+    def put_local(self, version: str, tile: Tile, items: List[dict]) -> None:
+        with self.lock:
+            self.tiles[(version, tile)] = (time.monotonic() + self.ttl, items)
+            self.tiles.move_to_end((version, tile))
+            while len(self.tiles) > Config.TILE_CACHE_MAX_TILES:
+                self.tiles.popitem(last=False)
+
+    def get_redis(self, version: str, tiles: List[Tile]) -> Dict[Tile, List[dict]]:
+        try:
+            values = redis_client.mget([self.redis_key(version, tile) for tile in tiles])
+        except Exception:
+            return {} # The database is always the fallback
+        return {tile: orjson.loads(value) for tile, value in zip(tiles, values) if value is not None}
+
+    def put_redis(self, version: str, loaded: Dict[Tile, List[dict]]) -> None:
+        try:
+            with redis_client.pipeline(transaction=False) as pipe:
+                for tile, items in loaded.items():
+                    pipe.set(self.redis_key(version, tile), orjson.dumps(items, default=orjson_default), ex=Config.TILE_CACHE_REDIS_TTL)
+                pipe.execute()
+        except Exception:
+            pass # Only a cache
+
+    def load(self, tiles: List[Tile]) -> Dict[Tile, List[dict]]:
+        """Load all missing tiles with one query over their bounding box and split the result per tile."""
+        rows = [tile[0] for tile in tiles]
+        cols = [tile[1] for tile in tiles]
+        start = time.perf_counter()
+        items = self.loader(*tile_range_bounds((min(rows), max(rows), min(cols), max(cols))))
+        self.count(loads=1, load_seconds=time.perf_counter() - start)
+
+        loaded = {tile: [] for tile in tiles}
+        for item in items:
+            tile = tile_of(item)
+            if tile in loaded:
+                loaded[tile].append(item)
+        return loaded
+
+    def get(self, tiles: TileRange) -> List[dict]:
+        """Assemble the items of every tile in the range."""
+        start = time.perf_counter()
+        version = self.version()
+        row_0, row_1, col_0, col_1 = tiles
+        wanted = [(row, col) for row in range(row_0, row_1 + 1) for col in range(col_0, col_1 + 1)]
+
+        found = {}
+        for tile in wanted:
+            items = self.get_local(version, tile)
+            if items is not None:
+                found[tile] = items
+        local_hits = len(found)
+
+        missing = [tile for tile in wanted if tile not in found]
+        redis_hits = 0
+        if missing and self.use_redis:
+            from_redis = self.get_redis(version, missing)
+            redis_hits = len(from_redis)
+            for tile, items in from_redis.items():
+                self.put_local(version, tile, items)
+            found.update(from_redis)
+            missing = [tile for tile in missing if tile not in found]
+
+        if missing:
+            loaded = self.load(missing)
+            for tile, items in loaded.items():
+                self.put_local(version, tile, items)
+            if self.use_redis:
+                self.put_redis(version, loaded)
+            found.update(loaded)
+
+        self.count(requests=1, request_seconds=time.perf_counter() - start, tiles=len(wanted),
+                   local_hits=local_hits, redis_hits=redis_hits, misses=len(missing))
+        return [item for tile in wanted for item in found[tile]]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.tiles.clear()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            current = dict(self.stats)
+            current['cached_tiles'] = len(self.tiles)
+        current['hit_ratio'] = (current['local_hits'] + current['redis_hits']) / current['tiles'] if current['tiles'] else None
+        current['mean_request_ms'] = current['request_seconds'] * 1000 / current['requests'] if current['requests'] else None
+        current['mean_load_ms'] = current['load_seconds'] * 1000 / current['loads'] if current['loads'] else None
+        return current
+
+tile_caches: Dict[str, TileCache] = {}
+
+def register_tile_cache(cache: TileCache) -> TileCache:
+    tile_caches[cache.namespace] = cache
+    return cache
+
+def clear_tile_caches() -> None:
+    for cache in tile_caches.values():
+        cache.clear()
+
+def get_stats() -> dict:
+    return {namespace: cache.get_stats() for namespace, cache in tile_caches.items()}
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import time
+import jwt
+import redis
+from bustrackr_server import redis_client
+from bustrackr_server.config import Config
+
+# Verified tokens are remembered until they expire so a request costs a dict lookup instead of
+# an HMAC check. Revoked tokens (logout) are kept in a redis set of jti until they would have
+# expired anyway, a sorted set by expiry is used to prune them.
+
+REVOKED_KEY = 'revoked_tokens'
+REVOKED_EXPIRY_KEY = 'revoked_tokens:expiry'
+
+cache_lock = Lock()
+verified = OrderedDict() # sha256 of the token -> claims, oldest first
+
+stats_lock = Lock()
+stats = {
+    'cache_hits': 0,
+    'cache_misses': 0,
+    'revoked': 0, # Requests with a revoked token
+    'revocation_errors': 0, # Revocation checks skipped because redis was unavailible
+}
+
+def count(key: str) -> None:
+    with stats_lock:
+        stats[key] += 1
+
+def token_key(token: str) -> bytes:
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+def decode(token: str) -> dict:
+    """Verify a token and return its claims, raises the same errors as jwt.decode."""
+    key = token_key(token)
+    with cache_lock:
+        claims = verified.get(key)
+    if claims is not None:
+        if claims['exp'] <= time.time():
+            with cache_lock:
+                verified.pop(key, None)
+            raise jwt.ExpiredSignatureError('Signature has expired')
+        count('cache_hits')
+        return claims
+
+    count('cache_misses')
+    claims = jwt.decode(token, Config.JWT_SECRET, algorithms=['HS256'])
+    with cache_lock:
+        verified[key] = claims
+        while len(verified) > Config.TOKEN_CACHE_SIZE:
+            verified.popitem(last=False)
+    return claims
+
+def is_revoked(claims: dict) -> bool:
+    jti = claims.get('jti')
+    if jti is None or not Config.TOKEN_REVOCATION_CHECK: # Tokens from before jti was added cannot be revoked
+        return False
+    try:
+        revoked = redis_client.sismember(REVOKED_KEY, jti)
+    except redis.exceptions.RedisError:
+        count('revocation_errors')
+        return False # The signature is still checked, an outage should not log everyone out
+    if revoked:
+        count('revoked')
+    return bool(revoked)
+
+def revoke(claims: dict) -> None:
+    """Revoke a token until it expires, and forget revocations which are no longer needed."""
+    jti = claims.get('jti')
+    if jti is None:
+        return
+    now = time.time()
+    try:
+        expired = redis_client.zrangebyscore(REVOKED_EXPIRY_KEY, '-inf', now)
+        with redis_client.pipeline() as pipe:
+            pipe.sadd(REVOKED_KEY, jti)
+            pipe.zadd(REVOKED_EXPIRY_KEY, {jti: claims['exp']})
+            if expired:
+                pipe.srem(REVOKED_KEY, *expired)
+                pipe.zremrangebyscore(REVOKED_EXPIRY_KEY, '-inf', now)
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        count('revocation_errors') # Logging out still clears the cookie
+
+def needs_renewal(claims: dict) -> bool:
+    """Renew once TOKEN_RENEW_FRACTION of the lifetime has passed."""
+    issued_at = claims.get('iat')
+    if issued_at is None:
+        return True
+    life = claims['exp'] - issued_at
+    return time.time() - issued_at >= life * Config.TOKEN_RENEW_FRACTION
+
+def get_stats() -> dict:
+    with stats_lock:
+        result = dict(stats)
+    lookups = result['cache_hits'] + result['cache_misses']
+    result['hit_ratio'] = result['cache_hits'] / lookups if lookups else None
+    with cache_lock:
+        result['cached_tokens'] = len(verified)
+    return result
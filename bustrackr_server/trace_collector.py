@@ -0,0 +1,108 @@
+'''Local stand-in for an OpenTelemetry collector, prints the traces it receives.
+
+    python -m bustrackr_server.trace_collector --port 4318
+    TRACE_OTLP_URL=http://localhost:4318/v1/traces  (for the API workers)
+
+    python -m bustrackr_server.trace_collector --read traces.jsonl
+
+Accepts OTLP/JSON on POST /v1/traces, like a real collector, and prints every trace as a tree of
+spans with their milliseconds. --output appends what it receives as JSON lines, the format of
+TRACE_FILE, which --read prints. Only the standard library is used.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+import argparse
+import json
+
+def spans_of(request: dict) -> List[dict]:
+    return [
+        span
+        for resource_spans in request.get('resourceSpans', [])
+        for scope_spans in resource_spans.get('scopeSpans', [])
+        for span in scope_spans.get('spans', [])
+    ]
+
+def attribute(span: dict, key: str):
+    for item in span.get('attributes', []):
+        if item['key'] == key:
+            return next(iter(item['value'].values()))
+    return None
+
+def format_traces(request: dict) -> str:
+    """Every trace of an export request as an indented tree, children in the order they started."""
+    traces: Dict[str, List[dict]] = {}
+    for span in spans_of(request):
+        traces.setdefault(span['traceId'], []).append(span)
+    lines = []
+    for trace_id, spans in traces.items():
+        children: Dict[str, List[dict]] = {}
+        for span in spans:
+            children.setdefault(span.get('parentSpanId', ''), []).append(span)
+        ids = {span['spanId'] for span in spans}
+        roots = [span for span in spans if span.get('parentSpanId', '') not in ids]
+        trace_start = min(int(span['startTimeUnixNano']) for span in spans)
+
+        def walk(span: dict, depth: int) -> None:
+            start = (int(span['startTimeUnixNano']) - trace_start) / 1e6
+            ms = (int(span['endTimeUnixNano']) - int(span['startTimeUnixNano'])) / 1e6
+            error = ' ERROR' if span.get('status', {}).get('code') == 2 else ''
+            detail = attribute(span, 'http.target') or attribute(span, 'db.statement') or ''
+            detail = ' '.join(str(detail).split())[:100]
+            lines.append(f'{"  " * depth}{span["name"]:<{40 - 2 * depth}} {ms:9.3f} ms  (+{start:.3f}){error}  {detail}')
+            for child in sorted(children.get(span['spanId'], []), key=lambda child: int(child['startTimeUnixNano'])):
+                walk(child, depth + 1)
+
+        lines.append(f'trace {trace_id}')
+        for root in roots:
+            walk(root, 1)
+    return '\n'.join(lines)
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    output = None
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/v1/traces':
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self.send_error(400, 'Only OTLP/JSON is supported')
+            return
+        print(format_traces(request), flush=True)
+        if self.output:
+            with open(self.output, 'ab') as output:
+                output.write(json.dumps(request, separators=(',', ':')).encode() + b'\n')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{}') # An ExportTraceServiceResponse with nothing rejected
+
+    def log_message(self, format, *args):
+        pass # The traces are the log
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=4318, help='4318 is the standard OTLP/HTTP port')
+    parser.add_argument('--output', help='Append the received traces here (JSON lines)')
+    parser.add_argument('--read', help='Print the traces of a JSON lines file (TRACE_FILE) and exit')
+    args = parser.parse_args()
+
+    if args.read:
+        with open(args.read) as traces:
+            for line in traces:
+                if line.strip():
+                    print(format_traces(json.loads(line)))
+        return
+
+    CollectorHandler.output = args.output
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), CollectorHandler)
+    print(f'Collecting traces on http://127.0.0.1:{args.port}/v1/traces', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+from collections import deque
+from contextvars import ContextVar
+from queue import Queue, Full
+from threading import Lock, Thread
+from typing import Dict, List, NamedTuple
+import random
+import time
+import orjson
+import requests
+from bustrackr_server.config import Config
+
+# Span tracing of API requests, if TRACE_ENABLED. Every request under /api gets a trace while it
+# is handled, with a span for the request itself, every database query (db_metrics' cursor
+# events), every redis command and the formatting and serialization steps. Traces of requests
+# slower than TRACE_SLOW_MS are kept in a ring buffer of TRACE_BUFFER_SIZE (GET /api/debug/traces)
+# and handed to a background thread, which appends them to TRACE_FILE as JSON lines and POSTs
+# them to TRACE_OTLP_URL, all in the OTLP/JSON format of OpenTelemetry that
+# bustrackr_server.trace_collector and any OpenTelemetry collector read. The others are dropped
+# when they finish, a span costs about as much as appending a tuple.
+
+SERVICE_NAME = 'bustrackr_server'
+MAX_SPANS = 500 # Per trace, a request running more queries than this keeps the first ones
+MAX_STATEMENT = 2000 # Characters of SQL kept in a span
+INTERNAL, SERVER, CLIENT = 1, 2, 3 # OTLP span kinds
+STATUS_ERROR = 2
+
+class Span(NamedTuple):
+    span_id: int
+    parent_id: int
+    name: str
+    kind: int
+    start: float # perf_counter
+    end: float
+    attributes: dict
+
+class Trace:
+    '''The spans of one request, current_trace while it is handled'''
+
+    __slots__ = ('trace_id', 'root_id', 'name', 'attributes', 'wall_start', 'start', 'end', 'status', 'spans', 'open', 'dropped', 'token')
+
+    def __init__(self, name: str, attributes: dict):
+        self.trace_id = random.getrandbits(128)
+        self.root_id = random.getrandbits(64)
+        self.name = name
+        self.attributes = attributes
+        self.wall_start = time.time_ns()
+        self.start = time.perf_counter()
+        self.end = None
+        self.status = 500 # Unless a response is sent
+        self.spans: List[Span] = []
+        self.open = [self.root_id] # Parents of the spans being recorded
+        self.dropped = 0
+        self.token = current_trace.set(self)
+
+    def add(self, name: str, kind: int, start: float, end: float, attributes: dict) -> None:
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append(Span(random.getrandbits(64), self.open[-1], name, kind, start, end, attributes))
+
+    def finish(self, status: int) -> None:
+        """End the trace, in the context it was started in, and keep it if it was slow."""
+        self.end = time.perf_counter()
+        self.status = status
+        current_trace.reset(self.token)
+        if (self.end - self.start) * 1000 >= Config.TRACE_SLOW_MS:
+            keep(self)
+
+    def duration_ms(self) -> float:
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+current_trace: ContextVar[Trace | None] = ContextVar('current_trace', default=None)
+
+def record_span(name: str, seconds: float, attributes: dict, kind: int = CLIENT) -> None:
+    """Record a span which just ended after seconds, in the current trace if there is one."""
+    trace = current_trace.get()
+    if trace is not None:
+        end = time.perf_counter()
+        trace.add(name, kind, end - seconds, end, attributes)
+
+class span:
+    '''Time a block as a span of the current trace, spans recorded inside it are its children:
+
+        with span('format_journey_details'):
+            ...
+    '''
+
+    __slots__ = ('name', 'trace', 'span_id', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = current_trace.get()
+        if self.trace is not None:
+            self.span_id = random.getrandbits(64)
+            self.trace.open.append(self.span_id)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        if trace is None:
+            return
+        end = time.perf_counter()
+        trace.open.pop()
+        if len(trace.spans) >= MAX_SPANS:
+            trace.dropped += 1
+        else:
+            attributes = {'error': exc_type.__name__} if exc_type is not None else {}
+            trace.spans.append(Span(self.span_id, trace.open[-1], self.name, INTERNAL, self.start, end, attributes))
+
+def db_span(query_name: str, statement: str, seconds: float) -> None:
+    if current_trace.get() is not None:
+        record_span(query_name, seconds, {'db.system': 'postgresql', 'db.statement': statement[:MAX_STATEMENT]})
+
+def redis_span(command: str, seconds: float, commands: int = 1) -> None:
+    """commands is the length of a pipeline."""
+    if current_trace.get() is not None:
+        record_span(f'redis {command}', seconds, {'db.system': 'redis', 'db.operation': command, 'db.redis.commands': commands})
+
+stats_lock = Lock()
+slow_traces: deque = deque(maxlen=Config.TRACE_BUFFER_SIZE)
+stats = {
+    'kept': 0, # Slower than TRACE_SLOW_MS
+    'exported': 0,
+    'export_errors': 0,
+}
+
+def keep(trace: Trace) -> None:
+    with stats_lock:
+        slow_traces.append(trace)
+        stats['kept'] += 1
+    if Config.TRACE_FILE or Config.TRACE_OTLP_URL:
+        send_to_exporter(trace)
+
+def get_slow_traces() -> List[Trace]:
+    """The kept traces, slowest first."""
+    with stats_lock:
+        traces = list(slow_traces)
+    return sorted(traces, key=Trace.duration_ms, reverse=True)
+
+def attribute_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def attributes_of(attributes: dict) -> List[dict]:
+    return [{'key': key, 'value': attribute_value(value)} for key, value in attributes.items()]
+
+def export_span(trace: Trace, span_id: int, parent_id: int | None, name: str, kind: int, start: float, end: float,
+                attributes: dict, error: bool) -> dict:
+    exported = {
+        'traceId': f'{trace.trace_id:032x}',
+        'spanId': f'{span_id:016x}',
+        'parentSpanId': f'{parent_id:016x}' if parent_id else '',
+        'name': name,
+        'kind': kind,
+        'startTimeUnixNano': str(trace.wall_start + int((start - trace.start) * 1e9)),
+        'endTimeUnixNano': str(trace.wall_start + int((end - trace.start) * 1e9)),
+        'attributes': attributes_of(attributes),
+    }
+    if error:
+        exported['status'] = {'code': STATUS_ERROR}
+    return exported
+
+def export(traces: List[Trace]) -> dict:
+    """The traces as an OTLP/JSON ExportTraceServiceRequest."""
+    spans = []
+    for trace in traces:
+        end = trace.end or time.perf_counter()
+        root_attributes = dict(trace.attributes, **{'http.status_code': trace.status})
+        if trace.dropped:
+            root_attributes['spans.dropped'] = trace.dropped
+        spans.append(export_span(trace, trace.root_id, None, trace.name, SERVER, trace.start, end, root_attributes, trace.status >= 500))
+        spans.extend(
+            export_span(trace, child.span_id, child.parent_id, child.name, child.kind, child.start, child.end, child.attributes, 'error' in child.attributes)
+            for child in trace.spans
+        )
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': attributes_of({'service.name': SERVICE_NAME})},
+            'scopeSpans': [{'scope': {'name': __name__}, 'spans': spans}],
+        }]
+    }
+
+def breakdown(trace: Trace) -> dict:
+    """A trace as nested spans with their milliseconds, for reading without a collector."""
+    children: Dict[int, List[Span]] = {}
+    for child in trace.spans:
+        children.setdefault(child.parent_id, []).append(child)
+
+    def tree(parent_id: int) -> List[dict]:
+        return [
+            {
+                'name': child.name,
+                'start_ms': round((child.start - trace.start) * 1000, 3),
+                'ms': round((child.end - child.start) * 1000, 3),
+                **({'statement': child.attributes['db.statement']} if 'db.statement' in child.attributes else {}),
+                **({'spans': tree(child.span_id)} if child.span_id in children else {}),
+            }
+            for child in sorted(children.get(parent_id, []), key=lambda child: child.start)
+        ]
+
+    return {
+        'trace_id': f'{trace.trace_id:032x}',
+        'name': trace.name,
+        'target': trace.attributes.get('http.target'),
+        'status': trace.status,
+        'time': trace.wall_start / 1e9,
+        'ms': round(trace.duration_ms(), 3),
+        'dropped_spans': trace.dropped,
+        'spans': tree(trace.root_id),
+    }
+
+export_queue: Queue = Queue(maxsize=100) # Traces waiting to be written and POSTed
+export_thread: Thread | None = None
+export_thread_lock = Lock()
+
+def send_to_exporter(trace: Trace) -> None:
+    """Export the trace in the background, so neither the file nor a slow collector delays a request."""
+    global export_thread
+    with export_thread_lock:
+        if export_thread is None:
+            export_thread = Thread(target=export_worker, name='trace-exporter', daemon=True)
+            export_thread.start()
+    try:
+        export_queue.put_nowait(trace)
+    except Full:
+        count(export_errors=1)
+
+def export_worker() -> None:
+    """The only writer of TRACE_FILE, so lines from concurrent requests never interleave."""
+    while True:
+        traces = [export_queue.get()]
+        while not export_queue.empty() and len(traces) < 50:
+            traces.append(export_queue.get_nowait())
+        body = orjson.dumps(export(traces))
+        try:
+            if Config.TRACE_FILE:
+                with open(Config.TRACE_FILE, 'ab') as trace_file:
+                    trace_file.write(body + b'\n')
+            if Config.TRACE_OTLP_URL:
+                response = requests.post(Config.TRACE_OTLP_URL, data=body, headers={'Content-Type': 'application/json'}, timeout=5)
+                response.raise_for_status()
+            count(exported=len(traces))
+        except (OSError, requests.RequestException): # RequestException is an OSError too
+            count(export_errors=len(traces))
+
+def count(**kwargs) -> None:
+    with stats_lock:
+        for key, value in kwargs.items():
+            stats[key] += value
+
+def get_stats() -> dict:
+    with stats_lock:
+        result = dict(stats)
+        result['buffered'] = len(slow_traces)
+    return result
@@ -0,0 +1,104 @@
+from datetime import datetime
+from threading import Lock
+from typing import List
+from zoneinfo import ZoneInfo
+import atexit
+import os
+import numpy
+from bustrackr_server.config import Config
+
+# Every fix the ingester sees, written as compressed columnar files for offline analysis:
+#   TRAIL_ARCHIVE_DIR/<local date>/trails-<HHMMSS>-<n>.npz
+# A file has one array per column (numpy.load gives a dict of columns), a day is all files in
+# its directory. Rows are buffered in memory and written every TRAIL_ARCHIVE_ROWS fixes, when
+# the day changes and on a clean shutdown.
+
+COLUMNS = {
+    'time': 'float64', # Unix seconds
+    'vehicle_id': 'int64',
+    'service_journey_id': 'int64',
+    'line_id': 'int64', # BIGINT ids, 16 digits
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'bearing': 'float32',
+    'velocity': 'int16',
+}
+
+class TrailArchive:
+
+    def __init__(self, directory: str, max_rows: int):
+        self.directory = directory
+        self.max_rows = max_rows
+        self.lock = Lock()
+        self.columns = {name: [] for name in COLUMNS}
+        self.day = None
+        self.sequence = 0 # Two files written in the same second get different names
+        self.stats = {
+            'rows': 0,
+            'files': 0,
+            'bytes': 0,
+            'buffered': 0,
+        }
+        if self.enabled:
+            atexit.register(self.flush)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def add(self, vehicles: List) -> None:
+        """Buffer the fixes of a cycle, called by the ingester."""
+        if not self.enabled or not vehicles:
+            return
+        day = datetime.now(ZoneInfo(Config.TIMEZONE)).date().isoformat()
+        if self.day is not None and day != self.day:
+            self.flush() # A file never spans two days
+        with self.lock:
+            self.day = day
+            columns = self.columns
+            for vehicle in vehicles:
+                columns['time'].append(vehicle.timestamp.timestamp())
+                columns['vehicle_id'].append(vehicle.vehicle_id)
+                columns['service_journey_id'].append(vehicle.service_journey_id)
+                columns['line_id'].append(vehicle.line_id or 0)
+                columns['latitude'].append(vehicle.latitude)
+                columns['longitude'].append(vehicle.longitude)
+                columns['bearing'].append(vehicle.bearing)
+                columns['velocity'].append(vehicle.velocity)
+            buffered = len(columns['time'])
+            self.stats['buffered'] = buffered
+        if buffered >= self.max_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            rows = len(self.columns['time'])
+            if not rows:
+                return
+            arrays = {name: numpy.asarray(values, dtype=COLUMNS[name]) for name, values in self.columns.items()}
+            self.columns = {name: [] for name in COLUMNS}
+            day = self.day
+            self.stats['buffered'] = 0
+            sequence = self.sequence
+            self.sequence += 1
+
+        directory = os.path.join(self.directory, day)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'trails-{datetime.now(ZoneInfo(Config.TIMEZONE)):%H%M%S}-{sequence}.npz')
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as archive_file: # A file object, so numpy does not add another .npz
+            numpy.savez_compressed(archive_file, **arrays)
+        os.replace(temporary, path) # Readers never see half a file
+
+        with self.lock:
+            self.stats['rows'] += rows
+            self.stats['files'] += 1
+            self.stats['bytes'] += os.path.getsize(path)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            result = dict(self.stats)
+        result['enabled'] = self.enabled
+        return result
+
+trail_archive = TrailArchive(Config.TRAIL_ARCHIVE_DIR, Config.TRAIL_ARCHIVE_ROWS)
@@ -0,0 +1,195 @@
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Dict, List, Tuple
+import math
+import random
+import time
+import orjson
+import redis
+from bustrackr_server import redis_client
+from bustrackr_server.config import Config
+from bustrackr_server.redis_resilience import UNAVAILABLE_ERRORS
+from bustrackr_server.trail_archive import trail_archive
+
+# The recent trail of every vehicle, one redis stream per vehicle fed by the ingester once per
+# cycle. A fix is only kept if the vehicle moved TRAIL_MIN_DISTANCE or TRAIL_MAX_GAP seconds
+# passed, so a bus waiting at a terminal costs nothing. Every stream is trimmed to its last
+# TRAIL_WINDOW seconds (XADD MINID, stream ids are milliseconds), capped at max_points entries and
+# expires TRAIL_WINDOW seconds after its vehicle was last seen. max_points starts at
+# TRAIL_MAX_POINTS and is lowered if the trails would not fit in TRAIL_MEMORY_BUDGET.
+
+TRAIL_KEY_PREFIX = 'trail:'
+STATS_KEY = 'trails:stats' # The ingester's stats, so every API worker can report them
+MEMORY_SAMPLE_EVERY = 12 # Cycles between memory estimates
+MEMORY_SAMPLE_KEYS = 25
+MIN_POINTS_TO_ESTIMATE = 20 # Mean points per sampled trail
+EARTH_RADIUS = 6371000 # Meters
+
+# Only the ingest thread touches these, both only hold the vehicles of the last cycle
+last_fix: Dict[int, float] = {} # vehicle id -> time of its last fix, the feed repeats fixes
+last_kept: Dict[int, Tuple[float, float, float]] = {} # vehicle id -> (time, lat, lon) of the last point in its trail
+
+stats_lock = Lock()
+stats = {
+    'cycles': 0,
+    'fixes': 0, # New fixes seen
+    'points': 0, # Fixes kept in the trails
+    'trails': 0, # Vehicles with a trail
+    'max_points': Config.TRAIL_MAX_POINTS, # Current cap per trail
+    'used_bytes': None, # Redis memory of the trails, from a sample
+    'bytes_per_point': None,
+    'estimated_bytes': None, # If every trail was full
+    'budget_bytes': Config.TRAIL_MEMORY_BUDGET,
+    'errors': 0,
+}
+
+def trail_key(vehicle_id: int) -> str:
+    return f'{TRAIL_KEY_PREFIX}{vehicle_id}'
+
+def distance(lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> float:
+    """Meters between two points, plenty accurate for a few hundred meters"""
+    x = math.radians(lon_1 - lon_0) * math.cos(math.radians((lat_0 + lat_1) / 2))
+    y = math.radians(lat_1 - lat_0)
+    return EARTH_RADIUS * math.hypot(x, y)
+
+def new_fixes(vehicles: List) -> List:
+    """The vehicles with a fix which was not in the last cycle."""
+    global last_fix
+    fixes = []
+    seen = {}
+    for vehicle in vehicles:
+        fix_time = vehicle.timestamp.timestamp()
+        seen[vehicle.vehicle_id] = fix_time
+        if last_fix.get(vehicle.vehicle_id) != fix_time:
+            fixes.append(vehicle)
+    last_fix = seen
+    return fixes
+
+def downsample(fixes: List) -> List:
+    """The fixes worth a point in the trail."""
+    global last_kept
+    kept = []
+    current = {}
+    for vehicle in fixes:
+        fix_time = vehicle.timestamp.timestamp()
+        previous = last_kept.get(vehicle.vehicle_id)
+        if (previous is None or fix_time - previous[0] >= Config.TRAIL_MAX_GAP or
+                distance(previous[1], previous[2], vehicle.latitude, vehicle.longitude) >= Config.TRAIL_MIN_DISTANCE):
+            kept.append(vehicle)
+            current[vehicle.vehicle_id] = (fix_time, vehicle.latitude, vehicle.longitude)
+        else:
+            current[vehicle.vehicle_id] = previous
+    for vehicle_id in last_kept.keys() & (last_fix.keys() - current.keys()): # Seen this cycle without a new fix
+        current[vehicle_id] = last_kept[vehicle_id]
+    last_kept = current
+    return kept
+
+def append_cycle(vehicles: List) -> None:
+    """Add a cycle of vehicles to the trails (and the archive), called by the ingester."""
+    fixes = new_fixes(vehicles)
+    trail_archive.add(fixes)
+    points = downsample(fixes)
+
+    max_points = stats['max_points']
+    window_start = int((time.time() - Config.TRAIL_WINDOW) * 1000)
+    try:
+        with redis_client.pipeline(transaction=False) as pipe: # One round trip per cycle
+            for vehicle in points:
+                key = trail_key(vehicle.vehicle_id)
+                pipe.xadd(key, {
+                    't': vehicle.timestamp.timestamp(),
+                    'lat': vehicle.latitude,
+                    'lon': vehicle.longitude,
+                    'b': vehicle.bearing,
+                    'v': vehicle.velocity,
+                    'j': vehicle.service_journey_id,
+                }, minid=window_start, approximate=True)
+                pipe.xtrim(key, maxlen=max_points, approximate=True) # XADD takes MINID or MAXLEN, not both
+                pipe.expire(key, Config.TRAIL_WINDOW)
+            pipe.execute()
+    except UNAVAILABLE_ERRORS:
+        count(errors=1) # The trails get a gap, the next cycle continues them
+        return
+
+    count(cycles=1, fixes=len(fixes), points=len(points))
+    with stats_lock:
+        stats['trails'] = len(last_kept)
+        cycles = stats['cycles']
+    if cycles % MEMORY_SAMPLE_EVERY == 1:
+        check_memory(list(last_kept))
+
+def check_memory(vehicle_ids: List[int]) -> None:
+    """Measure the trails from a sample, lower max_points if full trails would not fit the budget and publish the stats."""
+    sample = random.sample(vehicle_ids, min(MEMORY_SAMPLE_KEYS, len(vehicle_ids)))
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            for vehicle_id in sample:
+                pipe.memory_usage(trail_key(vehicle_id), samples=0)
+                pipe.xlen(trail_key(vehicle_id))
+            results = pipe.execute() if sample else []
+        memory = sum(usage or 0 for usage in results[0::2])
+        points = sum(results[1::2])
+
+        with stats_lock:
+            if sample:
+                stats['used_bytes'] = int(memory / len(sample) * len(vehicle_ids))
+            # Short trails are mostly per key overhead, wait until there is something to extrapolate from
+            if points >= MIN_POINTS_TO_ESTIMATE * len(sample) > 0:
+                bytes_per_point = memory / points # Includes the per key overhead, spread over the points
+                max_points = stats['max_points']
+                estimated = bytes_per_point * max_points * len(vehicle_ids)
+                if estimated > Config.TRAIL_MEMORY_BUDGET:
+                    max_points = max(10, int(max_points * Config.TRAIL_MEMORY_BUDGET / estimated * 0.9))
+                elif estimated < Config.TRAIL_MEMORY_BUDGET / 2:
+                    max_points = min(Config.TRAIL_MAX_POINTS, int(max_points * 1.25) + 1) # Grow back once there is room
+                stats.update(
+                    max_points=max_points,
+                    bytes_per_point=bytes_per_point,
+                    estimated_bytes=int(bytes_per_point * max_points * len(vehicle_ids)),
+                )
+            shared = dict(stats)
+        shared['archive'] = trail_archive.get_stats()
+        redis_client.set(STATS_KEY, orjson.dumps(shared), ex=MEMORY_SAMPLE_EVERY * 30)
+    except redis.exceptions.RedisError:
+        count(errors=1)
+
+def count(**kwargs) -> None:
+    with stats_lock:
+        for key, value in kwargs.items():
+            stats[key] += value
+
+def read_trail(vehicle_id: int, seconds: float) -> List[dict]:
+    """The points of a vehicle in the last seconds, oldest first."""
+    start = int((time.time() - seconds) * 1000) # Stream ids are milliseconds
+    entries = redis_client.xrange(trail_key(vehicle_id), min=start, max='+')
+    return [
+        {
+            'time': datetime.fromtimestamp(float(fields['t']), timezone.utc),
+            'service_journey_id': fields['j'],
+            'bearing': float(fields['b']),
+            'velocity': int(fields['v']),
+            'location': {'lat': float(fields['lat']), 'lon': float(fields['lon'])},
+        }
+        for _, fields in entries
+    ]
+
+def format_trail_response(vehicle_id: int, points: List[dict]) -> dict:
+    return {
+        'status': 'ok',
+        'type': 'trail',
+        'vehicle_id': str(vehicle_id),
+        'list': points,
+    }
+
+def get_stats() -> dict:
+    """The stats of the ingester, wherever it runs."""
+    try:
+        shared = redis_client.get(STATS_KEY)
+    except redis.exceptions.RedisError:
+        shared = None
+    if shared is not None:
+        return orjson.loads(shared)
+    with stats_lock:
+        result = dict(stats)
+    result['archive'] = trail_archive.get_stats()
+    return result
@@ -0,0 +1,54 @@
+import orjson
+import redis
+from bustrackr_server import redis_client
+from bustrackr_server.config import Config
+from bustrackr_server.utils import orjson_default
+
+# The account data sent on login and /re-auth, cached per user in redis.
+# Anything which changes it (account updates, new log rows) must call invalidate().
+# invalidate() also bumps the user's generation, and a summary read from the database is only
+# cached if the generation is still the one seen before reading it. Otherwise a write landing
+# between the read and put() would leave the old summary cached for USER_SUMMARY_TTL.
+
+SUMMARY_PREFIX = 'user_summary:'
+GENERATION_PREFIX = 'user_summary_gen:'
+GENERATION_TTL = 86400 # Seconds, far longer than reading a summary takes
+
+# Only compare-and-set through lua, so a summary read before an invalidate() is never cached
+PUT_SCRIPT = '''
+if (redis.call('get', KEYS[1]) or '0') == ARGV[1] then
+    return redis.call('set', KEYS[2], ARGV[2], 'EX', ARGV[3])
+end
+return 0
+'''
+
+def get(user_id: int) -> tuple[dict | None, str | None]:
+    """The cached summary, and the generation to pass to put() if there is none."""
+    try:
+        cached, generation = redis_client.mget(f'{SUMMARY_PREFIX}{user_id}', f'{GENERATION_PREFIX}{user_id}')
+    except redis.exceptions.RedisError:
+        return None, None
+    return (orjson.loads(cached) if cached else None), generation or '0'
+
+def put(user_id: int, summary: dict, generation: str | None) -> None:
+    """Cache a summary read from the database, unless it was invalidated since get() returned generation."""
+    if generation is None:
+        return # redis was unavailable for get(), so nothing is known about the generation
+    try:
+        redis_client.eval(PUT_SCRIPT, 2, f'{GENERATION_PREFIX}{user_id}', f'{SUMMARY_PREFIX}{user_id}',
+                          generation, orjson.dumps(summary, default=orjson_default), Config.USER_SUMMARY_TTL)
+    except redis.exceptions.RedisError:
+        pass
+
+def invalidate(*user_ids: int) -> None:
+    if not user_ids:
+        return
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.incr(f'{GENERATION_PREFIX}{user_id}')
+                pipe.expire(f'{GENERATION_PREFIX}{user_id}', GENERATION_TTL)
+            pipe.delete(*(f'{SUMMARY_PREFIX}{user_id}' for user_id in user_ids))
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        pass # The TTL is short, at worst the summary is stale until then
@@ -6,4 +6,8 @@ def orjson_default(obj):
         return obj.isoformat()
     if isinstance(obj, Decimal):
         return str(obj).rstrip('0')
-    raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
\ No newline at end of file
+    raise TypeError(f'Object of type {obj.__class__.__name__} is not JSON serializable')
+
+def bbox_params(lat_0: float, lon_0: float, lat_1: float, lon_1: float) -> dict:
+    """Parameters for the prepared bounding box queries."""
+    return {'lat_0': lat_0, 'lon_0': lon_0, 'lat_1': lat_1, 'lon_1': lon_1}
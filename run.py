@@ -1,11 +1,26 @@
-from bustrackr_server import app, fix_database
+import sys
+from bustrackr_server import create_app, fix_database
+from bustrackr_server.config import Config
+from bustrackr_server.ingest import run as run_ingest
 from flask.cli import with_appcontext
 
+if '--profile-startup' in sys.argv:
+    Config.STARTUP_PROFILE = Config.STARTUP_PROFILE or 'startup.prof'
+
+# Only fetch live data when started directly, not when the flask CLI loads this file
+app = create_app(ingest=None if __name__ == '__main__' else False)
+
 @app.cli.command('initdb')
 @with_appcontext
 def init_db_command():
     '''Load all relevant static data into the database'''
     fix_database()
 
+@app.cli.command('ingest')
+@with_appcontext
+def ingest_command():
+    '''Run the live data ingest worker'''
+    run_ingest()
+
 if __name__ == '__main__':
-    app.run(host='localhost', port=5005, debug=False) # Start the application :)
\ No newline at end of file
+    app.run(host='localhost', port=5005, debug=False) # Start the application :)